@@ -31,6 +31,40 @@ APPDATA_DIR: str = os.path.join(os.path.expanduser("~"), "AppData", "Local", "me
 os.makedirs(APPDATA_DIR, exist_ok=True)
 DB_PATH: str = os.path.join(APPDATA_DIR, "bot.db")
 
+# Пул соединений SQLite: сколько долгоживущих соединений держим для чтений
+DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "4") or 4)
+# Единственный писатель: максимум задач записи в одной транзакции (group commit)
+DB_WRITE_BATCH: int = int(os.getenv("DB_WRITE_BATCH", "128") or 128)
+# LRU-кэш строк users: сколько пользователей держим в памяти
+USER_CACHE_SIZE: int = int(os.getenv("USER_CACHE_SIZE", "10000") or 10000)
+
+# Фоновый подбор пар: период тика, мс
+MATCH_TICK_MS: int = int(os.getenv("MATCH_TICK_MS", "300") or 300)
+# Отложенная запись блоков антиповтора в recent_partners: период, сек
+BLOCKS_FLUSH_SECONDS: int = int(os.getenv("BLOCKS_FLUSH_SECONDS", "5") or 5)
+# Отложенная запись matches.last_activity: не чаще раза в период на матч, сек
+ACTIVITY_FLUSH_SECONDS: int = int(os.getenv("ACTIVITY_FLUSH_SECONDS", "5") or 5)
+# Исходящая очередь: общий лимит бота и лимит на один чат (сообщений/сек)
+OUTBOUND_GLOBAL_RPS: float = float(os.getenv("OUTBOUND_GLOBAL_RPS", "25") or 25)
+OUTBOUND_CHAT_RPS: float = float(os.getenv("OUTBOUND_CHAT_RPS", "1") or 1)
+OUTBOUND_CHAT_BURST: int = int(os.getenv("OUTBOUND_CHAT_BURST", "3") or 3)
+# Предел ожидающих сообщений на класс приоритета и повторов после retry_after
+OUTBOUND_QUEUE_SIZE: int = int(os.getenv("OUTBOUND_QUEUE_SIZE", "5000") or 5000)
+OUTBOUND_MAX_RETRIES: int = int(os.getenv("OUTBOUND_MAX_RETRIES", "3") or 3)
+# Альбомы в чате: окно сборки частей (мс) и предел одновременно собираемых альбомов
+ALBUM_WINDOW_MS: int = int(os.getenv("ALBUM_WINDOW_MS", "700") or 700)
+ALBUM_MAX_GROUPS: int = int(os.getenv("ALBUM_MAX_GROUPS", "1000") or 1000)
+# Обратный отсчёт молчания: общий бюджет правок сообщений в секунду
+COUNTDOWN_EDIT_RPS: float = float(os.getenv("COUNTDOWN_EDIT_RPS", "20") or 20)
+
+# Проверка подписки на канал: TTL кэша членства (подписан / не подписан), сек
+SUB_CACHE_TTL: int = int(os.getenv("SUB_CACHE_TTL", "21600") or 21600)
+SUB_NEGATIVE_TTL: int = int(os.getenv("SUB_NEGATIVE_TTL", "60") or 60)
+# Фоновая перепроверка: период прохода, размер пачки и лимит запросов в секунду
+SUB_RECHECK_INTERVAL: int = int(os.getenv("SUB_RECHECK_INTERVAL", "300") or 300)
+SUB_RECHECK_BATCH: int = int(os.getenv("SUB_RECHECK_BATCH", "50") or 50)
+SUB_RECHECK_RPS: float = float(os.getenv("SUB_RECHECK_RPS", "5") or 5)
+
 # === Тексты ===
 BLOCK_TXT: str = "Сейчас идёт анонимный чат. Доступны только команды: !stop, !next, !reveal."
 
@@ -67,6 +101,12 @@ __all__ = [
     "BOT_TOKEN", "ADMIN_IDS",
     "DAILY_BONUS_POINTS", "REF_BONUS_POINTS", "INACTIVITY_SECONDS",
     "CHANNEL_USERNAME", "CHANNEL_LINK",
-    "APPDATA_DIR", "DB_PATH",
+    "APPDATA_DIR", "DB_PATH", "DB_POOL_SIZE", "DB_WRITE_BATCH", "USER_CACHE_SIZE",
+    "MATCH_TICK_MS", "BLOCKS_FLUSH_SECONDS", "ACTIVITY_FLUSH_SECONDS", "COUNTDOWN_EDIT_RPS",
+    "OUTBOUND_GLOBAL_RPS", "OUTBOUND_CHAT_RPS", "OUTBOUND_CHAT_BURST",
+    "OUTBOUND_QUEUE_SIZE", "OUTBOUND_MAX_RETRIES",
+    "ALBUM_WINDOW_MS", "ALBUM_MAX_GROUPS",
+    "SUB_CACHE_TTL", "SUB_NEGATIVE_TTL",
+    "SUB_RECHECK_INTERVAL", "SUB_RECHECK_BATCH", "SUB_RECHECK_RPS",
     "BLOCK_TXT", "INTRO_TEXT", "FACULTIES",
 ]
@@ -2,7 +2,7 @@
 db package public API.
 
 Собирает экспорт из:
-- core.py  — CREATE_SQL, ALTERS, db(), init_db()
+- core.py  — CREATE_SQL, ALTERS, MIGRATIONS, пул соединений db()/close_db(), писатель write*(), init_db()
 - repo.py  — функции репозитория (ensure_user, set_user_fields, points/shop/refs и т.п.)
 """
 
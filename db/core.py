@@ -1,8 +1,14 @@
 # app/db/core.py
 from __future__ import annotations
 
+import asyncio
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, List, Optional, Sequence, Tuple, Union
+
 import aiosqlite
-from app.config import DB_PATH
+from app.config import DB_PATH, DB_POOL_SIZE, DB_WRITE_BATCH
 
 # ---------------------- Schema & Migrations ----------------------
 
@@ -14,8 +20,6 @@ CREATE TABLE IF NOT EXISTS recent_partners(
   PRIMARY KEY(u_id, partner_id)
 );
 
-PRAGMA journal_mode=WAL;
-
 CREATE TABLE IF NOT EXISTS users(
   tg_id INTEGER PRIMARY KEY,
   gender TEXT,
@@ -134,54 +138,482 @@ ALTERS = [
     ("users", "sub_verified", "ALTER TABLE users ADD COLUMN sub_verified INTEGER DEFAULT 0"),
 ]
 
-# ---------------------- Connection helper ----------------------
+# ---------------------- Connection pool ----------------------
 
-def db():
-    """Open a new aiosqlite connection to the bot database."""
-    return aiosqlite.connect(DB_PATH)
+# PRAGMA, которые применяются один раз при открытии соединения
+CONN_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+)
 
-# ---------------------- Initializer ----------------------
+# Простаивавшее дольше этого соединение перед выдачей проверяем через SELECT 1
+HEALTH_CHECK_IDLE_SECONDS = 30.0
+
+
+async def open_connection(**kwargs) -> aiosqlite.Connection:
+    """Открывает соединение к БД бота и применяет CONN_PRAGMAS."""
+    conn = await aiosqlite.connect(DB_PATH, **kwargs)
+    for pragma in CONN_PRAGMAS:
+        await conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    """
+    Пул долгоживущих aiosqlite-соединений.
+
+    Соединения открываются лениво (не больше size), переиспользуются между
+    запросами и перед выдачей проверяются, если долго простаивали.
+    При возврате в пул незакоммиченная транзакция откатывается.
+    """
+
+    def __init__(self, size: int, *, health_idle: float = HEALTH_CHECK_IDLE_SECONDS):
+        self.size = max(1, int(size))
+        self.health_idle = health_idle
+        self._slots = asyncio.Semaphore(self.size)
+        self._idle: List[Tuple[aiosqlite.Connection, float]] = []
+        self._closed = False
+
+    async def acquire(self) -> aiosqlite.Connection:
+        if self._closed:
+            raise RuntimeError("connection pool is closed")
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if time.monotonic() - last_used < self.health_idle or await self._healthy(conn):
+                    return conn
+                await self._discard(conn)
+            return await open_connection()
+        except BaseException:
+            self._slots.release()
+            raise
 
-async def init_db():
-    """Create base schema, apply soft ALTERs, and run lightweight migrations."""
-    async with db() as conn:
-        # base schema + WAL pragma
-        await conn.executescript(CREATE_SQL)
-
-        # soft ALTERs (idempotent)
-        for table, col, sql in ALTERS:
-            cur = await conn.execute(f"PRAGMA table_info({table})")
-            cols = [r[1] for r in await cur.fetchall()]
-            if col not in cols:
+    async def release(self, conn: aiosqlite.Connection, *, broken: bool = False) -> None:
+        try:
+            if not broken and conn.in_transaction:
                 try:
-                    await conn.execute(sql)
+                    await conn.rollback()
                 except Exception:
-                    # ignore concurrent/multi-run race or older SQLite quirks
-                    pass
+                    broken = True
+            if broken or self._closed:
+                await self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[aiosqlite.Connection]:
+        conn = await self.acquire()
+        broken = False
+        try:
+            yield conn
+        except BaseException:
+            # после ошибки проверим соединение, прежде чем вернуть его в пул
+            broken = not await self._healthy(conn)
+            raise
+        finally:
+            await self.release(conn, broken=broken)
+
+    async def close(self) -> None:
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            await self._discard(conn)
+
+    @staticmethod
+    async def _healthy(conn: aiosqlite.Connection) -> bool:
+        try:
+            await conn.execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    async def _discard(conn: aiosqlite.Connection) -> None:
+        try:
+            await conn.close()
+        except Exception:
+            pass
+
+
+_POOL: Optional[ConnectionPool] = None
+
+
+def get_pool() -> ConnectionPool:
+    """Возвращает общий пул соединений (создаётся при первом обращении)."""
+    global _POOL
+    if _POOL is None:
+        _POOL = ConnectionPool(DB_POOL_SIZE)
+    return _POOL
+
+
+def db():
+    """
+    Соединение из общего пула:
+        async with db() as conn: ...
+    По выходу из блока соединение возвращается в пул, а не закрывается.
+    """
+    return get_pool().connection()
+
+
+# ---------------------- Single writer ----------------------
+
+# Задача записи: получает соединение писателя, возвращает результат вызывающему.
+# commit()/executescript() внутри задачи вызывать нельзя — транзакцией владеет писатель.
+WriteJob = Callable[[aiosqlite.Connection], Awaitable[Any]]
+
+
+class DBWriter:
+    """
+    Единственный писатель в БД.
+
+    Владеет единственным пишущим соединением, принимает задачи через очередь
+    и выполняет всё, что накопилось к очередному «тику», одной транзакцией
+    (group commit). Каждая задача завёрнута в SAVEPOINT: ошибка одной задачи
+    откатывает только её. Future вызывающего резолвится после COMMIT.
+    """
+
+    def __init__(self, *, max_batch: int = DB_WRITE_BATCH):
+        self.max_batch = max(1, int(max_batch))
+        self._queue: "asyncio.Queue[Optional[Tuple[WriteJob, asyncio.Future]]]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._conn: Optional[aiosqlite.Connection] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="db-writer")
+
+    async def submit(self, job: WriteJob) -> Any:
+        self.start()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((job, fut))
+        return await fut
+
+    async def stop(self) -> None:
+        if self._task is None or self._task.done():
+            return
+        await self._queue.put(None)
+        await self._task
+
+    async def _run(self) -> None:
+        try:
+            while True:
+                item = await self._queue.get()
+                if item is None:
+                    return
+                batch = [item]
+                stop = False
+                while len(batch) < self.max_batch and not self._queue.empty():
+                    nxt = self._queue.get_nowait()
+                    if nxt is None:
+                        stop = True
+                        break
+                    batch.append(nxt)
+                await self._commit_batch(batch)
+                if stop:
+                    return
+        finally:
+            if self._conn is not None:
+                await ConnectionPool._discard(self._conn)
+                self._conn = None
+
+    async def _connection(self) -> aiosqlite.Connection:
+        if self._conn is None:
+            # isolation_level=None — транзакциями управляем явно (BEGIN/SAVEPOINT/COMMIT)
+            self._conn = await open_connection(isolation_level=None)
+        return self._conn
+
+    async def _commit_batch(self, batch: List[Tuple[WriteJob, asyncio.Future]]) -> None:
+        batch = [(job, fut) for job, fut in batch if not fut.done()]
+        if not batch:
+            return
+        outcomes: List[Tuple[asyncio.Future, Any, Optional[BaseException]]] = []
+        try:
+            conn = await self._connection()
+            await conn.execute("BEGIN IMMEDIATE")
+            for job, fut in batch:
+                await conn.execute("SAVEPOINT job")
+                try:
+                    res = await job(conn)
+                except Exception as e:
+                    await conn.execute("ROLLBACK TO job")
+                    await conn.execute("RELEASE job")
+                    outcomes.append((fut, None, e))
+                else:
+                    await conn.execute("RELEASE job")
+                    outcomes.append((fut, res, None))
+            await conn.execute("COMMIT")
+        except Exception as e:
+            await self._abort()
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        for fut, res, err in outcomes:
+            if fut.done():
+                continue
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(res)
+
+    async def _abort(self) -> None:
+        conn = self._conn
+        if conn is None:
+            return
+        try:
+            if conn.in_transaction:
+                await conn.execute("ROLLBACK")
+        except Exception:
+            # соединение в неизвестном состоянии — откроем новое на следующем тике
+            self._conn = None
+            await ConnectionPool._discard(conn)
+
+
+_WRITER: Optional[DBWriter] = None
+
+
+def get_writer() -> DBWriter:
+    """Возвращает общий писатель (стартует при первой записи)."""
+    global _WRITER
+    if _WRITER is None:
+        _WRITER = DBWriter()
+    return _WRITER
+
 
-        # referrals migration + opaque ref_codes
-        cur = await conn.execute(
-            "SELECT name FROM sqlite_master WHERE type='table' AND name='referrals'"
+async def write_tx(job: WriteJob) -> Any:
+    """Выполнить задачу записи через единственного писателя и дождаться COMMIT."""
+    return await get_writer().submit(job)
+
+
+async def write(sql: str, params: Sequence[Any] = ()) -> int:
+    """Один пишущий запрос через писателя. Возвращает lastrowid."""
+    async def job(conn: aiosqlite.Connection) -> int:
+        cur = await conn.execute(sql, params)
+        return int(cur.lastrowid or 0)
+    return await write_tx(job)
+
+
+async def write_many(sql: str, seq: Iterable[Sequence[Any]]) -> None:
+    """executemany через писателя."""
+    rows = list(seq)
+    if not rows:
+        return
+
+    async def job(conn: aiosqlite.Connection) -> None:
+        await conn.executemany(sql, rows)
+    await write_tx(job)
+
+
+async def close_db() -> None:
+    """Останавливает писателя и закрывает соединения пула (вызывать при остановке бота)."""
+    global _POOL, _WRITER
+    writer, _WRITER = _WRITER, None
+    if writer is not None:
+        await writer.stop()
+    pool, _POOL = _POOL, None
+    if pool is not None:
+        await pool.close()
+
+
+# ---------------------- Initializer ----------------------
+
+async def _m001_base(conn: aiosqlite.Connection) -> None:
+    """Базовая схема + мягкие ALTER'ы для баз, созданных до версионирования."""
+    for stmt in _split_sql(CREATE_SQL):
+        await conn.execute(stmt)
+
+    # soft ALTERs: старые базы (user_version=0) могут уже содержать колонки
+    for table, col, sql in ALTERS:
+        if col not in await _table_columns(conn, table):
+            await conn.execute(sql)
+
+    # referrals migration + opaque ref_codes
+    cols = await _table_columns(conn, "referrals")
+    if "inviter" not in cols:
+        await conn.execute("ALTER TABLE referrals ADD COLUMN inviter INTEGER")
+    if "ts" not in cols:
+        await conn.execute(
+            "ALTER TABLE referrals ADD COLUMN ts INTEGER DEFAULT (strftime('%s','now'))"
+        )
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ref_codes(
+          code TEXT PRIMARY KEY,
+          inviter INTEGER NOT NULL
         )
-        has_ref = await cur.fetchone()
-        if has_ref:
-            cur = await conn.execute("PRAGMA table_info(referrals)")
-            cols = {r[1] for r in await cur.fetchall()}
-            if "inviter" not in cols:
-                await conn.execute("ALTER TABLE referrals ADD COLUMN inviter INTEGER")
-            if "ts" not in cols:
-                await conn.execute(
-                    "ALTER TABLE referrals ADD COLUMN ts INTEGER DEFAULT (strftime('%s','now'))"
-                )
-            await conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS ref_codes(
-                  code TEXT PRIMARY KEY,
-                  inviter INTEGER NOT NULL
-                )
-                """
-            )
-
-        await conn.commit()
-
-__all__ = ["db", "init_db", "CREATE_SQL", "ALTERS"]
+        """
+    )
+
+
+# Индексы под горячие запросы (matching/support/admin/профиль).
+# idx_matches_active(active) почти не селективен и перебивал индексы по участникам,
+# поэтому заменён частичным индексом только по живым матчам.
+M002_HOT_INDEXES = """
+DROP INDEX IF EXISTS idx_matches_active;
+CREATE INDEX IF NOT EXISTS idx_matches_live ON matches(started_at) WHERE active=1;
+CREATE INDEX IF NOT EXISTS idx_matches_a ON matches(a_id, id);
+CREATE INDEX IF NOT EXISTS idx_matches_b ON matches(b_id, id);
+CREATE INDEX IF NOT EXISTS idx_queue_ts ON queue(ts);
+CREATE INDEX IF NOT EXISTS idx_support_open ON support_msgs(status, from_user, ts);
+CREATE INDEX IF NOT EXISTS idx_support_user ON support_msgs(from_user, status);
+CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(user_id, ts);
+CREATE INDEX IF NOT EXISTS idx_referrals_inviter ON referrals(inviter);
+CREATE INDEX IF NOT EXISTS idx_ref_codes_inviter ON ref_codes(inviter);
+CREATE INDEX IF NOT EXISTS idx_users_role ON users(role, tg_id);
+"""
+
+# Дубли живых матчей (у пользователя несколько active=1): оставляем только
+# матчи, у участников которых нет более позднего живого матча; вытесненные
+# закрываем, их строки active_sessions (у обоих участников) удаляем.
+_DEDUPE_LIVE_MATCHES = """
+UPDATE matches SET active=0
+WHERE active=1 AND EXISTS (
+  SELECT 1 FROM matches n
+  WHERE n.active=1 AND n.id > matches.id
+    AND (n.a_id IN (matches.a_id, matches.b_id) OR n.b_id IN (matches.a_id, matches.b_id))
+);
+"""
+
+# Денормализованные живые сессии: «есть ли у пользователя чат» — поиск по PK.
+# Поддерживается start_match / end_current_chat; заполняем из активных матчей
+# (дубли сначала разбираются _DEDUPE_LIVE_MATCHES).
+M003_ACTIVE_SESSIONS = _DEDUPE_LIVE_MATCHES + """
+CREATE TABLE IF NOT EXISTS active_sessions(
+  user_id INTEGER PRIMARY KEY,
+  peer_id INTEGER NOT NULL,
+  match_id INTEGER NOT NULL,
+  started_at INTEGER NOT NULL DEFAULT (strftime('%s','now'))
+);
+CREATE INDEX IF NOT EXISTS idx_active_sessions_match ON active_sessions(match_id);
+CREATE INDEX IF NOT EXISTS idx_active_sessions_started ON active_sessions(started_at);
+INSERT OR REPLACE INTO active_sessions(user_id, peer_id, match_id, started_at)
+  SELECT a_id, b_id, id, COALESCE(started_at, strftime('%s','now')) FROM matches WHERE active=1
+  UNION ALL
+  SELECT b_id, a_id, id, COALESCE(started_at, strftime('%s','now')) FROM matches WHERE active=1
+  ORDER BY 3;
+"""
+
+async def _m004_rating_totals(conn: aiosqlite.Connection) -> None:
+    """
+    Агрегаты оценок прямо в users: rating_sum/rating_count.
+    Бэкфилл из ratings + триггер, чтобы каждая новая оценка обновляла счётчики.
+    """
+    cols = await _table_columns(conn, "users")
+    if "rating_sum" not in cols:
+        await conn.execute("ALTER TABLE users ADD COLUMN rating_sum INTEGER NOT NULL DEFAULT 0")
+    if "rating_count" not in cols:
+        await conn.execute("ALTER TABLE users ADD COLUMN rating_count INTEGER NOT NULL DEFAULT 0")
+    await conn.execute(
+        """
+        UPDATE users SET
+          rating_sum   = (SELECT COALESCE(SUM(stars),0) FROM ratings WHERE to_user=users.tg_id),
+          rating_count = (SELECT COUNT(*) FROM ratings WHERE to_user=users.tg_id)
+        WHERE tg_id IN (SELECT to_user FROM ratings)
+        """
+    )
+    await conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_ratings_totals AFTER INSERT ON ratings
+        BEGIN
+          UPDATE users SET rating_sum = rating_sum + NEW.stars,
+                           rating_count = rating_count + 1
+          WHERE tg_id = NEW.to_user;
+        END
+        """
+    )
+
+
+async def _m005_match_activity(conn: aiosqlite.Connection) -> None:
+    """matches.last_activity — «стенное» время последнего сообщения (таймер молчания после рестарта)."""
+    if "last_activity" not in await _table_columns(conn, "matches"):
+        await conn.execute("ALTER TABLE matches ADD COLUMN last_activity INTEGER")
+    await conn.execute(
+        "UPDATE matches SET last_activity=started_at WHERE active=1 AND last_activity IS NULL"
+    )
+
+
+# Базы, прошедшие M003 до разбора дублей: вытесненный матч оставался активным,
+# а у второго его участника — висячая строка active_sessions.
+M006_DEDUPE_SESSIONS = _DEDUPE_LIVE_MATCHES + """
+DELETE FROM active_sessions
+WHERE match_id NOT IN (SELECT id FROM matches WHERE active=1);
+"""
+
+
+# Нумерованные шаги миграций: (версия, описание, SQL-скрипт или async-функция(conn)).
+# Новые шаги — только в конец, с версией на 1 больше последней.
+MIGRATIONS: List[Tuple[int, str, Union[str, Callable[[aiosqlite.Connection], Awaitable[None]]]]] = [
+    (1, "base schema", _m001_base),
+    (2, "hot query indexes", M002_HOT_INDEXES),
+    (3, "active_sessions", M003_ACTIVE_SESSIONS),
+    (4, "users rating totals", _m004_rating_totals),
+    (5, "matches.last_activity", _m005_match_activity),
+    (6, "drop superseded live matches", M006_DEDUPE_SESSIONS),
+]
+
+SCHEMA_VERSION: int = MIGRATIONS[-1][0]
+
+
+def _split_sql(script: str) -> List[str]:
+    """Режет SQL-скрипт на отдельные statements (учитывает BEGIN…END триггеров)."""
+    out: List[str] = []
+    buf = ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            if buf.strip():
+                out.append(buf.strip())
+            buf = ""
+    if buf.strip():
+        out.append(buf.strip())
+    return out
+
+
+async def _table_columns(conn: aiosqlite.Connection, table: str) -> set[str]:
+    cur = await conn.execute(f"PRAGMA table_info({table})")
+    return {r[1] for r in await cur.fetchall()}
+
+
+async def init_db() -> None:
+    """
+    Приводит схему к SCHEMA_VERSION по PRAGMA user_version.
+    Если база уже актуальна — один PRAGMA и выход. Каждый шаг миграции
+    выполняется в своей транзакции вместе с повышением user_version.
+    Вызывается на старте, до первой записи через писателя.
+    """
+    conn = await open_connection(isolation_level=None)
+    try:
+        cur = await conn.execute("PRAGMA user_version")
+        current = int((await cur.fetchone())[0])
+        if current >= SCHEMA_VERSION:
+            return
+
+        for version, _name, step in MIGRATIONS:
+            if version <= current:
+                continue
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                if isinstance(step, str):
+                    for stmt in _split_sql(step):
+                        await conn.execute(stmt)
+                else:
+                    await step(conn)
+                await conn.execute(f"PRAGMA user_version={int(version)}")
+                await conn.execute("COMMIT")
+            except BaseException:
+                await conn.execute("ROLLBACK")
+                raise
+    finally:
+        await conn.close()
+
+__all__ = [
+    "db", "init_db", "close_db", "get_pool", "open_connection",
+    "ConnectionPool", "CONN_PRAGMAS", "CREATE_SQL", "ALTERS",
+    "MIGRATIONS", "SCHEMA_VERSION",
+    "DBWriter", "WriteJob", "get_writer", "write_tx", "write", "write_many",
+]
@@ -1,25 +1,157 @@
 # app/db/repo.py
 from __future__ import annotations
 
-from typing import Optional, List, Tuple
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, List, Tuple
 import string
 import secrets
 
-from app.db.core import db
-from app.config import ADMIN_IDS
+from app.db.core import db, write, write_many, write_tx
+from app.config import ADMIN_IDS, USER_CACHE_SIZE
 
 # Базовые бесплатные статусы держим рядом с инвентарём
 # (как в исходнике).
 DEFAULT_FREE_STATUSES = ["Котик 12 кафедры", "Вайбкодер", "Странный чел"]
 
+# -------------------------- Кэш пользователей --------------------------
+
+# Порядок колонок прежнего кортежа get_user(): u[1] — gender, u[10] — photo1 и т.д.
+USER_COLUMNS = (
+    "tg_id", "gender", "seeking", "reveal_ready", "first_name", "last_name",
+    "faculty", "age", "about", "username", "photo1", "photo2", "photo3",
+)
+
+
+class UserRow:
+    """
+    Компактная строка users для кэша.
+    Индексируется как прежний кортеж (u[1], u[10]…), плюс role/status_title
+    и агрегаты оценок rating_sum/rating_count по имени.
+    Неизменяемая по соглашению: при записи кэш подменяет объект копией.
+    """
+    __slots__ = USER_COLUMNS + ("role", "status_title", "rating_sum", "rating_count")
+
+    def __init__(self, *values: Any):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(getattr(self, n) for n in USER_COLUMNS[i])
+        return getattr(self, USER_COLUMNS[i])
+
+    def __len__(self) -> int:
+        return len(USER_COLUMNS)
+
+    def __iter__(self):
+        return (getattr(self, n) for n in USER_COLUMNS)
+
+    def __repr__(self) -> str:
+        return f"UserRow{tuple(getattr(self, n) for n in self.__slots__)!r}"
+
+    def replaced(self, fields: Dict[str, Any]) -> "UserRow":
+        return UserRow(*(fields.get(n, getattr(self, n)) for n in self.__slots__))
+
+
+class _UserCache:
+    """
+    Ограниченный LRU строк users с write-through обновлением.
+    Чтение-промах, начатое до записи, не кладёт в кэш устаревшую строку.
+    """
+
+    def __init__(self, size: int):
+        self.size = max(1, int(size))
+        self.hits = 0
+        self.misses = 0
+        self._rows: "OrderedDict[int, UserRow]" = OrderedDict()
+        self._inflight: Dict[int, Tuple[int, int]] = {}  # tg_id -> (readers, writes)
+
+    def peek(self, tg_id: int) -> Optional[UserRow]:
+        """Строка без учёта в LRU и счётчиках."""
+        return self._rows.get(tg_id)
+
+    def get(self, tg_id: int) -> Optional[UserRow]:
+        row = self._rows.get(tg_id)
+        if row is None:
+            self.misses += 1
+            return None
+        self._rows.move_to_end(tg_id)
+        self.hits += 1
+        return row
+
+    def begin_read(self, tg_id: int) -> int:
+        readers, writes = self._inflight.get(tg_id, (0, 0))
+        self._inflight[tg_id] = (readers + 1, writes)
+        return writes
+
+    def end_read(self, tg_id: int, token: int, row: Optional[UserRow]) -> None:
+        readers, writes = self._inflight.pop(tg_id, (1, token))
+        if readers > 1:
+            self._inflight[tg_id] = (readers - 1, writes)
+        if row is not None and writes == token:
+            self._put(tg_id, row)
+
+    def apply(self, tg_id: int, fields: Dict[str, Any]) -> None:
+        if tg_id in self._inflight:
+            readers, writes = self._inflight[tg_id]
+            self._inflight[tg_id] = (readers, writes + 1)
+        row = self._rows.get(tg_id)
+        if row is None:
+            return
+        known = {k: v for k, v in fields.items() if k in UserRow.__slots__}
+        if known:
+            self._rows[tg_id] = row.replaced(known)
+
+    def invalidate(self, tg_id: int) -> None:
+        self.apply(tg_id, {})
+        self._rows.pop(tg_id, None)
+
+    def _put(self, tg_id: int, row: UserRow) -> None:
+        self._rows[tg_id] = row
+        self._rows.move_to_end(tg_id)
+        while len(self._rows) > self.size:
+            self._rows.popitem(last=False)
+
+
+_USERS = _UserCache(USER_CACHE_SIZE)
+
+
+def user_cache_stats() -> Dict[str, int]:
+    """Счётчики кэша пользователей: hits/misses/size."""
+    return {"hits": _USERS.hits, "misses": _USERS.misses, "size": len(_USERS._rows)}
+
+# -------------------------- Индекс ролей --------------------------
+
+# Админы в памяти: users.role='admin' ∪ ADMIN_IDS. Проверка роли — без I/O.
+_ADMINS: set[int] = set(ADMIN_IDS)
+
+
+async def load_role_index() -> None:
+    """Загружает индекс админов из users.role (вызывать на старте после init_db)."""
+    async with db() as conn:
+        cur = await conn.execute("SELECT tg_id FROM users WHERE role='admin'")
+        ids = {int(r[0]) for r in await cur.fetchall()}
+    _ADMINS.clear()
+    _ADMINS.update(ids | ADMIN_IDS)
+
+
+def is_admin_id(tg_id: int) -> bool:
+    return tg_id in _ADMINS
+
+
+def admin_ids() -> list[int]:
+    return sorted(_ADMINS)
+
 # -------------------------- Пользователи --------------------------
 
 async def ensure_user(tg_id: int):
-    async with db() as conn:
+    async def job(conn):
         await conn.execute("INSERT OR IGNORE INTO users(tg_id) VALUES(?)", (tg_id,))
         if tg_id in ADMIN_IDS:
             await conn.execute("UPDATE users SET role='admin' WHERE tg_id=?", (tg_id,))
-        await conn.commit()
+    await write_tx(job)
+    if tg_id in ADMIN_IDS:
+        _USERS.apply(tg_id, {"role": "admin"})
     # гарантируем бесплатные статусы в инвентаре
     await ensure_free_statuses(tg_id)
 
@@ -28,21 +160,56 @@ async def set_user_fields(tg_id: int, **kwargs):
         return
     cols = ", ".join([f"{k}=?" for k in kwargs.keys()])
     vals = list(kwargs.values()) + [tg_id]
-    async with db() as conn:
-        await conn.execute(f"UPDATE users SET {cols} WHERE tg_id=?", vals)
-        await conn.commit()
-
-async def get_user(tg_id: int):
-    async with db() as conn:
-        cur = await conn.execute(
-            """
-            SELECT tg_id,gender,seeking,reveal_ready,first_name,last_name,
-                   faculty,age,about,username,photo1,photo2,photo3
-            FROM users WHERE tg_id=?
-            """,
-            (tg_id,),
-        )
-        return await cur.fetchone()
+    await write(f"UPDATE users SET {cols} WHERE tg_id=?", vals)
+    _USERS.apply(tg_id, kwargs)
+
+_USER_SELECT = """
+    SELECT tg_id,gender,seeking,reveal_ready,first_name,last_name,
+           faculty,age,about,username,photo1,photo2,photo3,
+           role,status_title,rating_sum,rating_count
+    FROM users
+"""
+
+async def get_user(tg_id: int) -> Optional[UserRow]:
+    row = _USERS.get(tg_id)
+    if row is not None:
+        return row
+    token = _USERS.begin_read(tg_id)
+    row = None
+    try:
+        async with db() as conn:
+            cur = await conn.execute(_USER_SELECT + " WHERE tg_id=?", (tg_id,))
+            raw = await cur.fetchone()
+        row = UserRow(*raw) if raw else None
+    finally:
+        _USERS.end_read(tg_id, token, row)
+    return row
+
+async def get_users(ids: Iterable[int]) -> Dict[int, UserRow]:
+    """Несколько строк сразу: из кэша, промахи — одним запросом IN (...)."""
+    out: Dict[int, UserRow] = {}
+    missing: List[int] = []
+    for tg_id in dict.fromkeys(ids):
+        row = _USERS.get(tg_id)
+        if row is not None:
+            out[tg_id] = row
+        else:
+            missing.append(tg_id)
+    if not missing:
+        return out
+    tokens = {tg_id: _USERS.begin_read(tg_id) for tg_id in missing}
+    fetched: Dict[int, UserRow] = {}
+    try:
+        marks = ",".join("?" * len(missing))
+        async with db() as conn:
+            cur = await conn.execute(_USER_SELECT + f" WHERE tg_id IN ({marks})", missing)
+            for raw in await cur.fetchall():
+                fetched[int(raw[0])] = UserRow(*raw)
+    finally:
+        for tg_id, token in tokens.items():
+            _USERS.end_read(tg_id, token, fetched.get(tg_id))
+    out.update(fetched)
+    return out
 
 async def get_user_or_create(tg_id: int):
     u = await get_user(tg_id)
@@ -52,20 +219,23 @@ async def get_user_or_create(tg_id: int):
     return u
 
 async def get_role(tg_id: int) -> str:
-    async with db() as conn:
-        cur = await conn.execute("SELECT role FROM users WHERE tg_id=?", (tg_id,))
-        row = await cur.fetchone()
-        return row[0] if row else "user"
+    return "admin" if tg_id in _ADMINS else "user"
+
+async def set_role(tg_id: int, role: str) -> None:
+    await write("UPDATE users SET role=? WHERE tg_id=?", (role, tg_id))
+    _USERS.apply(tg_id, {"role": role})
+    if role == "admin":
+        _ADMINS.add(tg_id)
+    elif tg_id not in ADMIN_IDS:
+        _ADMINS.discard(tg_id)
 
 # ---------------------------- Очки -----------------------------
 
 async def add_points(tg_id: int, delta: int):
-    async with db() as conn:
-        await conn.execute(
-            "UPDATE users SET points = COALESCE(points,0) + ? WHERE tg_id=?",
-            (delta, tg_id),
-        )
-        await conn.commit()
+    await write(
+        "UPDATE users SET points = COALESCE(points,0) + ? WHERE tg_id=?",
+        (delta, tg_id),
+    )
 
 async def get_points(tg_id: int) -> int:
     async with db() as conn:
@@ -75,6 +245,39 @@ async def get_points(tg_id: int) -> int:
         row = await cur.fetchone()
         return int(row[0] if row else 0)
 
+# ---------------------------- Оценки -----------------------------
+
+async def add_rating(match_id: int, from_user: int, to_user: int, stars: int) -> bool:
+    """
+    Сохраняет оценку (одна на матч от пользователя). Счётчики users.rating_*
+    обновляет триггер; строку в кэше подправляем сами. True — оценка новая.
+    """
+    async def job(conn) -> bool:
+        cur = await conn.execute(
+            "INSERT OR IGNORE INTO ratings(match_id,from_user,to_user,stars) VALUES(?,?,?,?)",
+            (match_id, from_user, to_user, stars),
+        )
+        return cur.rowcount > 0
+    added = await write_tx(job)
+    if added:
+        row = _USERS.peek(to_user)
+        _USERS.apply(to_user, {} if row is None else {
+            "rating_sum": (row.rating_sum or 0) + stars,
+            "rating_count": (row.rating_count or 0) + 1,
+        })
+    return added
+
+def format_rating(u: Optional[UserRow]) -> str:
+    """Рейтинг для приветствия: «4.3 (12)» или «— (0)»."""
+    cnt = int(u.rating_count or 0) if u else 0
+    if not cnt:
+        return "— (0)"
+    return f"{u.rating_sum / cnt:.1f} ({cnt})"
+
+async def rating_text(tg_id: int) -> str:
+    """Рейтинг пользователя из кэша строк users (без агрегатов по ratings)."""
+    return format_rating(await get_user(tg_id))
+
 # ---------------------------- Магазин -----------------------------
 
 async def list_items():
@@ -86,17 +289,13 @@ async def list_items():
         return await cur.fetchall()
 
 async def add_item(name: str, price: int, type_: str, payload: str):
-    async with db() as conn:
-        await conn.execute(
-            "INSERT INTO shop_items(name,price,type,payload) VALUES(?,?,?,?)",
-            (name, price, type_, payload),
-        )
-        await conn.commit()
+    await write(
+        "INSERT INTO shop_items(name,price,type,payload) VALUES(?,?,?,?)",
+        (name, price, type_, payload),
+    )
 
 async def del_item(item_id: int):
-    async with db() as conn:
-        await conn.execute("DELETE FROM shop_items WHERE id=?", (item_id,))
-        await conn.commit()
+    await write("DELETE FROM shop_items WHERE id=?", (item_id,))
 
 async def get_item(item_id: int):
     async with db() as conn:
@@ -108,12 +307,10 @@ async def get_item(item_id: int):
 # ---------------------- Статусы / инвентарь ----------------------
 
 async def add_status_to_inventory(user_id: int, title: str):
-    async with db() as conn:
-        await conn.execute(
-            "INSERT OR IGNORE INTO user_statuses(user_id, title) VALUES(?,?)",
-            (user_id, title),
-        )
-        await conn.commit()
+    await write(
+        "INSERT OR IGNORE INTO user_statuses(user_id, title) VALUES(?,?)",
+        (user_id, title),
+    )
 
 async def get_status_inventory(user_id: int) -> list[str]:
     async with db() as conn:
@@ -128,51 +325,38 @@ async def ensure_free_statuses(user_id: int):
     missing = [s for s in DEFAULT_FREE_STATUSES if s not in inv]
     if not missing:
         return
-    async with db() as conn:
-        await conn.executemany(
-            "INSERT OR IGNORE INTO user_statuses(user_id, title) VALUES(?,?)",
-            [(user_id, s) for s in missing],
-        )
-        await conn.commit()
+    await write_many(
+        "INSERT OR IGNORE INTO user_statuses(user_id, title) VALUES(?,?)",
+        [(user_id, s) for s in missing],
+    )
 
 async def set_status(tg_id: int, title: Optional[str]):
-    async with db() as conn:
-        await conn.execute("UPDATE users SET status_title=? WHERE tg_id=?", (title, tg_id))
-        await conn.commit()
+    await write("UPDATE users SET status_title=? WHERE tg_id=?", (title, tg_id))
+    _USERS.apply(tg_id, {"status_title": title})
 
 async def get_status(tg_id: int) -> Optional[str]:
-    async with db() as conn:
-        cur = await conn.execute("SELECT status_title FROM users WHERE tg_id=?", (tg_id,))
-        row = await cur.fetchone()
-        return row[0] if row and row[0] else None
+    u = await get_user(tg_id)
+    return u.status_title if u and u.status_title else None
 
 # -------------------------- Рефералы -----------------------------
 
 async def register_referral(inviter: int, invited: int) -> bool:
     if inviter == invited or inviter is None:
         return False
-    async with db() as conn:
+
+    # проверка и вставка — в одной транзакции писателя
+    async def job(conn) -> bool:
         cur = await conn.execute("SELECT 1 FROM referrals WHERE invited=?", (invited,))
         if await cur.fetchone():
             return False
         await conn.execute(
             "INSERT INTO referrals(inviter, invited) VALUES(?,?)", (inviter, invited)
         )
-        await conn.commit()
-    return True
+        return True
+    return await write_tx(job)
 
 async def count_referrals(inviter: int) -> int:
     async with db() as conn:
-        # мягкая инициализация/миграции (как было в исходнике)
-        await conn.execute(
-            "CREATE TABLE IF NOT EXISTS referrals("
-            "inviter INTEGER, invited INTEGER PRIMARY KEY, "
-            "ts INTEGER DEFAULT (strftime('%s','now')))"
-        )
-        cur = await conn.execute("PRAGMA table_info(referrals)")
-        cols = {r[1] for r in await cur.fetchall()}
-        if "inviter" not in cols:
-            await conn.execute("ALTER TABLE referrals ADD COLUMN inviter INTEGER")
         cur = await conn.execute("SELECT COUNT(*) FROM referrals WHERE inviter=?", (inviter,))
         row = await cur.fetchone()
         return int(row[0] if row else 0)
@@ -187,10 +371,17 @@ async def get_or_create_ref_code(inviter: int) -> str:
         row = await cur.fetchone()
         if row:
             return row[0]
+
+    async def job(conn) -> str:
+        # повторная проверка уже внутри транзакции писателя
+        cur = await conn.execute("SELECT code FROM ref_codes WHERE inviter=?", (inviter,))
+        row = await cur.fetchone()
+        if row:
+            return row[0]
         code = "".join(secrets.choice(ALPH) for _ in range(12))
         await conn.execute("INSERT INTO ref_codes(code,inviter) VALUES(?,?)", (code, inviter))
-        await conn.commit()
         return code
+    return await write_tx(job)
 
 async def inviter_by_code(code: str) -> Optional[int]:
     async with db() as conn:
@@ -228,8 +419,11 @@ async def purchases_summary(user_id: int) -> tuple[int, list[str]]:
 
 __all__ = [
     # users/roles/points
-    "ensure_user", "set_user_fields", "get_user", "get_user_or_create",
-    "get_role", "add_points", "get_points",
+    "USER_COLUMNS", "UserRow", "user_cache_stats",
+    "ensure_user", "set_user_fields", "get_user", "get_users", "get_user_or_create",
+    "get_role", "set_role", "add_points", "get_points",
+    "add_rating", "rating_text", "format_rating",
+    "load_role_index", "is_admin_id", "admin_ids",
     # shop
     "list_items", "add_item", "del_item", "get_item",
     # statuses/inventory
@@ -4,8 +4,7 @@ from __future__ import annotations
 from aiogram import Router
 from aiogram.types import ReplyKeyboardMarkup
 
-from app import config as cfg
-from app.db.repo import get_role
+from app.db.repo import is_admin_id
 from app.keyboards.common import main_menu
 from app.keyboards.admin import admin_reply_menu
 
@@ -15,8 +14,7 @@ async def menu_for(user_id: int) -> ReplyKeyboardMarkup:
     Унифицированный выбор клавиатуры: если админ — показываем админ-кнопку,
     иначе — обычное главное меню.
     """
-    role = await get_role(user_id)
-    if role == "admin" or user_id in cfg.ADMIN_IDS:
+    if is_admin_id(user_id):
         return admin_reply_menu()
     return main_menu()
 
@@ -5,7 +5,7 @@ from aiogram import Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, Message
 
-from app.db.core import db
+from app.db.repo import set_role
 from app.keyboards.admin import admin_admins_kb
 from app.services.admin import require_admin, list_admin_ids
 from app.states import AdminAdmins
@@ -58,14 +58,11 @@ async def admin_admins_apply(m: Message, state: FSMContext):
     if uid == m.from_user.id:
         return await m.answer("Нельзя менять свои права этим способом.")
 
-    async with db() as conn:
-        if mode == "add":
-            await conn.execute("UPDATE users SET role='admin' WHERE tg_id=?", (uid,))
-            await conn.commit()
-            await m.answer(f"✅ Пользователь {uid} теперь админ.", reply_markup=admin_admins_kb())
-        else:
-            await conn.execute("UPDATE users SET role='user' WHERE tg_id=?", (uid,))
-            await conn.commit()
-            await m.answer(f"✅ Пользователь {uid} разжалован.", reply_markup=admin_admins_kb())
+    if mode == "add":
+        await set_role(uid, "admin")
+        await m.answer(f"✅ Пользователь {uid} теперь админ.", reply_markup=admin_admins_kb())
+    else:
+        await set_role(uid, "user")
+        await m.answer(f"✅ Пользователь {uid} разжалован.", reply_markup=admin_admins_kb())
 
     await state.clear()
@@ -1,7 +1,10 @@
 # app/handlers/admin/broadcast.py
 from __future__ import annotations
 
-from aiogram import Router, F
+import asyncio
+import logging
+
+from aiogram import Bot, Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, Message
 
@@ -9,8 +12,12 @@ from app.keyboards.admin import admin_main_kb
 from app.services.admin import require_admin, broadcast_all
 from app.states import AdminBroadcast
 
+log = logging.getLogger(__name__)
+
 router = Router(name="admin_broadcast")
 
+_BG: set[asyncio.Task] = set()  # фоновые рассылки
+
 
 @router.callback_query(F.data == "admin:broadcast")
 async def admin_broadcast_start(c: CallbackQuery, state: FSMContext):
@@ -27,5 +34,22 @@ async def admin_broadcast_run(m: Message, state: FSMContext):
         return
     text = m.text or ""
     await state.clear()
-    ok, total = await broadcast_all(m.bot, text)
-    await m.answer(f"📣 Разослано: {ok}/{total}", reply_markup=admin_main_kb())
+    # рассылка идёт минутами — в фоне, чтобы не держать очередь апдейтов админа
+    await m.answer("📣 Рассылка запущена, пришлю итог.")
+    task = asyncio.create_task(_run_broadcast(m.bot, m.chat.id, text))
+    _BG.add(task)
+    task.add_done_callback(_BG.discard)
+
+
+async def _run_broadcast(bot: Bot, admin_chat: int, text: str) -> None:
+    # фоновая задача: неперехваченное исключение не увидел бы ни лог, ни админ
+    try:
+        ok, total = await broadcast_all(bot, text)
+        report = f"📣 Разослано: {ok}/{total}"
+    except Exception as e:
+        log.exception("broadcast failed")
+        report = f"⚠️ Рассылка прервана: {type(e).__name__}. Подробности в логе."
+    try:
+        await bot.send_message(admin_chat, report, reply_markup=admin_main_kb())
+    except Exception:
+        log.exception("broadcast: report to admin %s failed", admin_chat)
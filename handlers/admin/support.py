@@ -10,6 +10,7 @@ from app.keyboards.admin import admin_main_kb
 from app.services.admin import (
     require_admin, list_open_support_threads, close_support_thread
 )
+from app.services.outbound import send_text, P_FEEDBACK
 from app.states import AdminSupportReply
 
 router = Router(name="admin_support")
@@ -53,7 +54,7 @@ async def admin_support_reply_send(m: Message, state: FSMContext):
         return
     d = await state.get_data()
     uid = int(d.get("uid"))
-    await m.bot.send_message(uid, f"🛠 Ответ админа:\n{m.text}")
+    await send_text(m.bot, uid, f"🛠 Ответ админа:\n{m.text}", prio=P_FEEDBACK)
     await m.answer("✅ Ответ отправлен.", reply_markup=admin_main_kb())
     await state.clear()
 
@@ -70,9 +71,10 @@ async def sup_close(c: CallbackQuery):
     except Exception:
         pass
     try:
-        await c.message.bot.send_message(
-            uid,
-            "🔧 Админ закрыл обращение. Если проблема осталась — открой новый запрос через «🆘 Поддержка»."
+        await send_text(
+            c.message.bot, uid,
+            "🔧 Админ закрыл обращение. Если проблема осталась — открой новый запрос через «🆘 Поддержка».",
+            prio=P_FEEDBACK,
         )
     except Exception:
         pass
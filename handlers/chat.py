@@ -15,12 +15,10 @@ from app.services.matching import (
     active_peer, _materialize_session_if_needed, end_current_chat,
     record_separation, enqueue, try_match_now,
 )
-from app.services.inactivity import _stop_countdown as stop_countdown
-from app.runtime import (
-    DEADLINE, LAST_SHOWN, WARNED, COUNTDOWN_TASKS, COUNTDOWN_MSGS,
-    _now as now_wall, _nowm, g_inactivity,
-)
-from app.db.repo import get_role, get_user
+from app.services.inactivity import _stop_countdown as stop_countdown, bump_deadline
+from app.services.outbound import submit, submit_text, log_failure, P_RELAY
+from app.services.relay import relay_message, album_pending, flush_pending_album
+from app.db.repo import is_admin_id, get_user
 
 router = Router(name="chat")
 
@@ -54,8 +52,7 @@ async def has_required_prefs(uid: int) -> bool:
 
 
 async def _menu_for(user_id: int):
-    role = await get_role(user_id)
-    return admin_reply_menu() if (role == "admin" or user_id in cfg.ADMIN_IDS) else main_menu()
+    return admin_reply_menu() if is_admin_id(user_id) else main_menu()
 
 
 # --------- КНОПКА: «🔎 Найти собеседника» (вне чата) ---------
@@ -104,19 +101,20 @@ async def relay_chat(m: Message, state: FSMContext):
         return
     peer, mid = materialized
 
-    # Сброс таймера молчания и фиксация активности
-    DEADLINE[mid] = _nowm() + g_inactivity()
-    LAST_SHOWN.pop(mid, None)
+    # Следующие части альбома — только в буфер: таймер сбрасывается раз на альбом
+    if album_pending(m):
+        await relay_message(m, peer)
+        return
+
+    # Собранные альбомы отправителя — в очередь раньше этого сообщения
+    await flush_pending_album(m.from_user.id)
+
+    # Сброс таймера молчания и фиксация активности (O(1), планировщик не трогаем)
+    bump_deadline(mid)
 
-    now = now_wall()  # noqa: F841  # (восстановление LAST_SEEN делает _materialize_session_if_needed)
 
     # Останавливаем обратный отсчёт
     await stop_countdown(mid, m.from_user.id, peer, delete_msgs=True)
-    WARNED.pop(mid, None)
-    t = COUNTDOWN_TASKS.pop(mid, None)
-    if t and not t.done():
-        t.cancel()
-    COUNTDOWN_MSGS.pop(mid, None)
 
     # Внутричатовые команды
     if m.text:
@@ -124,6 +122,7 @@ async def relay_chat(m: Message, state: FSMContext):
         if ttxt == "!stop":
             a = m.from_user.id
             b = peer
+            await flush_pending_album(b)  # чат кончается — альбом собеседника не теряем
             await end_current_chat(a)
             from app.services.matching import _cleanup_match  # локальный импорт
             _cleanup_match(mid, a, b)
@@ -133,12 +132,13 @@ async def relay_chat(m: Message, state: FSMContext):
                 "Чат завершён. Нажми «🔎 Найти собеседника», чтобы начать новый.",
                 reply_markup=(await _menu_for(a))
             )
-            await m.bot.send_message(b, "Собеседник завершил чат.", reply_markup=(await _menu_for(b)))
+            await submit_text(m.bot, b, "Собеседник завершил чат.", prio=P_RELAY, reply_markup=(await _menu_for(b)))
             return
 
         if ttxt == "!next":
             a = m.from_user.id
             b = peer
+            await flush_pending_album(b)  # чат кончается — альбом собеседника не теряем
             if not await has_required_prefs(a):
                 await end_current_chat(a)
                 from app.services.matching import _cleanup_match
@@ -146,7 +146,7 @@ async def relay_chat(m: Message, state: FSMContext):
                 await send_post_chat_feedback(a, b, mid)
                 await send_post_chat_feedback(b, a, mid)
                 await m.answer("Чтобы продолжить поиск, укажи свой пол и кого ищешь.", reply_markup=gender_self_kb())
-                await m.bot.send_message(b, "Собеседник завершил чат.", reply_markup=(await _menu_for(b)))
+                await submit_text(m.bot, b, "Собеседник завершил чат.", prio=P_RELAY, reply_markup=(await _menu_for(b)))
                 return
             await record_separation(a, b)
             await end_current_chat(a)
@@ -155,10 +155,11 @@ async def relay_chat(m: Message, state: FSMContext):
             me = await get_user(a)
             await enqueue(a, me[1], me[2])
             await m.answer("Ищу следующего собеседника…", reply_markup=cancel_kb())
-            await m.bot.send_message(
-                b,
+            await submit_text(
+                m.bot, b,
                 "Собеседник ушёл к следующему. Ты можешь нажать «🔎 Найти собеседника».",
-                reply_markup=(await _menu_for(b))
+                prio=P_RELAY,
+                reply_markup=(await _menu_for(b)),
             )
             await try_match_now(a)
             return
@@ -167,8 +168,8 @@ async def relay_chat(m: Message, state: FSMContext):
             await _handle_reveal(m.from_user.id, peer)
             return
 
-    # Пересылка контента с маскировкой
-    await _relay_payload(m, peer)
+    # Пересылка контента с маскировкой (тип сверяется с RELAY_POLICY)
+    await relay_message(m, peer)
 
 
 # --------- Команды !stop/!next/!reveal, если RAM ещё не успел материализоваться ---------
@@ -176,8 +177,8 @@ async def relay_chat(m: Message, state: FSMContext):
 @router.message(F.text.regexp(r"^!(stop|next|reveal)\b"))
 async def bang_commands_when_db_active(m: Message, state: FSMContext):
     # Если RAM уже есть — relay_chat обработает
-    from app.runtime import ACTIVE
-    if m.from_user.id in ACTIVE:
+    from app.runtime import BY_USER
+    if m.from_user.id in BY_USER:
         return
 
     mat = await _materialize_session_if_needed(m.from_user.id)
@@ -186,11 +187,13 @@ async def bang_commands_when_db_active(m: Message, state: FSMContext):
         return
 
     peer, mid = mat
+    await flush_pending_album(m.from_user.id)
     txt = (m.text or "").strip().lower()
 
     if txt.startswith("!stop"):
         a = m.from_user.id
         b = peer
+        await flush_pending_album(b)  # чат кончается — альбом собеседника не теряем
         await end_current_chat(a)
         from app.services.matching import _cleanup_match
         _cleanup_match(mid, a, b)
@@ -200,12 +203,13 @@ async def bang_commands_when_db_active(m: Message, state: FSMContext):
             "Чат завершён. Нажми «🔎 Найти собеседника», чтобы начать новый.",
             reply_markup=(await _menu_for(m.from_user.id))
         )
-        await m.bot.send_message(b, "Собеседник завершил чат.", reply_markup=(await _menu_for(b)))
+        await submit_text(m.bot, b, "Собеседник завершил чат.", prio=P_RELAY, reply_markup=(await _menu_for(b)))
         return
 
     if txt.startswith("!next"):
         a = m.from_user.id
         b = peer
+        await flush_pending_album(b)  # чат кончается — альбом собеседника не теряем
         if not await has_required_prefs(a):
             await end_current_chat(a)
             from app.services.matching import _cleanup_match
@@ -213,7 +217,7 @@ async def bang_commands_when_db_active(m: Message, state: FSMContext):
             await send_post_chat_feedback(a, b, mid)
             await send_post_chat_feedback(b, a, mid)
             await m.answer("Чтобы продолжить поиск, укажи свой пол и кого ищешь.", reply_markup=gender_self_kb())
-            await m.bot.send_message(b, "Собеседник завершил чат.", reply_markup=(await _menu_for(b)))
+            await submit_text(m.bot, b, "Собеседник завершил чат.", prio=P_RELAY, reply_markup=(await _menu_for(b)))
             return
         await record_separation(a, b)
         await end_current_chat(a)
@@ -222,10 +226,11 @@ async def bang_commands_when_db_active(m: Message, state: FSMContext):
         me = await get_user(a)
         await enqueue(a, me[1], me[2])
         await m.answer("Ищу следующего собеседника…", reply_markup=cancel_kb())
-        await m.bot.send_message(
-            b,
+        await submit_text(
+            m.bot, b,
             "Собеседник ушёл к следующему. Ты можешь нажать «🔎 Найти собеседника».",
-            reply_markup=(await _menu_for(b))
+            prio=P_RELAY,
+            reply_markup=(await _menu_for(b)),
         )
         await try_match_now(a)
         return
@@ -237,73 +242,60 @@ async def bang_commands_when_db_active(m: Message, state: FSMContext):
 
 # --------- Вспомогательные для пересылки и reveal ---------
 
-async def _relay_payload(m: Message, peer: int):
-    from app.services.matching import send_text_anonym, clean_cap
-    if m.text:
-        await send_text_anonym(peer, m.text)
-    elif m.photo:
-        await m.bot.send_photo(peer, m.photo[-1].file_id, caption=clean_cap(m.caption), protect_content=True)
-    elif m.animation:
-        await m.bot.send_animation(peer, m.animation.file_id, caption=clean_cap(m.caption), protect_content=True)
-    elif m.video:
-        await m.bot.send_video(peer, m.video.file_id, caption=clean_cap(m.caption), protect_content=True)
-    elif m.audio:
-        await m.bot.send_audio(peer, m.audio.file_id, caption=clean_cap(m.caption), protect_content=True)
-    elif m.voice:
-        await m.bot.send_voice(peer, m.voice.file_id, caption=clean_cap(m.caption), protect_content=True)
-    elif m.video_note:
-        await m.bot.send_video_note(peer, m.video_note.file_id, protect_content=True)
-    elif m.document:
-        await m.bot.send_document(peer, m.document.file_id, caption=clean_cap(m.caption), protect_content=True)
-    elif m.contact or m.location or m.venue or m.poll or m.dice or m.game:
-        await m.answer("Этот тип вложений отключён в анонимном чате.")
-
-
 async def _handle_reveal(me_id: int, peer_id: int):
-    from app.db.core import db
+    from app.db.core import write_tx
     me = await get_user(me_id)
     peer = await get_user(peer_id)
     if not (me and peer and me[3] == 1 and peer[3] == 1):
         from aiogram import Bot
-        await Bot.get_current().send_message(me_id, "Раскрытие невозможно: у одного из вас не заполнена анкета.")
+        await submit_text(Bot.get_current(), me_id, "Раскрытие невозможно: у одного из вас не заполнена анкета.", prio=P_RELAY)
         return
 
-    async with db() as conn:
+    # чтение флагов и отметка запроса — одной транзакцией писателя
+    async def job(conn):
         cur = await conn.execute(
-            "SELECT id,a_id,b_id,a_reveal,b_reveal FROM matches "
-            "WHERE active=1 AND (a_id=? OR b_id=?) ORDER BY id DESC LIMIT 1",
-            (me_id, me_id)
+            "SELECT m.id,m.a_id,m.b_id,m.a_reveal,m.b_reveal "
+            "FROM active_sessions s JOIN matches m ON m.id=s.match_id "
+            "WHERE s.user_id=?",
+            (me_id,)
         )
         row = await cur.fetchone()
         if not row:
-            from aiogram import Bot
-            await Bot.get_current().send_message(me_id, "Нет активного чата.")
-            return
+            return None
         mid, a, b, ar, br = row
         is_a = (me_id == a)
 
         if (is_a and ar == 1) or ((not is_a) and br == 1):
-            from aiogram import Bot
-            await Bot.get_current().send_message(me_id, "Запрос на раскрытие уже отправлен. Ждём собеседника.")
-            return
+            return "already"
 
         if is_a:
             await conn.execute("UPDATE matches SET a_reveal=1 WHERE id=?", (mid,))
         else:
             await conn.execute("UPDATE matches SET b_reveal=1 WHERE id=?", (mid,))
-        await conn.commit()
 
         cur = await conn.execute("SELECT a_reveal,b_reveal FROM matches WHERE id=?", (mid,))
         ar, br = await cur.fetchone()
+        return a, b, ar, br
+
+    res = await write_tx(job)
+    if res is None:
+        from aiogram import Bot
+        await submit_text(Bot.get_current(), me_id, "Нет активного чата.", prio=P_RELAY)
+        return
+    if res == "already":
+        from aiogram import Bot
+        await submit_text(Bot.get_current(), me_id, "Запрос на раскрытие уже отправлен. Ждём собеседника.", prio=P_RELAY)
+        return
+    a, b, ar, br = res
 
     from aiogram import Bot
     if ar == 1 and br == 1:
         await _send_reveal_card(a, peer_id)
         await _send_reveal_card(b, me_id)
-        await Bot.get_current().send_message(a, "Взаимное раскрытие выполнено.")
-        await Bot.get_current().send_message(b, "Взаимное раскрытие выполнено.")
+        await submit_text(Bot.get_current(), a, "Взаимное раскрытие выполнено.", prio=P_RELAY)
+        await submit_text(Bot.get_current(), b, "Взаимное раскрытие выполнено.", prio=P_RELAY)
     else:
-        await Bot.get_current().send_message(me_id, "Запрос на раскрытие отправлен. Ждём согласия собеседника.")
+        await submit_text(Bot.get_current(), me_id, "Запрос на раскрытие отправлен. Ждём согласия собеседника.", prio=P_RELAY)
 
 
 async def _send_reveal_card(to_id: int, whose_id: int):
@@ -312,16 +304,21 @@ async def _send_reveal_card(to_id: int, whose_id: int):
     from app.db.repo import get_user
     u = await get_user(whose_id)
     if not u:
-        await Bot.get_current().send_message(to_id, "Профиль не найден.")
+        await submit_text(Bot.get_current(), to_id, "Профиль не найден.", prio=P_RELAY)
         return
 
     txt = format_profile_text(u)
     photos = [p for p in (u[10], u[11], u[12]) if p]
     if photos:
+        bot = Bot.get_current()
         for p in photos[:-1]:
-            await Bot.get_current().send_photo(to_id, p, protect_content=True)
-        await Bot.get_current().send_photo(to_id, photos[-1], caption=txt, protect_content=True, parse_mode=None)
+            fut = await submit(bot.send_photo, chat_id=to_id, photo=p, protect_content=True, prio=P_RELAY)
+            log_failure(fut, f"reveal photo to {to_id}")
+        fut = await submit(bot.send_photo, chat_id=to_id, photo=photos[-1], caption=txt,
+                           protect_content=True, parse_mode=None, prio=P_RELAY)
+        log_failure(fut, f"reveal card to {to_id}")
     else:
-        await Bot.get_current().send_message(
-            to_id, txt, parse_mode=None, disable_web_page_preview=True, protect_content=True
+        await submit_text(
+            Bot.get_current(), to_id, txt,
+            prio=P_RELAY, parse_mode=None, disable_web_page_preview=True, protect_content=True,
         )
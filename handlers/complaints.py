@@ -5,7 +5,8 @@ from aiogram import Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, Message
 
-from app.db.core import db
+from app.db.core import db, write
+from app.db.repo import add_rating
 from app.keyboards.common import (
     rate_or_complain_kb,
     post_chat_actions_kb,
@@ -44,12 +45,7 @@ async def cb_rate(c: CallbackQuery):
 
     # фиксируем оценку (один раз за матч)
     try:
-        async with db() as conn:
-            await conn.execute(
-                "INSERT OR IGNORE INTO ratings(match_id,from_user,to_user,stars) VALUES(?,?,?,?)",
-                (mid, c.from_user.id, to_user, stars)
-            )
-            await conn.commit()
+        await add_rating(mid, c.from_user.id, to_user, stars)
     except Exception:
         pass
 
@@ -130,12 +126,10 @@ async def complaint_text(m: Message, state: FSMContext):
     mid = int(d.get("mid")); about_id = int(d.get("about_id"))
     text = (m.text or "").strip()
 
-    async with db() as conn:
-        await conn.execute(
-            "INSERT INTO complaints(match_id,from_user,about_user,text) VALUES(?,?,?,?)",
-            (mid, m.from_user.id, about_id, text)
-        )
-        await conn.commit()
+    await write(
+        "INSERT INTO complaints(match_id,from_user,about_user,text) VALUES(?,?,?,?)",
+        (mid, m.from_user.id, about_id, text)
+    )
 
     # шлём админам
     for admin_id in (cfg.ADMIN_IDS or []):
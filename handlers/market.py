@@ -5,10 +5,10 @@ from aiogram import Router, F
 from aiogram.filters import Command
 from aiogram.types import Message, CallbackQuery
 
-from app.db.core import db
+from app.db.core import write
 from app.db.repo import (
     list_items, get_item, get_points, add_points,
-    add_status_to_inventory, set_status, get_role,
+    add_status_to_inventory, set_status, is_admin_id,
 )
 from app.keyboards.common import shop_kb
 
@@ -17,7 +17,7 @@ router = Router(name="market")
 
 @router.message(Command("market"))
 async def cmd_market(m: Message):
-    if await get_role(m.from_user.id) == "admin":
+    if is_admin_id(m.from_user.id):
         from app.handlers import menu_for  # ← локальный импорт, чтобы не ловить цикл
         return await m.answer(
             "Ты админ и не можешь покупать. Используй /admin.",
@@ -32,7 +32,7 @@ async def cmd_market(m: Message):
 
 @router.callback_query(F.data.startswith("shop_buy:"))
 async def shop_buy(c: CallbackQuery):
-    if await get_role(c.from_user.id) == "admin":
+    if is_admin_id(c.from_user.id):
         await c.answer("Админ не может покупать товары.", show_alert=True)
         return
 
@@ -57,9 +57,7 @@ async def shop_buy(c: CallbackQuery):
     elif type_ == "privilege":
         applied_msg = f"Привилегия активирована: {payload}"
 
-    async with db() as conn:
-        await conn.execute("INSERT INTO purchases(user_id,item_id) VALUES(?,?)", (c.from_user.id, _id))
-        await conn.commit()
+    await write("INSERT INTO purchases(user_id,item_id) VALUES(?,?)", (c.from_user.id, _id))
 
     new_pts = await get_points(c.from_user.id)
     try:
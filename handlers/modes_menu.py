@@ -5,8 +5,7 @@ from aiogram import Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message
 
-from app import config as cfg
-from app.db.repo import get_role
+from app.db.repo import is_admin_id
 from app.keyboards.common import modes_kb, anon_chat_menu_kb
 from app.keyboards.admin import admin_reply_menu  # ⬅️
 from app.services.subscription_gate import gate_subscription
@@ -16,7 +15,7 @@ router = Router(name="modes_menu")
 
 @router.message(F.text.in_({"🧭 Режимы", "Режимы"}))
 async def modes_entry(m: Message, state: FSMContext):
-    if (await get_role(m.from_user.id) == "admin") or m.from_user.id in cfg.ADMIN_IDS:
+    if is_admin_id(m.from_user.id):
         await m.answer("Этот раздел недоступен админу. Открой панель: /admin", reply_markup=admin_reply_menu())
         return
     if not await gate_subscription(m):
@@ -37,7 +36,7 @@ async def mode_cards(m: Message):
 
 @router.message(F.text.in_({"🕵️ Анонимный чат", "Анонимный чат"}))
 async def mode_anon_chat(m: Message):
-    if (await get_role(m.from_user.id) == "admin") or m.from_user.id in cfg.ADMIN_IDS:
+    if is_admin_id(m.from_user.id):
         await m.answer("Этот раздел недоступен админу. Открой панель: /admin", reply_markup=admin_reply_menu())
         return
     if not await gate_subscription(m):
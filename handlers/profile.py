@@ -6,7 +6,6 @@ from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message
 
-from app import config as cfg
 from app.db.repo import (
     ensure_user, get_user, get_user_or_create, get_points,
     get_status, get_status_inventory, count_referrals, purchases_summary,
@@ -30,9 +29,8 @@ router = Router(name="profile")
 @router.message(F.text.in_({"👤 Анкета", "Анкета"}))
 async def show_or_edit_reveal(m: Message, state: FSMContext):
     # Админам профиль (анкеты) не доступен — только панель
-    from app.db.repo import get_role
-    role = await get_role(m.from_user.id)
-    if role == "admin" or m.from_user.id in cfg.ADMIN_IDS:
+    from app.db.repo import is_admin_id
+    if is_admin_id(m.from_user.id):
         await m.answer("Раздел «Анкета» недоступен для администраторов. Открой /admin.", reply_markup=admin_reply_menu())
         return
 
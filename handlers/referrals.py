@@ -5,7 +5,7 @@ from aiogram import Router
 from aiogram.filters import Command
 from aiogram.types import Message
 
-from app.db.repo import count_referrals, ensure_user, get_role
+from app.db.repo import count_referrals, ensure_user, is_admin_id
 from app.runtime import g_ref_bonus, g_daily_bonus
 from app.handlers import menu_for
 
@@ -14,7 +14,7 @@ router = Router(name="referrals")
 
 @router.message(Command("ref"))
 async def cmd_ref(m: Message):
-    if await get_role(m.from_user.id) == "admin":
+    if is_admin_id(m.from_user.id):
         await m.answer("Админам рефералка не нужна. Используй /admin для панели.", reply_markup=(await menu_for(m.from_user.id)))
         return
 
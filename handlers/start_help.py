@@ -11,11 +11,11 @@ from aiogram.types import Message, CallbackQuery
 from app import config as cfg
 from app.db.repo import (
     ensure_user, get_user, add_points, register_referral,
-    inviter_by_code, set_user_fields,
+    inviter_by_code,
 )
 from app.keyboards.common import main_menu, gender_self_kb, subscription_kb
 from app.runtime import intro_text
-from app.services.subscription_gate import gate_subscription, is_subscribed
+from app.services.subscription_gate import gate_subscription, check_membership, mark_verified
 from app.states import GState
 
 router = Router(name="start_help")
@@ -89,15 +89,20 @@ async def cmd_help(m: Message):
 @router.callback_query(F.data == "sub_check")
 async def sub_check(c: CallbackQuery):
     await ensure_user(c.from_user.id)
-    await set_user_fields(c.from_user.id, sub_verified=1)
 
-    ok = False
+    # None — проверить не удалось (бот не админ канала и т.п.): доверяем, как раньше
+    ok: Optional[bool] = None
     try:
-        from app.services.subscription_gate import is_subscribed
-        ok = await is_subscribed(c.message.bot, c.from_user.id)  # ⬅️ передаём bot
+        ok = await check_membership(c.message.bot, c.from_user.id, force=True)
     except Exception:
         pass
 
+    if ok is False:
+        await c.answer("Подписка не найдена. Подпишись на канал и попробуй ещё раз.", show_alert=True)
+        return
+
+    await mark_verified(c.from_user.id)
+
     try:
         await c.message.edit_text("✅ Спасибо за подписку!" if ok else "✅ Готово.")
     except Exception:
@@ -6,7 +6,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import Message
 
 from app import config as cfg
-from app.db.core import db
+from app.db.core import write
 from app.keyboards.common import cancel_kb
 from app.keyboards.admin import admin_reply_menu  # ⬅️
 from app.states import SupportState
@@ -17,9 +17,8 @@ router = Router(name="support")
 
 @router.message(F.text.in_({"🆘 Поддержка", "Поддержка"}))
 async def support_entry(m: Message, state: FSMContext):
-    from app.db.repo import get_role
-    role = await get_role(m.from_user.id)
-    if role == "admin" or m.from_user.id in cfg.ADMIN_IDS:
+    from app.db.repo import is_admin_id
+    if is_admin_id(m.from_user.id):
         await m.answer("Для админов есть «🧰 Поддержка» внутри /admin.", reply_markup=admin_reply_menu())
         return
     await state.clear()
@@ -35,13 +34,10 @@ async def support_entry(m: Message, state: FSMContext):
 async def support_collect(m: Message, state: FSMContext):
     from app.runtime import SUPPORT_RELAY
     # сохраняем в БД
-    async with db() as conn:
-        cur = await conn.execute(
-            "INSERT INTO support_msgs(from_user, text) VALUES(?,?)",
-            (m.from_user.id, m.text or "")
-        )
-        _row_id = cur.lastrowid
-        await conn.commit()
+    _row_id = await write(
+        "INSERT INTO support_msgs(from_user, text) VALUES(?,?)",
+        (m.from_user.id, m.text or "")
+    )
 
     # пересылаем админам
     for admin_id in (cfg.ADMIN_IDS or []):
@@ -56,10 +52,8 @@ async def support_collect(m: Message, state: FSMContext):
 
 @router.message(F.text == "/done")
 async def support_done(m: Message):
-    async with db() as conn:
-        await conn.execute(
-            "UPDATE support_msgs SET status='closed' WHERE from_user=? AND status='open'",
-            (m.from_user.id,)
-        )
-        await conn.commit()
+    await write(
+        "UPDATE support_msgs SET status='closed' WHERE from_user=? AND status='open'",
+        (m.from_user.id,)
+    )
     await m.answer("✅ Обращение закрыто. Если что — пиши снова: «🆘 Поддержка».")
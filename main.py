@@ -11,16 +11,25 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 
 from app import config as cfg
-from app.db.core import db, init_db
+from app.db.core import write_tx, init_db, close_db
+from app.db.repo import load_role_index
 from app.runtime import load_settings_cache
+from app.services.matching import (
+    init_matching, load_match_index, start_batch_matcher, stop_batch_matcher,
+    load_blocks, start_blocks_flusher, stop_blocks_flusher, restore_sessions,
+)
+from app.services.inactivity import init_inactivity, stop_inactivity_scheduler, flush_activity
+from app.services.outbound import stop_outbound
+from app.services.subscription_gate import load_verified, start_recheck_worker, stop_recheck_worker
 from app.middlewares.subscription import SubscriptionGuard
+from app.middlewares.ordering import OrderedUpdates
 
 # Роутеры обработчиков
-from app.handlers import router as user_router
+from app.handlers import router as user_router, menu_for
 from app.handlers.admin import router as admin_router
 
 # Сервисы, которым нужен bot при старте
-from app.services.feedback import init_feedback
+from app.services.feedback import init_feedback, send_post_chat_feedback
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
 log = logging.getLogger("mephi")
@@ -28,13 +37,16 @@ log = logging.getLogger("mephi")
 async def _fix_stale_chats() -> None:
     """
     Мягко деактивируем слишком старые активные матчи (например, старше суток).
+    Отбор — диапазоном по active_sessions.started_at.
     """
-    async with db() as conn:
+    async def job(conn):
+        cutoff = "strftime('%s','now') - 86400"
         await conn.execute(
-            "UPDATE matches SET active=0 "
-            "WHERE active=1 AND started_at < strftime('%s','now') - 86400"
+            "UPDATE matches SET active=0 WHERE id IN "
+            f"(SELECT match_id FROM active_sessions WHERE started_at < {cutoff})"
         )
-        await conn.commit()
+        await conn.execute(f"DELETE FROM active_sessions WHERE started_at < {cutoff}")
+    await write_tx(job)
 
 
 async def main() -> None:
@@ -45,7 +57,11 @@ async def main() -> None:
     # 2) Инициализации/миграции/кеши
     await init_db()
     await load_settings_cache()
+    await load_role_index()
+    await load_verified()
     await _fix_stale_chats()
+    await load_match_index()
+    await load_blocks()
 
     # 3) Логируем путь к БД и снимаем read-only, если вдруг стоит
     log.info("DB path: %s", cfg.DB_PATH)
@@ -55,7 +71,8 @@ async def main() -> None:
     except Exception:
         pass
 
-    # 5) Подключаем мидлварь «подписка на канал»
+    # 5) Подключаем мидлвари: порядок апдейтов (матч/пользователь) и «подписка на канал»
+    dp.update.outer_middleware(OrderedUpdates())
     dp.message.middleware(SubscriptionGuard())
     dp.callback_query.middleware(SubscriptionGuard())
 
@@ -65,9 +82,24 @@ async def main() -> None:
 
     # 7) Инициализируем сервисы, которым нужен bot
     init_feedback(bot)
+    init_matching(bot, send_post_chat_feedback, menu_for)
+    init_inactivity(bot, menu_for, send_post_chat_feedback)
+    log.info("Restored live chats: %d", await restore_sessions())
+    start_blocks_flusher()
+    start_batch_matcher()
+    start_recheck_worker(bot)
 
     log.info("Bot started. Polling…")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        stop_batch_matcher()
+        stop_inactivity_scheduler()
+        stop_recheck_worker()
+        await stop_blocks_flusher()
+        await flush_activity()
+        await stop_outbound()
+        await close_db()
 
 
 if __name__ == "__main__":
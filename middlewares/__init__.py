@@ -4,8 +4,10 @@ Public API for app.middlewares.
 
 Exports:
 - SubscriptionGuard — middleware that blocks updates until channel subscription is verified.
+- OrderedUpdates — outer update middleware that serializes updates per match/user.
 """
 
 from .subscription import SubscriptionGuard
+from .ordering import OrderedUpdates
 
-__all__ = ["SubscriptionGuard"]
+__all__ = ["SubscriptionGuard", "OrderedUpdates"]
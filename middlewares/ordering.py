@@ -0,0 +1,70 @@
+# app/middlewares/ordering.py
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+from app.runtime import session_of
+
+
+class KeyedLocks:
+    """
+    Замки по ключу с подсчётом ссылок: замок живёт, пока его кто-то держит
+    или ждёт, и удаляется с последним уходящим — память ограничена числом
+    ключей «в работе», а не всех когда-либо встреченных.
+    asyncio.Lock пропускает ожидающих в порядке прихода (FIFO).
+    """
+    def __init__(self) -> None:
+        self._locks: Dict[Hashable, List[Any]] = {}  # key -> [Lock, refs]
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+class OrderedUpdates(BaseMiddleware):
+    """
+    Последовательная обработка апдейтов одного ключа при параллельности между ключами.
+    Ключ — матч, если у пользователя живой чат (сообщения обоих собеседников
+    идут строго по очереди: релей, !stop/!next, отсчёт), иначе — сам пользователь.
+    Релей держит замок только до постановки в исходящую очередь (submit), а не
+    до доставки: порядок дальше хранит FIFO чата получателя.
+    Апдейты без пользователя не сериализуются.
+    Регистрируется как outer-middleware на dp.update (после UserContextMiddleware).
+    """
+    def __init__(self) -> None:
+        self.locks = KeyedLocks()
+
+    @staticmethod
+    def key_for(user_id: int) -> Tuple[str, int]:
+        s = session_of(user_id)
+        return ("match", s.mid) if s is not None else ("user", user_id)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user: User | None = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        async with self.locks.hold(self.key_for(user.id)):
+            return await handler(event, data)
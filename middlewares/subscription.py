@@ -7,10 +7,9 @@ from aiogram import BaseMiddleware
 from aiogram.types import Message, CallbackQuery
 from aiogram import Bot
 
-from app.config import ADMIN_IDS
-from app.db.core import db
-from app.db.repo import get_role
+from app.db.repo import is_admin_id
 from app.keyboards.common import subscription_kb
+from app.services.subscription_gate import is_verified
 
 
 class SubscriptionGuard(BaseMiddleware):
@@ -37,7 +36,7 @@ class SubscriptionGuard(BaseMiddleware):
         user_id = user.id
 
         # 1) Админам — всегда можно
-        if user_id in ADMIN_IDS or (await get_role(user_id)) == "admin":
+        if is_admin_id(user_id):
             return await handler(event, data)
 
         # 2) Разрешаем /start, чтобы показать экран с подпиской
@@ -52,16 +51,8 @@ class SubscriptionGuard(BaseMiddleware):
         ):
             return await handler(event, data)
 
-        # 4) Проверяем одноразовую «верификацию» по флагу sub_verified
-        async with db() as conn:
-            cur = await conn.execute(
-                "SELECT COALESCE(sub_verified,0) FROM users WHERE tg_id=?",
-                (user_id,),
-            )
-            row = await cur.fetchone()
-        sub_verified = bool(row and row[0])
-
-        if sub_verified:
+        # 4) Проверяем одноразовую «верификацию» по флагу sub_verified (множество в RAM)
+        if is_verified(user_id):
             return await handler(event, data)
 
         # 5) Блокируем: показываем клавиатуру подписки и выходим
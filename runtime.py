@@ -1,14 +1,13 @@
 # app/runtime.py
 from __future__ import annotations
 
-import asyncio
 import time
-from typing import Dict, Tuple, Optional
+from typing import Dict, Set, Tuple, Optional
 
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import Message
 
-from app.db.core import db
+from app.db.core import db, write, write_many
 
 # ===================== Settings cache =====================
 
@@ -31,24 +30,16 @@ async def load_settings_cache() -> None:
             SETTINGS[k] = str(v)
 
     # проставим дефолты, если чего-то нет
-    async with db() as conn:
-        for k, v in DEFAULT_SETTINGS.items():
-            if k not in SETTINGS:
-                await conn.execute(
-                    "INSERT OR REPLACE INTO settings(key,value) VALUES(?,?)",
-                    (k, v),
-                )
-                SETTINGS[k] = v
-        await conn.commit()
+    missing = [(k, v) for k, v in DEFAULT_SETTINGS.items() if k not in SETTINGS]
+    await write_many("INSERT OR REPLACE INTO settings(key,value) VALUES(?,?)", missing)
+    SETTINGS.update(missing)
 
 async def set_setting(key: str, value: str) -> None:
     """Обновляет значение настройки в БД и в кэше."""
-    async with db() as conn:
-        await conn.execute(
-            "INSERT OR REPLACE INTO settings(key,value) VALUES(?,?)",
-            (key, str(value)),
-        )
-        await conn.commit()
+    await write(
+        "INSERT OR REPLACE INTO settings(key,value) VALUES(?,?)",
+        (key, str(value)),
+    )
     SETTINGS[key] = str(value)
 
 def g_inactivity() -> int:
@@ -115,19 +106,82 @@ _nowm = time.monotonic            # монотоничные секунды (д
 def _now() -> float:             # «стенные» секунды (для LAST_SEEN)
     return time.time()
 
-# Матчевые таймеры/счётчики
-DEADLINE: Dict[int, float] = {}   # match_id -> monotonic deadline
-LAST_SHOWN: Dict[int, int] = {}   # match_id -> последний показанный остаток (сек)
-
-# Активные чаты и активность
-ACTIVE: Dict[int, Tuple[int, int]] = {}   # user_id -> (peer_id, match_id)
-LAST_SEEN: Dict[int, float] = {}          # user_id -> last_seen_unix
+class ChatSession:
+    """
+    Живой чат в RAM: всё состояние матча в одном компактном объекте.
+    Индексы — SESSIONS (по match_id) и BY_USER (по каждому участнику);
+    close() снимает сессию отовсюду, и ссылки на неё у планировщика/очередей
+    становятся устаревшими сами собой.
+    """
+    __slots__ = (
+        "mid", "a", "b",
+        "deadline",        # monotonic-дедлайн молчания
+        "last_seen",       # «стенные» секунды последней активности
+        "last_shown",      # последний показанный остаток отсчёта (сек)
+        "warned",          # показано предупреждение о завершении
+        "countdown_msgs",  # (msg_id у a, msg_id у b) сообщений отсчёта
+        "due",             # взведённый срок в планировщике неактивности
+    )
 
-# Вотчеры/обратные отсчёты (таски создаются в сервисе неактивности)
-WATCH: Dict[int, asyncio.Task] = {}              # match_id -> watcher task
-WARNED: Dict[int, bool] = {}                     # match_id -> предупреждение о завершении
-COUNTDOWN_TASKS: Dict[int, asyncio.Task] = {}    # match_id -> countdown task
-COUNTDOWN_MSGS: Dict[int, Tuple[Optional[int], Optional[int]]] = {}  # match_id -> (msg_id_a, msg_id_b)
+    def __init__(self, mid: int, a: int, b: int, deadline: float, last_seen: float):
+        self.mid = mid
+        self.a = a
+        self.b = b
+        self.deadline = deadline
+        self.last_seen = last_seen
+        self.last_shown: Optional[int] = None
+        self.warned = False
+        self.countdown_msgs: Optional[Tuple[Optional[int], Optional[int]]] = None
+        self.due: Optional[float] = None
+
+    def peer(self, user_id: int) -> int:
+        return self.b if user_id == self.a else self.a
+
+    @property
+    def active(self) -> bool:
+        return SESSIONS.get(self.mid) is self
+
+    def close(self) -> None:
+        """Снять сессию со всех индексов и сбросить таймеры."""
+        if SESSIONS.get(self.mid) is self:
+            del SESSIONS[self.mid]
+        for u in (self.a, self.b):
+            if BY_USER.get(u) is self:
+                del BY_USER[u]
+        self.due = None
+        self.warned = False
+        self.countdown_msgs = None
+
+    def __repr__(self) -> str:
+        return f"ChatSession(mid={self.mid}, a={self.a}, b={self.b})"
+
+
+SESSIONS: Dict[int, ChatSession] = {}   # match_id -> сессия
+BY_USER: Dict[int, ChatSession] = {}    # user_id -> сессия
+
+
+def open_chat_session(mid: int, a: int, b: int, deadline: float) -> ChatSession:
+    """Создать сессию матча; прежние сессии участников (если остались) закрываются."""
+    for u in (a, b):
+        old = BY_USER.get(u)
+        if old is not None and old.mid != mid:
+            old.close()
+    s = SESSIONS.get(mid)
+    if s is None:
+        s = ChatSession(mid, a, b, deadline, _now())
+        SESSIONS[mid] = s
+    BY_USER[a] = s
+    BY_USER[b] = s
+    return s
+
+
+def session_of(user_id: int) -> Optional[ChatSession]:
+    return BY_USER.get(user_id)
+
+# Антиповтор: user_id -> {partner_id: сколько раундов ещё не матчить}.
+# Источник истины в RAM; в recent_partners пишется отложенно (BLOCKS_DIRTY).
+BLOCKS: Dict[int, Dict[int, int]] = {}
+BLOCKS_DIRTY: Set[int] = set()
 
 # Маршрутизация ответов админа в саппорте (msg_id бота -> user_id)
 SUPPORT_RELAY: Dict[int, int] = {}
@@ -140,6 +194,7 @@ __all__ = [
     # runtime clocks
     "_nowm", "_now",
     # RAM structures
-    "DEADLINE", "LAST_SHOWN", "ACTIVE", "LAST_SEEN", "WATCH", "WARNED",
-    "COUNTDOWN_TASKS", "COUNTDOWN_MSGS", "SUPPORT_RELAY",
+    "ChatSession", "SESSIONS", "BY_USER", "open_chat_session", "session_of",
+    "SUPPORT_RELAY",
+    "BLOCKS", "BLOCKS_DIRTY",
 ]
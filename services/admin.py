@@ -7,21 +7,22 @@ from typing import Iterable, Optional
 from aiogram import Bot
 from aiogram.types import Message, CallbackQuery
 
-from app import config as cfg
-from app.db.core import db
-from app.db.repo import get_role, add_points, get_points, ensure_user
+from app.db.core import db, write
+from app.db.repo import is_admin_id, admin_ids, add_points, get_points, ensure_user, user_cache_stats
+from app.services.matching import match_start_stats
+from app.services.inactivity import bump_deadline
+from app.services.outbound import send_text, P_FEEDBACK, P_BROADCAST
+from app.services.relay import relay_stats
 from app.runtime import (
     safe_edit_message, g_inactivity, g_block_rounds, g_daily_bonus, g_ref_bonus,
-    g_support_enabled, _nowm, DEADLINE
+    g_support_enabled, SESSIONS
 )
 
 
 # ====== Проверка прав администратора ======
 
 async def is_admin(user_id: int) -> bool:
-    if user_id in cfg.ADMIN_IDS:
-        return True
-    return (await get_role(user_id)) == "admin"
+    return is_admin_id(user_id)
 
 
 async def require_admin(event: Message | CallbackQuery) -> bool:
@@ -58,9 +59,10 @@ async def grant_points_and_notify(bot: Bot, to_user_id: int, amount: int, reason
     new_pts = await get_points(to_user_id)
     note = f"\nПричина: {reason}" if reason else ""
     try:
-        await bot.send_message(
-            to_user_id,
-            f"💳 Тебе {'начислено' if amount >= 0 else 'списано'} {abs(amount)} очков.{note}\nБаланс: {new_pts}."
+        await send_text(
+            bot, to_user_id,
+            f"💳 Тебе {'начислено' if amount >= 0 else 'списано'} {abs(amount)} очков.{note}\nБаланс: {new_pts}.",
+            prio=P_FEEDBACK,
         )
     except Exception:
         pass
@@ -77,9 +79,8 @@ async def set_numeric_setting(key: str, value: int) -> None:
     from app.runtime import set_setting  # локальный импорт, чтобы избежать циклов
     await set_setting(key, str(value))
     if key == "inactivity_seconds":
-        now = _nowm()
-        for mid in list(DEADLINE.keys()):
-            DEADLINE[mid] = now + g_inactivity()
+        for mid in list(SESSIONS):
+            bump_deadline(mid)
 
 
 # ====== Статистика ======
@@ -102,6 +103,9 @@ async def fetch_stats() -> dict[str, int]:
 
 
 def render_stats_text(agg: dict[str, int]) -> str:
+    uc = user_cache_stats()
+    ms = match_start_stats()
+    rs = relay_stats()
     return (
         "<b>📊 Статистика</b>\n\n"
         f"👤 Пользователей: <b>{agg['users']}</b>\n"
@@ -112,7 +116,12 @@ def render_stats_text(agg: dict[str, int]) -> str:
         f"🎯 Рефералов всего: <b>{agg['referrals']}</b>\n"
         f"\n⚙️ Неактивность: {g_inactivity()} c | Блок-раундов: {g_block_rounds()}\n"
         f"🎁 Daily: {g_daily_bonus()} | 🎯 Referral: {g_ref_bonus()}\n"
-        f"🆘 Support: {'ON' if g_support_enabled() else 'OFF'}"
+        f"🆘 Support: {'ON' if g_support_enabled() else 'OFF'}\n"
+        f"🗄 Кэш анкет: {uc['size']} | hit {uc['hits']} / miss {uc['misses']}\n"
+        f"⚡ Старт матча: n={ms['n']} | p50 {ms['p50_ms']:.0f} мс | "
+        f"p95 {ms['p95_ms']:.0f} мс | max {ms['max_ms']:.0f} мс\n"
+        f"🔁 Релей: n={rs['n']} | p50 {rs['p50_ms']:.0f} мс | "
+        f"p95 {rs['p95_ms']:.0f} мс | отклонено {rs['rejected']}"
     )
 
 
@@ -135,48 +144,51 @@ async def list_open_support_threads(limit: int = 10) -> list[tuple[int, int]]:
 
 
 async def append_support_message(from_user: int, text: str) -> None:
-    async with db() as conn:
-        await conn.execute(
-            "INSERT INTO support_msgs(from_user, text) VALUES(?,?)",
-            (from_user, text)
-        )
-        await conn.commit()
+    await write(
+        "INSERT INTO support_msgs(from_user, text) VALUES(?,?)",
+        (from_user, text)
+    )
 
 
 async def close_support_thread(user_id: int) -> None:
-    async with db() as conn:
-        await conn.execute(
-            "UPDATE support_msgs SET status='closed' WHERE from_user=?",
-            (user_id,)
-        )
-        await conn.commit()
+    await write(
+        "UPDATE support_msgs SET status='closed' WHERE from_user=?",
+        (user_id,)
+    )
 
 
 # ====== Рассылка ======
 
-async def broadcast_all(bot: Bot, text: str, throttle: float = 0.05) -> tuple[int, int]:
+_BROADCAST_WORKERS = 100
+
+
+async def broadcast_all(bot: Bot, text: str) -> tuple[int, int]:
     """
     Шлёт текст всем пользователям. Возвращает (успешно, всего).
+    Темп задаёт исходящая очередь: рассылка идёт низшим классом
+    и не тормозит релей/приветствия.
     """
     async with db() as conn:
         cur = await conn.execute("SELECT tg_id FROM users")
         uids = [int(x[0]) for x in await cur.fetchall()]
 
     ok = 0
-    for uid in uids:
-        try:
-            await bot.send_message(uid, text)
-            ok += 1
-        except Exception:
-            pass
-        await asyncio.sleep(throttle)
-
+    pending = iter(uids)
+
+    async def worker() -> None:
+        nonlocal ok
+        for uid in pending:
+            try:
+                await send_text(bot, uid, text, prio=P_BROADCAST)
+                ok += 1
+            except Exception:
+                pass
+
+    await asyncio.gather(*(worker() for _ in range(min(_BROADCAST_WORKERS, len(uids)))))
     return ok, len(uids)
 
 
 # ====== Админы-учёт ======
 
 async def list_admin_ids() -> list[int]:
-    async with db() as conn:
-        cur = await conn.execute("SELECT tg_id FROM users WHERE role='admin' ORDER BY tg_id ASC")
-        return [int(x[0]) for x in await cur.fetchall()]
+    return admin_ids()
@@ -12,6 +12,7 @@ from app.keyboards.common import (
     post_chat_actions_kb,
     rate_stars_kb,
 )
+from app.services.outbound import submit_text, P_FEEDBACK
 
 # ====== Контекст: аккуратно пробрасываем Bot ======
 _CTX: Dict[str, Optional[Bot]] = {"bot": None}
@@ -45,15 +46,14 @@ async def send_post_chat_feedback(user_id: int, peer_id: int, mid: int) -> None:
     :param peer_id: id собеседника (сейчас не используется, оставлен для совместимости сигнатуры)
     :param mid: id матча (вшивается в callback_data)
     """
-    try:
-        await _bot().send_message(
-            user_id,
-            "Как тебе собеседник? Выбери оценку (1–5), можешь пожаловаться или пропустить:",
-            reply_markup=post_chat_rate_kb(mid),
-        )
-    except Exception:
-        # не валим поток, если пользователь закрыл ЛС/заблокировал бота и т.п.
-        pass
+    # только в очередь: вызывающий (часто под замком матча) не ждёт доставки,
+    # закрытые ЛС/блокировка бота уходят в лог
+    await submit_text(
+        _bot(), user_id,
+        "Как тебе собеседник? Выбери оценку (1–5), можешь пожаловаться или пропустить:",
+        reply_markup=post_chat_rate_kb(mid),
+        prio=P_FEEDBACK,
+    )
 
 
 # Что отдаём наружу
@@ -2,18 +2,21 @@
 from __future__ import annotations
 
 import asyncio
+import heapq
+import logging
+from collections import OrderedDict
+from functools import partial
 from math import ceil
-from typing import Awaitable, Callable, Dict, Optional, Tuple
+from typing import Awaitable, Callable, Dict, Iterable, List, Set, Tuple
 
 from aiogram import Bot
 
-from app.runtime import (
-    ACTIVE, LAST_SEEN,
-    DEADLINE, LAST_SHOWN, WATCH, WARNED,
-    COUNTDOWN_TASKS, COUNTDOWN_MSGS,
-    _nowm, _now, g_inactivity,
-)
-from app.services.matching import end_current_chat
+from app.config import ACTIVITY_FLUSH_SECONDS, COUNTDOWN_EDIT_RPS
+from app.db.core import write_many
+from app.runtime import ChatSession, SESSIONS, _nowm, _now, g_inactivity
+from app.services.outbound import submit, send_text, P_GREETING
+
+log = logging.getLogger(__name__)
 
 
 # ====== Контекст (Bot и коллбеки верхнего уровня) ======
@@ -21,7 +24,10 @@ from app.services.matching import end_current_chat
 _MenuFor = Callable[[int], Awaitable]                       # async def menu_for(user_id) -> ReplyKeyboardMarkup
 _SendFeedback = Callable[[int, int, int], Awaitable[None]]  # async def send_post_chat_feedback(me, peer, mid) -> None
 
-_CTX: Dict[str, object] = {"bot": None, "menu_for": None, "send_fb": None}
+_CTX: Dict[str, object] = {
+    "bot": None, "menu_for": None, "send_fb": None,
+    "task": None, "editor": None, "activity": None,
+}
 
 def init_inactivity(bot: Bot,
                     menu_for: _MenuFor,
@@ -50,151 +56,348 @@ def _send_fb() -> _SendFeedback:
     return f  # type: ignore[return-value]
 
 
-# ====== Публичные утилиты для RAM-таймера ======
+# ====== Планировщик дедлайнов (одна задача на все матчи) ======
+#
+# Куча (due, mid); актуальный срок хранится в ChatSession.due. Запись в куче,
+# у которой due не совпадает с сессией (или сессии уже нет), устарела и
+# пропускается. Продление дедлайна в relay ничего не трогает в куче:
+# сработавшая раньше запись пересчитает срок по текущему deadline и
+# перевзведётся (ленивое перевзведение, продление — O(1)).
+
+WARN_SECONDS = 60  # за сколько секунд до конца показываем обратный отсчёт
+# После предупреждения отсчёт обновляется только на этих отметках (сек)
+COUNTDOWN_STEPS = (30, 10, 5)
+
+_HEAP: List[Tuple[float, int]] = []
+_WAKE = asyncio.Event()
+_BG: Set[asyncio.Task] = set()
+
+
+def _spawn(coro) -> None:
+    """Фоновая задача со ссылкой в _BG (не соберёт GC); её сбой — в лог."""
+    t = asyncio.create_task(coro)
+    _BG.add(t)
+    t.add_done_callback(_reap)
+
+
+def _reap(t: asyncio.Task) -> None:
+    _BG.discard(t)
+    if not t.cancelled() and t.exception() is not None:
+        name = getattr(t.get_coro(), "__qualname__", t.get_name())
+        log.error("inactivity: background task %s failed", name, exc_info=t.exception())
+
+
+def _arm(s: ChatSession, due: float) -> None:
+    s.due = due
+    heapq.heappush(_HEAP, (due, s.mid))
+    if _HEAP[0][1] == s.mid:
+        _WAKE.set()
+
 
-async def _watch_inactivity(mid: int, a: int, b: int):
+def _ensure_running() -> None:
+    task = _CTX["task"]
+    if task is None or task.done():  # type: ignore[union-attr]
+        _CTX["task"] = asyncio.create_task(_run_scheduler())
+    editor = _CTX["editor"]
+    if editor is None or editor.done():  # type: ignore[union-attr]
+        _CTX["editor"] = asyncio.create_task(_run_editor())
+    flusher = _CTX["activity"]
+    if flusher is None or flusher.done():  # type: ignore[union-attr]
+        _CTX["activity"] = asyncio.create_task(_run_activity_flusher())
+
+
+def _next_step(remaining: int) -> int:
+    """Следующая отметка отсчёта ниже remaining (0 — сам дедлайн)."""
+    return max((s for s in COUNTDOWN_STEPS if s < remaining), default=0)
+
+
+def schedule_match(s: ChatSession) -> None:
+    """Поставить сессию под контроль молчания (идемпотентно)."""
+    _ensure_running()
+    if s.due is None:
+        _arm(s, s.deadline - WARN_SECONDS)
+
+
+def schedule_many(sessions: Iterable[ChatSession]) -> None:
+    """Поставить пачку сессий (восстановление на старте): одна перестройка кучи."""
+    _ensure_running()
+    added = False
+    for s in sessions:
+        if s.due is None:
+            s.due = s.deadline - WARN_SECONDS
+            _HEAP.append((s.due, s.mid))
+            added = True
+    if added:
+        heapq.heapify(_HEAP)
+        _WAKE.set()
+
+
+def bump_deadline(mid: int) -> None:
     """
-    Каждую секунду проверяет дедлайн молчания.
-    За 60 сек до автозакрытия — показывает обратный отсчёт.
-    На нуле — завершает матч и шлёт фидбек-форму.
+    Продлить дедлайн молчания (сообщение в чате). Обычно срок только отодвигается,
+    и куча не трогается; если дедлайн стал раньше взведённого — взводим заново.
     """
-    bot = _bot()
-    menu_for = _menu_for()
-    send_fb = _send_fb()
+    s = SESSIONS.get(mid)
+    if s is None:
+        return
+    now = _nowm()
+    s.deadline = now + g_inactivity()
+    s.last_seen = _now()
+    s.last_shown = None
+    _ACTIVITY_DIRTY.add(mid)
+    if s.warned:
+        _arm(s, now)  # отсчёт на экране — снять его сразу, а не на следующей отметке
+    elif s.due is None or s.deadline - WARN_SECONDS < s.due:
+        _arm(s, max(now, s.deadline - WARN_SECONDS))
+
+
+async def _run_scheduler() -> None:
+    while True:
+        if not _HEAP:
+            _WAKE.clear()
+            await _WAKE.wait()
+            continue
+        delay = _HEAP[0][0] - _nowm()
+        if delay > 0:
+            _WAKE.clear()
+            try:
+                await asyncio.wait_for(_WAKE.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        due, mid = heapq.heappop(_HEAP)
+        s = SESSIONS.get(mid)
+        if s is None or s.due != due:
+            continue  # устаревшая запись
+        s.due = None
+        try:
+            _on_due(s)
+        except Exception:
+            log.exception("inactivity: match %s tick failed", mid)
+
+
+def stop_inactivity_scheduler() -> None:
+    for name in ("task", "editor", "activity"):
+        task = _CTX[name]
+        if task is not None and not task.done():  # type: ignore[union-attr]
+            task.cancel()  # type: ignore[union-attr]
+        _CTX[name] = None
+
 
+# ====== Отложенная запись последней активности ======
+# bump_deadline только помечает матч; раз в ACTIVITY_FLUSH_SECONDS все
+# помеченные пишутся одной пачкой — не больше одной записи на матч за период.
+
+_ACTIVITY_DIRTY: Set[int] = set()
+
+
+async def flush_activity() -> None:
+    if not _ACTIVITY_DIRTY:
+        return
+    rows = [
+        (int(s.last_seen), mid)
+        for mid in _ACTIVITY_DIRTY
+        if (s := SESSIONS.get(mid)) is not None
+    ]
+    # чистим до записи: отметки, пришедшие во время неё, попадут в следующий сброс
+    _ACTIVITY_DIRTY.clear()
+    if not rows:
+        return
     try:
-        while True:
-            await asyncio.sleep(1)
-
-            # матч всё ещё актуален?
-            if a not in ACTIVE or b not in ACTIVE:
-                return
-            if ACTIVE.get(a, (None, None))[1] != mid or ACTIVE.get(b, (None, None))[1] != mid:
-                return
-
-            now = _nowm()
-            deadline = DEADLINE.get(mid, now + g_inactivity())
-            remaining = ceil(deadline - now)
-
-            # показать предупреждение и запустить счётчик
-            if 0 < remaining <= 60 and not WARNED.get(mid):
-                WARNED[mid] = True
-                warn_text = (
-                    f"⌛️ Тишина… Чат автоматически завершится через {remaining} сек.\n"
-                    f"Напиши любое сообщение, чтобы продолжить разговор."
-                )
-                try:
-                    ma = await bot.send_message(a, warn_text)
-                    mb = await bot.send_message(b, warn_text)
-                    COUNTDOWN_MSGS[mid] = (ma.message_id, mb.message_id)
-                except Exception:
-                    COUNTDOWN_MSGS[mid] = (None, None)
-                COUNTDOWN_TASKS[mid] = asyncio.create_task(_countdown(mid, a, b))
-
-            # дедлайн — закрываем
-            if remaining <= 0:
-                await _stop_countdown(mid, a, b, delete_msgs=True)
-                await end_current_chat(a)
-                await end_current_chat(b)
-                _cleanup_match(mid, a, b)
-                DEADLINE.pop(mid, None)
-                LAST_SHOWN.pop(mid, None)
-                try:
-                    await bot.send_message(a, "Чат завершён из-за неактивности.",
-                                           reply_markup=(await menu_for(a)))
-                    await bot.send_message(b, "Чат завершён из-за неактивности.",
-                                           reply_markup=(await menu_for(b)))
-                except Exception:
-                    pass
-                # запрос фидбека
-                await send_fb(a, b, mid)
-                await send_fb(b, a, mid)
-                return
-    except asyncio.CancelledError:
+        await write_many("UPDATE matches SET last_activity=? WHERE id=?", rows)
+    except BaseException:
+        # не записали (ошибка БД или отмена на остановке) — вернуть живые чаты в грязные
+        _ACTIVITY_DIRTY.update(mid for _, mid in rows if mid in SESSIONS)
+        raise
+
+
+async def _run_activity_flusher() -> None:
+    while True:
+        await asyncio.sleep(max(ACTIVITY_FLUSH_SECONDS, 1))
+        try:
+            await flush_activity()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("inactivity: last_activity flush failed")
+
+
+def _on_due(s: ChatSession) -> None:
+    """Сработал срок матча: предупредить, обновить отсчёт или закрыть; перевзвести."""
+    now = _nowm()
+    remaining = ceil(s.deadline - now)
+
+    # дедлайн — закрываем
+    if remaining <= 0:
+        _spawn(_expire(s))
         return
 
+    if remaining <= WARN_SECONDS:
+        if not s.warned:
+            s.warned = True
+            _spawn(_warn(s, remaining))
+        elif s.last_shown != remaining:
+            s.last_shown = remaining
+            _queue_edit(s.mid, remaining)
+        # следующий раз — на ближайшей отметке отсчёта (или на самом дедлайне)
+        _arm(s, s.deadline - _next_step(remaining))
+        return
 
-def _cleanup_match(mid: int, a: int, b: int) -> None:
-    """
-    Сбрасывает RAM-структуры по матчу и отменяет фоновые задачи.
-    Ничего не делает с БД — это обязанность вызывающего кода.
-    """
-    ACTIVE.pop(a, None)
-    ACTIVE.pop(b, None)
-    LAST_SEEN.pop(a, None)
-    LAST_SEEN.pop(b, None)
+    # тишину прервали — убрать отсчёт, ждать следующего порога
+    if s.warned or s.countdown_msgs:
+        _spawn(_stop_countdown(s.mid, s.a, s.b, delete_msgs=True))
+    _arm(s, s.deadline - WARN_SECONDS)
 
-    t = WATCH.pop(mid, None)
-    if t and not t.done():
-        t.cancel()
 
-    DEADLINE.pop(mid, None)
-    LAST_SHOWN.pop(mid, None)
-    WARNED.pop(mid, None)
+async def _warn(s: ChatSession, remaining: int) -> None:
+    bot = _bot()
+    warn_text = (
+        f"⌛️ Тишина… Чат автоматически завершится через {remaining} сек.\n"
+        f"Напиши любое сообщение, чтобы продолжить разговор."
+    )
+    sent = await asyncio.gather(
+        send_text(bot, s.a, warn_text, prio=P_GREETING),
+        send_text(bot, s.b, warn_text, prio=P_GREETING),
+        return_exceptions=True,
+    )
+    msgs = tuple(None if isinstance(m, BaseException) else m.message_id for m in sent)
+    if s.active and s.warned:
+        s.countdown_msgs = msgs
+
+
+# ====== Очередь правок отсчёта ======
+# mid -> remaining. Новое значение заменяет ещё не отправленное
+# (место в очереди сохраняется), так что устаревшие правки не уходят в API.
+# Воркер расходует общий бюджет COUNTDOWN_EDIT_RPS правок в секунду и только
+# ставит правки в исходящую очередь: чат под flood-wait не тормозит остальные.
+# Правка, так и не ушедшая к появлению следующей для того же чата, снимается.
+
+_EDITS: "OrderedDict[int, int]" = OrderedDict()
+_EDITS_WAKE = asyncio.Event()
+_EDIT_FUTS: Dict[int, "asyncio.Future[object]"] = {}  # chat_id -> правка в исходящей очереди
+
+
+def _queue_edit(mid: int, remaining: int) -> None:
+    _EDITS[mid] = remaining
+    _EDITS_WAKE.set()
+
+
+async def _run_editor() -> None:
+    pause = 2 / COUNTDOWN_EDIT_RPS if COUNTDOWN_EDIT_RPS > 0 else 0.0  # две правки на матч
+    while True:
+        if not _EDITS:
+            _EDITS_WAKE.clear()
+            await _EDITS_WAKE.wait()
+            continue
+        mid, remaining = _EDITS.popitem(last=False)
+        s = SESSIONS.get(mid)
+        # сессии нет, отсчёт уже снят или показан более свежий остаток
+        if s is None or not s.warned or s.last_shown != remaining:
+            continue
+        try:
+            await _edit_countdown(s, remaining)
+        except Exception:
+            log.exception("inactivity: countdown edit for match %s failed", mid)
+        if pause:
+            await asyncio.sleep(pause)
+
+
+def _cancel_edit(chat_id: int) -> None:
+    fut = _EDIT_FUTS.pop(chat_id, None)
+    if fut is not None and not fut.done():
+        fut.cancel()  # ещё в очереди — диспетчер её пропустит
+
+
+def _edit_done(chat_id: int, fut: "asyncio.Future[object]") -> None:
+    if _EDIT_FUTS.get(chat_id) is fut:
+        del _EDIT_FUTS[chat_id]
+    if not fut.cancelled():
+        fut.exception()  # ошибки правок не важны: следующая всё равно придёт
+
+
+async def _edit_countdown(s: ChatSession, remaining: int) -> None:
+    if not s.countdown_msgs:
+        return
+    bot = _bot()
+    text = f"⌛️ Тишина… Осталось {remaining} сек.\nНапиши, чтобы продолжить."
+    for uid, msg_id in zip((s.a, s.b), s.countdown_msgs):
+        if not msg_id:
+            continue
+        _cancel_edit(uid)
+        fut = await submit(bot.edit_message_text, chat_id=uid, message_id=msg_id, text=text,
+                           prio=P_GREETING, retry=False)
+        _EDIT_FUTS[uid] = fut
+        fut.add_done_callback(partial(_edit_done, uid))
+
 
-    t2 = COUNTDOWN_TASKS.pop(mid, None)
-    if t2 and not t2.done():
-        t2.cancel()
-    COUNTDOWN_MSGS.pop(mid, None)
+async def _expire(s: ChatSession) -> None:
+    """На нуле — завершает матч и шлёт фидбек-форму."""
+    from app.services.matching import end_current_chat  # matching импортирует этот модуль
 
+    bot = _bot()
+    menu_for = _menu_for()
+    send_fb = _send_fb()
+    mid, a, b = s.mid, s.a, s.b
 
-async def _countdown(mid: int, a: int, b: int):
+    await _stop_countdown(mid, a, b, delete_msgs=True)
+    await end_current_chat(a)
+    await end_current_chat(b)
+    _cleanup_match(mid, a, b)
+    try:
+        await send_text(bot, a, "Чат завершён из-за неактивности.",
+                        prio=P_GREETING, reply_markup=(await menu_for(a)))
+        await send_text(bot, b, "Чат завершён из-за неактивности.",
+                        prio=P_GREETING, reply_markup=(await menu_for(b)))
+    except Exception:
+        pass
+    # запрос фидбека
+    await send_fb(a, b, mid)
+    await send_fb(b, a, mid)
+
+
+async def notify_expired(pairs: Iterable[Tuple[int, int, int]]) -> None:
     """
-    Обновляет текст «⌛️ Осталось N сек…» раз в секунду до 60 сек.
-    Сбрасывается, если тишина прерывается (DEADLINE уходит > 60 сек).
+    Сообщения о закрытии по неактивности для матчей, уже закрытых в БД
+    пачкой (например, на старте): (mid, a, b) -> уведомление + фидбек обоим.
     """
     bot = _bot()
-    try:
-        while True:
-            await asyncio.sleep(1)
-
-            # актуальность матча
-            if a not in ACTIVE or b not in ACTIVE:
-                return
-            if ACTIVE.get(a, (None, None))[1] != mid or ACTIVE.get(b, (None, None))[1] != mid:
-                return
-
-            now = _nowm()
-            deadline = DEADLINE.get(mid, now + g_inactivity())
-            remaining = ceil(deadline - now)
-
-            if remaining > 60:
-                await _stop_countdown(mid, a, b, delete_msgs=True)
-                return
-            if remaining <= 0:
-                return
-            if LAST_SHOWN.get(mid) == remaining:
-                continue
-            LAST_SHOWN[mid] = remaining
-
-            ids = COUNTDOWN_MSGS.get(mid)
-            if not ids:
-                continue
-            a_msg, b_msg = ids
-            text = f"⌛️ Тишина… Осталось {remaining} сек.\nНапиши, чтобы продолжить."
-            try:
-                if a_msg:
-                    await bot.edit_message_text(chat_id=a, message_id=a_msg, text=text)
-            except Exception:
-                pass
+    menu_for = _menu_for()
+    send_fb = _send_fb()
+    for mid, a, b in pairs:
+        for u, p in ((a, b), (b, a)):
             try:
-                if b_msg:
-                    await bot.edit_message_text(chat_id=b, message_id=b_msg, text=text)
+                await send_text(bot, u, "Чат завершён из-за неактивности.",
+                                prio=P_GREETING, reply_markup=(await menu_for(u)))
             except Exception:
                 pass
-    except asyncio.CancelledError:
-        return
+            await send_fb(u, p, mid)
+
+
+def _cleanup_match(mid: int, a: int, b: int) -> None:
+    """
+    Закрывает RAM-сессию матча (и снимает её с планировщика).
+    Ничего не делает с БД — это обязанность вызывающего кода.
+    """
+    s = SESSIONS.get(mid)
+    if s is not None:
+        s.close()
+    _EDITS.pop(mid, None)
+    _ACTIVITY_DIRTY.discard(mid)
 
 
 async def _stop_countdown(mid: int, a: int, b: int, *, delete_msgs: bool = True) -> None:
     """
     Отключает и (опционально) удаляет сообщения обратного отсчёта.
     """
-    t = COUNTDOWN_TASKS.pop(mid, None)
-    if t and not t.done():
-        t.cancel()
-
-    ids = COUNTDOWN_MSGS.pop(mid, None)
+    s = SESSIONS.get(mid)
+    ids = None
+    if s is not None:
+        ids = s.countdown_msgs
+        s.countdown_msgs = None
+        s.warned = False
+    _EDITS.pop(mid, None)
+    _cancel_edit(a)
+    _cancel_edit(b)
     if delete_msgs and ids:
         bot = _bot()
         a_msg, b_msg = ids
@@ -208,13 +411,13 @@ async def _stop_countdown(mid: int, a: int, b: int, *, delete_msgs: bool = True)
                 await bot.delete_message(chat_id=b, message_id=b_msg)
         except Exception:
             pass
-    WARNED.pop(mid, None)
 
 
 __all__ = [
     "init_inactivity",
-    "_watch_inactivity",
-    "_countdown",
+    "schedule_match", "schedule_many", "bump_deadline", "stop_inactivity_scheduler",
+    "flush_activity", "notify_expired",
+    "WARN_SECONDS", "COUNTDOWN_STEPS",
     "_stop_countdown",
     "_cleanup_match",
 ]
@@ -6,19 +6,25 @@ from aiogram.types import Message, ReplyKeyboardRemove
 from app import config as cfg
 
 import asyncio
-from math import ceil
-from typing import Optional, Tuple, Awaitable, Callable, Dict
+import contextlib
+import logging
+from collections import OrderedDict, deque
+from typing import Optional, Tuple, Awaitable, Callable, Collection, Deque, Dict, List
 
 from aiogram import Bot
 from aiogram.types import ReplyKeyboardRemove
 
-from app.db.core import db
-from app.db.repo import get_status  # статусы пользователя для приветствия
+from app.db.core import db, write, write_tx
+from app.db.repo import get_user, get_users, format_rating  # статусы и рейтинги для приветствия
 from app.runtime import (
-    ACTIVE, LAST_SEEN, DEADLINE, LAST_SHOWN, WATCH, WARNED,
-    COUNTDOWN_TASKS, COUNTDOWN_MSGS,
+    BY_USER, open_chat_session,
+    BLOCKS, BLOCKS_DIRTY,
     _nowm, _now, g_inactivity, g_block_rounds,
 )
+from app.services.outbound import submit_text, P_GREETING
+from app.services.inactivity import schedule_match, schedule_many, notify_expired, _spawn, _cleanup_match  # noqa: F401  (_cleanup_match — ещё и для handlers.chat)
+
+log = logging.getLogger(__name__)
 
 # ========================== Контекст ==========================
 
@@ -32,6 +38,9 @@ _CTX: Dict[str, object] = {
     "bot": None,
     "menu_for": None,
     "send_post_chat_feedback": None,
+    "matcher": None,
+    "blocks_flusher": None,
+    "restored": False,   # сессии подняты restore_sessions(): RAM — источник истины
 }
 
 def init_matching(bot: Bot,
@@ -61,396 +70,587 @@ def _send_fb() -> _SendFeedback:
 
 async def active_peer(tg_id: int) -> Optional[int]:
     """Вернуть ID собеседника, если у пользователя активный чат."""
-    if tg_id in ACTIVE:
-        return ACTIVE[tg_id][0]
+    sess = BY_USER.get(tg_id)
+    if sess is not None:
+        return sess.peer(tg_id)
+    if _CTX["restored"]:
+        return None
     async with db() as conn:
         cur = await conn.execute(
-            "SELECT a_id,b_id FROM matches "
-            "WHERE active=1 AND (a_id=? OR b_id=?) "
-            "ORDER BY id DESC LIMIT 1",
-            (tg_id, tg_id),
+            "SELECT peer_id FROM active_sessions WHERE user_id=?",
+            (tg_id,),
         )
         row = await cur.fetchone()
-        if not row:
-            return None
-        a, b = int(row[0]), int(row[1])
-        return b if a == tg_id else a
+        return int(row[0]) if row else None
 
 async def end_current_chat(tg_id: int) -> None:
-    """Завершить все активные матчи пользователя в БД."""
-    async with db() as conn:
+    """Завершить активный матч пользователя в БД (у обоих участников)."""
+    async def job(conn):
         await conn.execute(
-            "UPDATE matches SET active=0 WHERE active=1 AND (a_id=? OR b_id=?)",
-            (tg_id, tg_id),
+            "UPDATE matches SET active=0 "
+            "WHERE id IN (SELECT match_id FROM active_sessions WHERE user_id=?)",
+            (tg_id,),
         )
-        await conn.commit()
-
-async def enqueue(tg_id: int, gender: str, seeking: str) -> None:
-    async with db() as conn:
         await conn.execute(
-            "INSERT OR REPLACE INTO queue(tg_id, gender, seeking, ts) "
-            "VALUES(?,?,?,strftime('%s','now'))",
-            (tg_id, gender, seeking),
+            "DELETE FROM active_sessions "
+            "WHERE match_id IN (SELECT match_id FROM active_sessions WHERE user_id=?)",
+            (tg_id,),
         )
-        await conn.commit()
+    await write_tx(job)
 
-async def dequeue(tg_id: int) -> None:
+# ---- Индекс ожидающих: FIFO-корзины по (пол, кого ищет) ----
+
+# Кого ищет -> какой пол подходит; обратное — какой «seeking» принимает мой пол
+_SEEK_TO_GENDER = {"Парни": "Парень", "Девушки": "Девушка"}
+_GENDER_TO_SEEK = {"Парень": "Парни", "Девушка": "Девушки"}
+_ANY = "Не важно"
+
+
+class MatchIndex:
+    """
+    Очередь поиска в памяти. Ожидающие лежат в FIFO-корзинах по ключу
+    (gender, seeking); поиск смотрит только совместимые корзины (их единицы)
+    и берёт самого старого кандидата, пропуская заблокированных.
+    Таблица queue — зеркало для переживания рестарта.
+    """
+
+    def __init__(self) -> None:
+        self._buckets: Dict[Tuple[str, str], "OrderedDict[int, int]"] = {}
+        self._where: Dict[int, Tuple[str, str]] = {}
+        self._seq = 0
+
+    def __contains__(self, tg_id: int) -> bool:
+        return tg_id in self._where
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def add(self, tg_id: int, gender: str, seeking: str) -> None:
+        """Поставить в конец очереди (повторная постановка — тоже в конец)."""
+        self.remove(tg_id)
+        key = (gender or "", seeking or "")
+        self._seq += 1
+        self._buckets.setdefault(key, OrderedDict())[tg_id] = self._seq
+        self._where[tg_id] = key
+
+    def remove(self, tg_id: int) -> bool:
+        return self.take(tg_id) is not None
+
+    def take(self, tg_id: int) -> Optional[Tuple[Tuple[str, str], int]]:
+        """Изъять из очереди; возвращает (ключ корзины, позицию) для restore()."""
+        key = self._where.pop(tg_id, None)
+        if key is None:
+            return None
+        bucket = self._buckets[key]
+        seq = bucket.pop(tg_id)
+        if not bucket:
+            del self._buckets[key]
+        return key, seq
+
+    def restore(self, tg_id: int, entry: Optional[Tuple[Tuple[str, str], int]]) -> None:
+        """Вернуть изъятого на прежнее место (если он тем временем не встал заново)."""
+        if entry is None or tg_id in self._where:
+            return
+        key, seq = entry
+        bucket = self._buckets.setdefault(key, OrderedDict())
+        bucket[tg_id] = seq
+        self._where[tg_id] = key
+        if any(v > seq for v in bucket.values()):
+            # редкий путь (конфликт при записи): восстанавливаем FIFO-порядок
+            items = sorted(bucket.items(), key=lambda kv: kv[1])
+            bucket.clear()
+            bucket.update(items)
+
+    def clear(self) -> None:
+        self._buckets.clear()
+        self._where.clear()
+
+    def snapshot(self) -> List[Tuple[int, Tuple[str, str]]]:
+        """Все ожидающие в порядке постановки: [(tg_id, (gender, seeking)), ...]."""
+        items = [
+            (seq, uid, key)
+            for key, bucket in self._buckets.items()
+            for uid, seq in bucket.items()
+        ]
+        items.sort()
+        return [(uid, key) for _seq, uid, key in items]
+
+    def _compatible(self, gender: str, seeking: str):
+        """Корзины кандидатов, подходящих пользователю (gender, seeking)."""
+        want = None
+        if seeking != _ANY:
+            want = _SEEK_TO_GENDER.get(seeking)
+            if want is None:
+                return
+        accepts = {_ANY, _GENDER_TO_SEEK.get(gender)}
+        for key, bucket in self._buckets.items():
+            if key[1] in accepts and (want is None or key[0] == want):
+                yield bucket
+
+    def find(self, for_id: int, gender: str, seeking: str,
+             blocked: Collection[int] = ()) -> Optional[int]:
+        """Самый старый совместимый кандидат, кроме себя и заблокированных."""
+        best: Optional[Tuple[int, int]] = None
+        for bucket in self._compatible(gender or "", seeking or ""):
+            for uid, seq in bucket.items():
+                if uid == for_id or uid in blocked:
+                    continue
+                if best is None or seq < best[0]:
+                    best = (seq, uid)
+                break
+        return best[1] if best else None
+
+
+_INDEX = MatchIndex()
+
+
+async def load_match_index() -> None:
+    """Восстановить индекс из таблицы queue (вызывать на старте после init_db)."""
     async with db() as conn:
-        await conn.execute("DELETE FROM queue WHERE tg_id=?", (tg_id,))
-        await conn.commit()
+        cur = await conn.execute("SELECT tg_id, gender, seeking FROM queue ORDER BY ts, rowid")
+        rows = await cur.fetchall()
+    _INDEX.clear()
+    for tg_id, gender, seeking in rows:
+        _INDEX.add(int(tg_id), gender or "", seeking or "")
+
+# Когда пользователь встал в очередь (monotonic) — точка отсчёта задержки старта матча
+_ENQUEUED_AT: Dict[int, float] = {}
+
+async def enqueue(tg_id: int, gender: str, seeking: str) -> None:
+    _INDEX.add(tg_id, gender, seeking)
+    _ENQUEUED_AT[tg_id] = _nowm()
+    await write(
+        "INSERT OR REPLACE INTO queue(tg_id, gender, seeking, ts) "
+        "VALUES(?,?,?,strftime('%s','now'))",
+        (tg_id, gender, seeking),
+    )
+
+async def dequeue(tg_id: int) -> None:
+    _INDEX.remove(tg_id)
+    _ENQUEUED_AT.pop(tg_id, None)
+    await write("DELETE FROM queue WHERE tg_id=?", (tg_id,))
 
 async def in_queue(tg_id: int) -> bool:
-    async with db() as conn:
-        cur = await conn.execute("SELECT 1 FROM queue WHERE tg_id=?", (tg_id,))
-        return (await cur.fetchone()) is not None
+    return tg_id in _INDEX
+
+def queue_size() -> int:
+    return len(_INDEX)
 
 # ========================== Антиповтор ==========================
+# Счётчики живут в runtime.BLOCKS; recent_partners — отложенная копия
+# (flush_blocks по таймеру и при остановке, load_blocks на старте).
+
+async def load_blocks() -> None:
+    """Загрузить блоки из recent_partners (вызывать на старте после init_db)."""
+    async with db() as conn:
+        cur = await conn.execute(
+            "SELECT u_id, partner_id, block_left FROM recent_partners WHERE block_left>0"
+        )
+        rows = await cur.fetchall()
+    BLOCKS.clear()
+    BLOCKS_DIRTY.clear()
+    for u, p, left in rows:
+        BLOCKS.setdefault(int(u), {})[int(p)] = int(left)
+
+async def flush_blocks() -> None:
+    """Записать изменённые блоки в recent_partners одной транзакцией."""
+    if not BLOCKS_DIRTY:
+        return
+    dirty = list(BLOCKS_DIRTY)
+    BLOCKS_DIRTY.clear()
+    rows = [(u, p, left) for u in dirty for p, left in BLOCKS.get(u, {}).items()]
+
+    async def job(conn):
+        await conn.executemany("DELETE FROM recent_partners WHERE u_id=?", [(u,) for u in dirty])
+        await conn.executemany(
+            "INSERT INTO recent_partners(u_id,partner_id,block_left) VALUES(?,?,?)", rows
+        )
+    try:
+        await write_tx(job)
+    except BaseException:
+        # не записали (ошибка БД или отмена на остановке) — вернуть в грязные
+        BLOCKS_DIRTY.update(dirty)
+        raise
+
+async def _blocks_flusher(period: float) -> None:
+    while True:
+        await asyncio.sleep(period)
+        try:
+            await flush_blocks()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("recent_partners flush failed")
+
+def start_blocks_flusher(period: int = cfg.BLOCKS_FLUSH_SECONDS) -> None:
+    task = _CTX["blocks_flusher"]
+    if task is None or task.done():  # type: ignore[union-attr]
+        _CTX["blocks_flusher"] = asyncio.create_task(_blocks_flusher(max(period, 1)))
+
+async def stop_blocks_flusher() -> None:
+    """Останавливает фоновую запись и дописывает остаток."""
+    task = _CTX["blocks_flusher"]
+    _CTX["blocks_flusher"] = None
+    if task is not None and not task.done():  # type: ignore[union-attr]
+        task.cancel()  # type: ignore[union-attr]
+        # дождаться отмены: прерванная запись вернёт свои id в BLOCKS_DIRTY
+        with contextlib.suppress(asyncio.CancelledError):
+            await task  # type: ignore[misc]
+    await flush_blocks()
 
 async def record_separation(a: int, b: int) -> None:
     """После !next — отметим пару, чтобы пару раундов не матчить снова."""
     br = g_block_rounds()
-    async with db() as conn:
-        # двунаправленно
-        for u, p in ((a, b), (b, a)):
-            await conn.execute(
-                "INSERT INTO recent_partners(u_id,partner_id,block_left) "
-                "VALUES(?,?,?) "
-                "ON CONFLICT(u_id,partner_id) DO UPDATE SET block_left=?",
-                (u, p, br, br),
-            )
-        await conn.commit()
+    # двунаправленно
+    for u, p in ((a, b), (b, a)):
+        BLOCKS.setdefault(u, {})[p] = br
+        BLOCKS_DIRTY.add(u)
 
 async def decay_blocks(u_id: int) -> None:
-    """Снижаем счетчик 'block_left' у недавних партнёров пользователя."""
-    async with db() as conn:
-        await conn.execute(
-            "UPDATE recent_partners SET block_left=block_left-1 "
-            "WHERE u_id=? AND block_left>0",
-            (u_id,),
-        )
-        await conn.execute(
-            "DELETE FROM recent_partners WHERE u_id=? AND block_left<=0",
-            (u_id,),
-        )
-        await conn.commit()
+    """Снижаем счетчик оставшихся раундов у недавних партнёров пользователя."""
+    blocks = BLOCKS.get(u_id)
+    if not blocks:
+        return
+    for p, left in list(blocks.items()):
+        if left > 1:
+            blocks[p] = left - 1
+        else:
+            del blocks[p]
+    if not blocks:
+        del BLOCKS[u_id]
+    BLOCKS_DIRTY.add(u_id)
 
 async def is_recent_blocked(u_id: int, candidate_id: int) -> bool:
-    async with db() as conn:
-        cur = await conn.execute(
-            "SELECT 1 FROM recent_partners "
-            "WHERE u_id=? AND partner_id=? AND block_left>0",
-            (u_id, candidate_id),
-        )
-        return (await cur.fetchone()) is not None
+    return candidate_id in BLOCKS.get(u_id, ())
+
+def _blocked_for(u_id: int) -> Collection[int]:
+    return BLOCKS.get(u_id, ())
 
 # ========================== Подбор пары ==========================
 
 async def find_partner(for_id: int) -> Optional[int]:
     """
-    Находит кандидата из очереди по предпочтениям и антиповтору.
+    Находит кандидата из очереди по предпочтениям и антиповтору (через MatchIndex).
     """
-    async with db() as conn:
-        cur = await conn.execute(
-            "SELECT gender,seeking FROM users WHERE tg_id=?",
-            (for_id,),
-        )
-        me = await cur.fetchone()
-        if not me:
-            return None
-        my_gender, my_seek = (me[0] or ""), (me[1] or "")
+    me = await get_user(for_id)
+    if not me:
+        return None
+    blocked = _blocked_for(for_id)
+    return _INDEX.find(for_id, me[1] or "", me[2] or "", blocked)
 
-        cur = await conn.execute(
-            """
-            SELECT q.tg_id
-            FROM queue q
-            JOIN users u ON u.tg_id=q.tg_id
-            LEFT JOIN recent_partners rp
-                   ON rp.u_id=? AND rp.partner_id=q.tg_id AND rp.block_left>0
-            WHERE q.tg_id<>?
-              AND ((?='Не важно') OR u.gender=CASE ? WHEN 'Парни' THEN 'Парень' WHEN 'Девушки' THEN 'Девушка' END)
-              AND (u.seeking='Не важно' OR u.seeking=CASE ? WHEN 'Парень' THEN 'Парни' WHEN 'Девушка' THEN 'Девушки' END)
-              AND rp.partner_id IS NULL
-            ORDER BY q.ts ASC
-            LIMIT 1
-            """,
-            (for_id, for_id, my_seek, my_seek, my_gender),
-        )
-        row = await cur.fetchone()
-        return int(row[0]) if row else None
+# Сколько кандидатов пробуем, если запись матча упёрлась в конфликт с БД
+_CLAIM_RETRIES = 5
 
 async def try_match_now(tg_id: int) -> None:
-    """Проверить очередь и сразу стартовать матч, если нашёлся кандидат."""
-    mate = await find_partner(tg_id)
-    if mate:
-        await start_match(tg_id, mate)
-
-# ======================= Запуск и RAM-учёт =======================
-
-async def start_match(a: int, b: int) -> None:
     """
-    Старт матча: создаёт запись, поднимает RAM-состояние, запускает вотчер,
-    отправляет обоим приветственные сообщения с рейтингами/статусами.
+    Проверить очередь и сразу стартовать матч, если нашёлся кандидат.
+    Поиск и изъятие обоих из индекса идут без await между ними, поэтому
+    параллельный поиск уже не увидит ни искавшего, ни кандидата.
     """
-    bot = _bot()
-
-    # лёгкое «старение» блоков перед новым матчем
-    await decay_blocks(a)
-    await decay_blocks(b)
-
-    # создать матч и вынуть id
-    async with db() as conn:
-        await conn.execute("DELETE FROM queue WHERE tg_id IN (?,?)", (a, b))
-        cur = await conn.execute("INSERT INTO matches(a_id,b_id) VALUES(?,?)", (a, b))
-        mid = int(cur.lastrowid)
-        await conn.commit()
-
-    # материализуем RAM
-    ACTIVE[a] = (b, mid)
-    ACTIVE[b] = (a, mid)
-    now_wall = _now()
-    LAST_SEEN[a] = now_wall
-    LAST_SEEN[b] = now_wall
-    DEADLINE[mid] = _nowm() + g_inactivity()
-    LAST_SHOWN.pop(mid, None)
-
-    # запустим вотчер
-    WATCH[mid] = asyncio.create_task(_watch_inactivity(mid, a, b))
-
-    # приветствие: статусы + рейтинги
-    sa = await get_status(a)
-    sb = await get_status(b)
-
-    pa, pcnt = await _get_avg_rating(b)  # рейтинг собеседника для A
-    ma, mcnt = await _get_avg_rating(a)  # собственный рейтинг A (для себя)
-    pb, bcnt = await _get_avg_rating(a)  # рейтинг собеседника для B
-    mb, bmcnt = await _get_avg_rating(b) # собственный рейтинг B (для себя)
-
-    def fmt(avg, cnt):
-        return f"{avg:.1f} ({cnt})" if avg is not None else "— (0)"
-
-    def greet_line(self_status: Optional[str], peer_rating: str, my_rating: str) -> str:
-        who = self_status or "без статуса"
-        return (
-            f"Ваш собеседник — {who}. Вы анонимны.\n"
-            f"Рейтинг собеседника: {peer_rating}\n"
-            f"Твой рейтинг: {my_rating}\n\n"
-            "Команды в чате:\n"
-            "<code>!next</code> — следующий собеседник\n"
-            "<code>!stop</code> — закончить\n"
-            "<code>!reveal</code> — взаимное раскрытие (если анкеты есть у обоих)\n"
-        )
+    me = await get_user(tg_id)
+    if not me:
+        return
+    blocked = _blocked_for(tg_id)
+    for _ in range(_CLAIM_RETRIES):
+        if tg_id not in _INDEX:  # искавшего уже сматчил кто-то другой
+            return
+        mate = _INDEX.find(tg_id, me[1] or "", me[2] or "", blocked)
+        if mate is None:
+            return
+        mine, theirs = _INDEX.take(tg_id), _INDEX.take(mate)
+        mid, waiting = await _create_match(tg_id, mate)
+        if mid is not None:
+            await _open_session(tg_id, mate, mid)
+            return
+        # БД не подтвердила: возвращаем тех, кто ещё ждёт, и пробуем следующего
+        if mate in waiting:
+            _INDEX.restore(mate, theirs)
+        if tg_id not in waiting:
+            return
+        _INDEX.restore(tg_id, mine)
+
+# ====================== Фоновый подбор пар ======================
+
+async def run_matching_tick() -> int:
+    """
+    Один тик пакетного подбора: снимок очереди в порядке FIFO, жадно каждому
+    ещё свободному — самого старого совместимого незаблокированного кандидата
+    (результат — максимальное паросочетание: оставшихся уже не спарить).
+    Все матчи тика создаются одной транзакцией. Возвращает число матчей.
+    """
+    if len(_INDEX) < 2:
+        return 0
+
+    # подбор и изъятие из индекса — синхронно, без await
+    pairs: List[_Pair] = []
+    taken: Dict[int, Tuple[Tuple[str, str], int]] = {}
+    for uid, (gender, seeking) in _INDEX.snapshot():
+        if uid not in _INDEX:
+            continue
+        mate = _INDEX.find(uid, gender, seeking, _blocked_for(uid))
+        if mate is None:
+            continue
+        taken[uid] = _INDEX.take(uid)  # type: ignore[assignment]
+        taken[mate] = _INDEX.take(mate)  # type: ignore[assignment]
+        pairs.append((uid, mate))
+    if not pairs:
+        return 0
 
     try:
-        await bot.send_message(a, greet_line(sb, fmt(pa, pcnt), fmt(ma, mcnt)),
-                               reply_markup=ReplyKeyboardRemove())
-        await bot.send_message(b, greet_line(sa, fmt(pb, bcnt), fmt(mb, bmcnt)),
-                               reply_markup=ReplyKeyboardRemove())
+        results = await _create_matches(pairs)
     except Exception:
-        pass
+        for uid, entry in taken.items():
+            _INDEX.restore(uid, entry)
+        raise
+
+    created: List[Tuple[int, int, int]] = []
+    for (a, b), (mid, waiting) in zip(pairs, results):
+        if mid is None:
+            for u in waiting:
+                _INDEX.restore(u, taken[u])
+            continue
+        created.append((mid, a, b))
+    outcomes = await asyncio.gather(
+        *(_open_session(a, b, mid) for mid, a, b in created), return_exceptions=True
+    )
+    opened = 0
+    for (mid, a, b), res in zip(created, outcomes):
+        if not isinstance(res, BaseException):
+            opened += 1
+            continue
+        log.error("matching: opening match %s (%s, %s) failed", mid, a, b, exc_info=res)
+        try:
+            await _abort_match(mid, a, b, {u: taken[u] for u in (a, b)})
+        except Exception:
+            log.exception("matching: rollback of match %s failed", mid)
+    return opened
 
-async def _materialize_session_if_needed(user_id: int) -> Optional[Tuple[int, int]]:
+
+async def _abort_match(mid: int, a: int, b: int,
+                       entries: Dict[int, Tuple[Tuple[str, str], int]]) -> None:
     """
-    Восстанавливает RAM-состояние (ACTIVE/WATCH/DEADLINE и т.д.) из БД,
-    если бот перезапускался. Возвращает (peer_id, match_id) или None.
+    Матч записан, но сессия не открылась (никого не поприветствовали):
+    закрыть его в RAM и БД и вернуть обоих на прежние места в очереди.
     """
-    if user_id in ACTIVE:
-        peer_id, mid = ACTIVE[user_id]
-        # гарантируем, что вотчер жив
-        if mid not in WATCH or WATCH[mid].done():
-            a, b = user_id, peer_id
-            WATCH[mid] = asyncio.create_task(_watch_inactivity(mid, a, b))
-        return ACTIVE[user_id]
-
-    # искать активный матч в БД
-    async with db() as conn:
-        cur = await conn.execute(
-            "SELECT id,a_id,b_id FROM matches "
-            "WHERE active=1 AND (a_id=? OR b_id=?) "
-            "ORDER BY id DESC LIMIT 1",
-            (user_id, user_id),
-        )
-        row = await cur.fetchone()
-    if not row:
-        return None
-
-    mid, a, b = int(row[0]), int(row[1]), int(row[2])
-    peer = b if a == user_id else a
+    _cleanup_match(mid, a, b)
 
-    # поднять RAM
-    ACTIVE[a] = (b, mid)
-    ACTIVE[b] = (a, mid)
-    now_wall = _now()
-    LAST_SEEN[a] = now_wall
-    LAST_SEEN[b] = now_wall
-    DEADLINE[mid] = _nowm() + g_inactivity()
-    LAST_SHOWN.pop(mid, None)
-    if mid not in WATCH or WATCH[mid].done():
-        WATCH[mid] = asyncio.create_task(_watch_inactivity(mid, a, b))
+    async def job(conn):
+        await conn.execute("UPDATE matches SET active=0 WHERE id=?", (mid,))
+        await conn.execute("DELETE FROM active_sessions WHERE match_id=?", (mid,))
+        await conn.executemany(
+            "INSERT OR REPLACE INTO queue(tg_id, gender, seeking, ts) "
+            "VALUES(?,?,?,strftime('%s','now'))",
+            [(u, g, sk) for u, ((g, sk), _seq) in entries.items()],
+        )
+    await write_tx(job)
+    for u, entry in entries.items():
+        _INDEX.restore(u, entry)
 
-    return (peer, mid)
+async def _matcher_loop(tick: float) -> None:
+    while True:
+        await asyncio.sleep(tick)
+        try:
+            await run_matching_tick()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("matching tick failed")
 
-# ===================== Вотчер неактивности =====================
+def start_batch_matcher(tick_ms: int = cfg.MATCH_TICK_MS) -> None:
+    """Запускает фоновый подбор пар (после init_matching)."""
+    task = _CTX["matcher"]
+    if task is None or task.done():  # type: ignore[union-attr]
+        _CTX["matcher"] = asyncio.create_task(_matcher_loop(max(tick_ms, 10) / 1000))
 
-async def _watch_inactivity(mid: int, a: int, b: int):
-    """
-    Каждую секунду проверяет дедлайн молчания.
-    За 60 сек до автозакрытия — показывает обратный отсчёт.
-    На нуле — завершает матч и шлёт фидбек-форму.
-    """
-    bot = _bot()
-    menu_for = _menu_for()
-    send_fb = _send_fb()
+def stop_batch_matcher() -> None:
+    task = _CTX["matcher"]
+    if task is not None and not task.done():  # type: ignore[union-attr]
+        task.cancel()  # type: ignore[union-attr]
+    _CTX["matcher"] = None
 
-    try:
-        while True:
-            await asyncio.sleep(1)
+# ======================= Запуск и RAM-учёт =======================
 
-            # матч всё ещё актуален?
-            if a not in ACTIVE or b not in ACTIVE:
-                return
-            if ACTIVE.get(a, (None, None))[1] != mid or ACTIVE.get(b, (None, None))[1] != mid:
-                return
+_Pair = Tuple[int, int]
 
-            now = _nowm()
-            deadline = DEADLINE.get(mid, now + g_inactivity())
-            remaining = ceil(deadline - now)
-
-            # показать предупреждение и запустить счётчик
-            if 0 < remaining <= 60 and not WARNED.get(mid):
-                WARNED[mid] = True
-                warn_text = (
-                    f"⌛️ Тишина… Чат автоматически завершится через {remaining} сек.\n"
-                    f"Напиши любое сообщение, чтобы продолжить разговор."
-                )
-                try:
-                    ma = await bot.send_message(a, warn_text)
-                    mb = await bot.send_message(b, warn_text)
-                    COUNTDOWN_MSGS[mid] = (ma.message_id, mb.message_id)
-                except Exception:
-                    COUNTDOWN_MSGS[mid] = (None, None)
-                COUNTDOWN_TASKS[mid] = asyncio.create_task(_countdown(mid, a, b))
-
-            # дедлайн — закрываем
-            if remaining <= 0:
-                await _stop_countdown(mid, a, b, delete_msgs=True)
-                await end_current_chat(a)
-                await end_current_chat(b)
-                _cleanup_match(mid, a, b)
-                DEADLINE.pop(mid, None)
-                LAST_SHOWN.pop(mid, None)
-                try:
-                    await bot.send_message(a, "Чат завершён из-за неактивности.",
-                                           reply_markup=(await menu_for(a)))
-                    await bot.send_message(b, "Чат завершён из-за неактивности.",
-                                           reply_markup=(await menu_for(b)))
-                except Exception:
-                    pass
-                # запрос фидбека
-                await send_fb(a, b, mid)
-                await send_fb(b, a, mid)
-                return
-    except asyncio.CancelledError:
-        return
 
-def _cleanup_match(mid: int, a: int, b: int) -> None:
-    """Сбрасывает RAM-структуры по матчу."""
-    ACTIVE.pop(a, None)
-    ACTIVE.pop(b, None)
-    LAST_SEEN.pop(a, None)
-    LAST_SEEN.pop(b, None)
+async def _create_matches(pairs: List[_Pair]) -> List[Tuple[Optional[int], set[int]]]:
+    """
+    Compare-and-delete в одной транзакции писателя: матч пары создаётся, только
+    если оба ещё стоят в queue и ни у кого нет активной сессии.
+    Для каждой пары возвращает (match_id | None, кто из пары всё ещё ждёт).
+    """
+    async def job(conn) -> List[Tuple[Optional[int], set[int]]]:
+        out: List[Tuple[Optional[int], set[int]]] = []
+        for a, b in pairs:
+            cur = await conn.execute(
+                "SELECT tg_id FROM queue WHERE tg_id IN (?,?) "
+                "AND tg_id NOT IN (SELECT user_id FROM active_sessions WHERE user_id IN (?,?))",
+                (a, b, a, b),
+            )
+            waiting = {int(r[0]) for r in await cur.fetchall()}
+            if len(waiting) < 2 or a == b:
+                out.append((None, waiting))
+                continue
+            await conn.execute("DELETE FROM queue WHERE tg_id IN (?,?)", (a, b))
+            cur = await conn.execute("INSERT INTO matches(a_id,b_id) VALUES(?,?)", (a, b))
+            mid = int(cur.lastrowid)
+            await conn.executemany(
+                "INSERT OR REPLACE INTO active_sessions(user_id,peer_id,match_id) VALUES(?,?,?)",
+                ((a, b, mid), (b, a, mid)),
+            )
+            out.append((mid, waiting))
+        return out
+    return await write_tx(job)
 
-    t = WATCH.pop(mid, None)
-    if t and not t.done():
-        t.cancel()
+async def _create_match(a: int, b: int) -> Tuple[Optional[int], set[int]]:
+    return (await _create_matches([(a, b)]))[0]
 
-    DEADLINE.pop(mid, None)
-    LAST_SHOWN.pop(mid, None)
-    WARNED.pop(mid, None)
+async def start_match(a: int, b: int) -> Optional[int]:
+    """
+    Старт матча двух ожидающих: атомарно забирает обоих из очереди и
+    открывает сессию. None — кто-то из пары уже не ждёт.
+    """
+    entries = {u: _INDEX.take(u) for u in (a, b)}
+    mid, waiting = await _create_match(a, b)
+    if mid is None:
+        for u in waiting:
+            _INDEX.restore(u, entries[u])
+        return None
+    await _open_session(a, b, mid)
+    return mid
+
+# Задержка «второй встал в очередь → оба получили приветствие», последние замеры (сек)
+_START_LATENCY: Deque[float] = deque(maxlen=1000)
+
+def match_start_stats() -> Dict[str, float]:
+    """Счётчики задержки старта матча: n, p50/p95/max в миллисекундах."""
+    xs = sorted(_START_LATENCY)
+    if not xs:
+        return {"n": 0, "p50_ms": 0.0, "p95_ms": 0.0, "max_ms": 0.0}
+    def pct(q: float) -> float:
+        return xs[min(len(xs) - 1, int(q * len(xs)))] * 1000
+    return {"n": len(xs), "p50_ms": pct(0.5), "p95_ms": pct(0.95), "max_ms": xs[-1] * 1000}
+
+def _greet_text(peer_status: Optional[str], peer_rating: str, my_rating: str) -> str:
+    who = peer_status or "без статуса"
+    return (
+        f"Ваш собеседник — {who}. Вы анонимны.\n"
+        f"Рейтинг собеседника: {peer_rating}\n"
+        f"Твой рейтинг: {my_rating}\n\n"
+        "Команды в чате:\n"
+        "<code>!next</code> — следующий собеседник\n"
+        "<code>!stop</code> — закончить\n"
+        "<code>!reveal</code> — взаимное раскрытие (если анкеты есть у обоих)\n"
+    )
 
-    t2 = COUNTDOWN_TASKS.pop(mid, None)
-    if t2 and not t2.done():
-        t2.cancel()
-    COUNTDOWN_MSGS.pop(mid, None)
+async def _greet(bot: Bot, user_id: int, text: str) -> None:
+    # только в очередь (тик подбора не ждёт доставки); ошибка у A не мешает B — в лог
+    await submit_text(bot, user_id, text, prio=P_GREETING, reply_markup=ReplyKeyboardRemove())
 
-async def _countdown(mid: int, a: int, b: int):
-    """Обновляет текст «⌛️ Осталось N сек…» раз в секунду до 60 сек."""
+async def _open_session(a: int, b: int, mid: int) -> None:
+    """
+    Поднимает RAM-сессию матча, ставит её в планировщик и отправляет обоим
+    приветствия с рейтингами/статусами (одно чтение на пару, отправка параллельно).
+    """
     bot = _bot()
-    try:
-        while True:
-            await asyncio.sleep(1)
+    queued = [_ENQUEUED_AT.pop(u, None) for u in (a, b)]
 
-            # матч всё ещё актуален?
-            if a not in ACTIVE or b not in ACTIVE:
-                return
-            if ACTIVE.get(a, (None, None))[1] != mid or ACTIVE.get(b, (None, None))[1] != mid:
-                return
+    # материализуем RAM и ставим под контроль молчания
+    schedule_match(open_chat_session(mid, a, b, _nowm() + g_inactivity()))
 
-            now = _nowm()
-            deadline = DEADLINE.get(mid, now + g_inactivity())
-            remaining = ceil(deadline - now)
-
-            if remaining > 60:
-                await _stop_countdown(mid, a, b, delete_msgs=True)
-                return
-            if remaining <= 0:
-                return
-            if LAST_SHOWN.get(mid) == remaining:
-                continue
-            LAST_SHOWN[mid] = remaining
-
-            ids = COUNTDOWN_MSGS.get(mid)
-            if not ids:
-                continue
-            a_msg, b_msg = ids
-            text = f"⌛️ Тишина… Осталось {remaining} сек.\nНапиши, чтобы продолжить."
-            try:
-                if a_msg:
-                    await bot.edit_message_text(chat_id=a, message_id=a_msg, text=text)
-            except Exception:
-                pass
-            try:
-                if b_msg:
-                    await bot.edit_message_text(chat_id=b, message_id=b_msg, text=text)
-            except Exception:
-                pass
-    except asyncio.CancelledError:
-        return
+    # лёгкое «старение» блоков при новом матче
+    await decay_blocks(a)
+    await decay_blocks(b)
 
-async def _stop_countdown(mid: int, a: int, b: int, *, delete_msgs: bool = True) -> None:
-    """Отключает и (опционально) удаляет сообщения обратного отсчёта."""
-    t = COUNTDOWN_TASKS.pop(mid, None)
-    if t and not t.done():
-        t.cancel()
+    # статусы + рейтинги обоих одним чтением (кэш строк users, промахи — один IN)
+    rows = await get_users((a, b))
+    ua, ub = rows.get(a), rows.get(b)
+    sa = ua.status_title if ua and ua.status_title else None
+    sb = ub.status_title if ub and ub.status_title else None
+    ra, rb = format_rating(ua), format_rating(ub)
 
-    ids = COUNTDOWN_MSGS.pop(mid, None)
-    if delete_msgs and ids:
-        bot = _bot()
-        a_msg, b_msg = ids
-        try:
-            if a_msg:
-                await bot.delete_message(chat_id=a, message_id=a_msg)
-        except Exception:
-            pass
-        try:
-            if b_msg:
-                await bot.delete_message(chat_id=b, message_id=b_msg)
-        except Exception:
-            pass
-    WARNED.pop(mid, None)
+    await asyncio.gather(
+        _greet(bot, a, _greet_text(sb, rb, ra)),
+        _greet(bot, b, _greet_text(sa, ra, rb)),
+    )
+    if all(t is not None for t in queued):
+        _START_LATENCY.append(_nowm() - max(queued))  # type: ignore[type-var]
 
-# ========================= Вспомогательное =========================
+async def _materialize_session_if_needed(user_id: int) -> Optional[Tuple[int, int]]:
+    """
+    Восстанавливает RAM-сессию из БД, если бот перезапускался.
+    Возвращает (peer_id, match_id) или None.
+    """
+    sess = BY_USER.get(user_id)
+    if sess is not None:
+        # гарантируем, что матч стоит в планировщике
+        schedule_match(sess)
+        return sess.peer(user_id), sess.mid
+    if _CTX["restored"]:
+        return None
 
-async def _get_avg_rating(user_id: int) -> tuple[Optional[float], int]:
-    """AVG(stars), COUNT(*) по оценкам получателя user_id."""
+    # искать активную сессию в БД
     async with db() as conn:
         cur = await conn.execute(
-            "SELECT AVG(stars), COUNT(*) FROM ratings WHERE to_user=?",
+            "SELECT peer_id, match_id FROM active_sessions WHERE user_id=?",
             (user_id,),
         )
         row = await cur.fetchone()
-        avg = float(row[0]) if row and row[0] is not None else None
-        cnt = int(row[1] or 0)
-        return avg, cnt
+    if not row:
+        return None
+
+    peer, mid = int(row[0]), int(row[1])
+
+    # поднять RAM
+    schedule_match(open_chat_session(mid, user_id, peer, _nowm() + g_inactivity()))
+    return (peer, mid)
+
+async def restore_sessions() -> int:
+    """
+    Поднять все живые сессии одним запросом при старте (после init_db и
+    чистки зависших матчей) и поставить их в планировщик пачкой.
+    Дедлайн считается от matches.last_activity; чаты, простоявшие дольше
+    таймаута, закрываются одной транзакцией, участникам уходят уведомления
+    и фидбек. После этого active_peer/_materialize не ходят в БД.
+    Возвращает число поднятых сессий.
+    """
+    async with db() as conn:
+        cur = await conn.execute(
+            """
+            SELECT s.match_id, s.user_id, s.peer_id,
+                   COALESCE(m.last_activity, m.started_at, s.started_at)
+            FROM active_sessions s JOIN matches m ON m.id=s.match_id
+            WHERE s.user_id < s.peer_id
+            """
+        )
+        rows = await cur.fetchall()
+
+    timeout = g_inactivity()
+    now_m, now_w = _nowm(), _now()
+    sessions, expired = [], []
+    for mid, a, b, last in rows:
+        idle = max(0.0, now_w - float(last or now_w))
+        if idle >= timeout:
+            expired.append((int(mid), int(a), int(b)))
+            continue
+        sess = open_chat_session(int(mid), int(a), int(b), now_m + timeout - idle)
+        sess.last_seen = float(last)
+        sessions.append(sess)
+
+    if expired:
+        ids = [(mid,) for mid, _a, _b in expired]
+
+        async def job(conn):
+            await conn.executemany("UPDATE matches SET active=0 WHERE id=?", ids)
+            await conn.executemany("DELETE FROM active_sessions WHERE match_id=?", ids)
+        await write_tx(job)
+        _spawn(notify_expired(expired))  # уведомления — в фоне, старт их не ждёт
+
+    schedule_many(sessions)
+    _CTX["restored"] = True
+    return len(sessions)
+
+# ========================= Вспомогательное =========================
 
 # --- Guard: запрещаем действия, если у пользователя активный чат ---
 
@@ -476,24 +676,27 @@ TGID_RE = re.compile(r'tg://user\?id=\d+', re.I)                 # tg://user?id=
 MAIL_RE = re.compile(r'[\w\.-]+@[\w\.-]+\.\w+', re.I)            # email
 PHON_RE = re.compile(r'(?<!\d)(?:\+?\d[\d\-\s()]{8,}\d)')        # телефон
 
+# Дешёвые подсказки: без них соответствующий шаблон совпасть не может.
+# Проходы идут в прежнем порядке (результат тот же), но каждый пропускается,
+# если в текущей строке нет его подсказки; чистый текст не трогаем вовсе.
+_LINK_HINT_RE = re.compile(r'tg://|t\.me/', re.I)   # TGID_RE / TME_RE
+_DIGIT_RE = re.compile(r'\d')                      # PHON_RE (замены цифр не добавляют)
+
 def sanitize_text(s: str) -> str:
-    s = TGID_RE.sub('[hidden]', s)
-    s = TME_RE.sub('[link hidden]', s)
-    s = USER_RE.sub('@hidden', s)
-    s = MAIL_RE.sub('[email hidden]', s)
-    s = PHON_RE.sub('[phone hidden]', s)
+    has_at = '@' in s
+    has_link = _LINK_HINT_RE.search(s) is not None
+    if not (has_at or has_link or _DIGIT_RE.search(s)):
+        return s
+    if has_link:
+        s = TGID_RE.sub('[hidden]', s)
+        s = TME_RE.sub('[link hidden]', s)
+    if '@' in s:
+        s = USER_RE.sub('@hidden', s)
+        s = MAIL_RE.sub('[email hidden]', s)
+    if _DIGIT_RE.search(s):
+        s = PHON_RE.sub('[phone hidden]', s)
     return s
 
-async def send_text_anonym(peer: int, text: str) -> None:
-    """Шлём текст без HTML, без превью и с защитой контента."""
-    await _bot().send_message(
-        peer,
-        sanitize_text(text),
-        parse_mode=None,
-        disable_web_page_preview=True,
-        protect_content=True,
-    )
-
 def clean_cap(caption: Optional[str]) -> Optional[str]:
     """Санитайз подписи к медиа (если есть)."""
     return sanitize_text(caption) if caption else None
@@ -559,11 +762,15 @@ __all__ = [
     "init_matching",
     # queue & sessions
     "active_peer", "end_current_chat", "enqueue", "dequeue", "in_queue",
+    "MatchIndex", "load_match_index", "queue_size",
+    "run_matching_tick", "start_batch_matcher", "stop_batch_matcher",
+    "match_start_stats",
     "record_separation", "decay_blocks", "is_recent_blocked",
+    "load_blocks", "flush_blocks", "start_blocks_flusher", "stop_blocks_flusher",
     "find_partner", "start_match", "try_match_now",
-    "_materialize_session_if_needed",
+    "_materialize_session_if_needed", "restore_sessions",
     # helpers
-    "sanitize_text", "send_text_anonym", "clean_cap",
+    "sanitize_text", "clean_cap",
     "format_profile_text", "last_match_info",
     "deny_actions_during_chat",   # ← добавь это
 ]
\ No newline at end of file
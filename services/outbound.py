@@ -0,0 +1,314 @@
+# app/services/outbound.py
+"""
+Единая очередь исходящих сообщений бота.
+
+Все отправки «наружу» (релей, приветствия, уведомления, фидбек, рассылка)
+идут через send() или submit() (без ожидания доставки): у каждого чата своя
+FIFO-очередь и свой токен-бакет (~1 сообщение/сек с небольшим всплеском),
+поверх — общий бакет на весь бот (лимит Telegram ~30/сек). Из готовых
+к отправке чатов первым уходит тот, где ждёт сообщение самого высокого класса:
+
+    P_RELAY > P_GREETING > P_FEEDBACK > P_BROADCAST
+
+TelegramRetryAfter не теряет сообщение: чат замораживается на retry_after
+секунд, сообщение возвращается в голову его очереди. Очереди ограничены
+(OUTBOUND_QUEUE_SIZE на класс): когда мест нет, send() ждёт.
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from functools import partial
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from app.config import (
+    OUTBOUND_GLOBAL_RPS, OUTBOUND_CHAT_RPS, OUTBOUND_CHAT_BURST,
+    OUTBOUND_QUEUE_SIZE, OUTBOUND_MAX_RETRIES,
+)
+
+log = logging.getLogger(__name__)
+
+
+# ====== Классы приоритета (меньше — важнее) ======
+
+P_RELAY = 0       # пересылка сообщений собеседнику и события внутри чата
+P_GREETING = 1    # приветствия матча и служебные уведомления чата
+P_FEEDBACK = 2    # фидбек-формы и прочие уведомления
+P_BROADCAST = 3   # массовая рассылка
+
+_N_PRIO = 4
+_IDLE_SWEEP_SECONDS = 30.0
+
+
+def _mono() -> float:
+    return time.monotonic()
+
+
+class _Bucket:
+    """Токен-бакет: rate токенов в секунду, не больше cap."""
+    __slots__ = ("rate", "cap", "tokens", "ts")
+
+    def __init__(self, rate: float, cap: float) -> None:
+        self.rate = max(rate, 1e-6)
+        self.cap = max(cap, 1.0)
+        self.tokens = self.cap
+        self.ts = _mono()
+
+    def _refill(self, now: float) -> None:
+        if now > self.ts:
+            self.tokens = min(self.cap, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1.0 else (1.0 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1.0
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.cap
+
+
+class _Job:
+    __slots__ = ("prio", "call", "fut", "tries")
+
+    def __init__(self, prio: int, call: Callable[[], Awaitable[Any]],
+                 fut: "asyncio.Future[Any]", tries: int) -> None:
+        self.prio = prio
+        self.call = call
+        self.fut = fut
+        self.tries = tries
+
+
+class _Chat:
+    """Очередь одного чата: FIFO заданий, счётчики по классам, свой бакет."""
+    __slots__ = ("jobs", "counts", "bucket", "busy", "key", "hold")
+
+    def __init__(self) -> None:
+        self.jobs: Deque[_Job] = deque()
+        self.counts: List[int] = [0] * _N_PRIO
+        self.bucket = _Bucket(OUTBOUND_CHAT_RPS, OUTBOUND_CHAT_BURST)
+        self.busy = False              # запрос в полёте: следующий — только после ответа
+        self.key: Optional[int] = None  # актуальная запись в _READY/_TIMED
+        self.hold = 0.0                # заморозка по retry_after (monotonic)
+
+    def prio(self) -> int:
+        """Класс чата — самый важный из ожидающих (наследуется голове FIFO)."""
+        for p, n in enumerate(self.counts):
+            if n:
+                return p
+        return _N_PRIO
+
+
+# ====== Состояние диспетчера ======
+
+_CHATS: Dict[int, _Chat] = {}
+_READY: List[Tuple[int, int, int]] = []    # (класс, seq, chat_id) — бакет чата позволяет слать
+_TIMED: List[Tuple[float, int, int]] = []  # (когда, seq, chat_id) — ждут токен/retry_after
+_GLOBAL = _Bucket(OUTBOUND_GLOBAL_RPS, 1.0)  # без всплеска: ровный темп
+_SLOTS = [asyncio.Semaphore(max(OUTBOUND_QUEUE_SIZE, 1)) for _ in range(_N_PRIO)]
+_SEQ = itertools.count()
+_WAKE = asyncio.Event()
+_BG: Set[asyncio.Task] = set()
+_CTX: Dict[str, Optional[asyncio.Task]] = {"task": None}
+
+
+def _schedule(cid: int, ch: _Chat) -> None:
+    """Поставить чат в готовые (или в ожидание токена). Старая запись становится устаревшей."""
+    if ch.busy or not ch.jobs:
+        ch.key = None
+        return
+    seq = next(_SEQ)
+    ch.key = seq
+    now = _mono()
+    at = max(now + ch.bucket.wait_time(now), ch.hold)
+    if at > now:
+        heapq.heappush(_TIMED, (at, seq, cid))
+    else:
+        heapq.heappush(_READY, (ch.prio(), seq, cid))
+    _WAKE.set()
+
+
+def _promote(now: float) -> None:
+    while _TIMED and _TIMED[0][0] <= now:
+        _, seq, cid = heapq.heappop(_TIMED)
+        ch = _CHATS.get(cid)
+        if ch is not None and ch.key == seq:
+            heapq.heappush(_READY, (ch.prio(), seq, cid))
+
+
+def _sweep(now: float) -> None:
+    """Забыть простаивающие чаты, чьи бакеты уже полны (ничего не теряем)."""
+    idle = [
+        cid for cid, ch in _CHATS.items()
+        if not ch.jobs and not ch.busy and ch.hold <= now and ch.bucket.full(now)
+    ]
+    for cid in idle:
+        del _CHATS[cid]
+
+
+async def _run_dispatcher() -> None:
+    next_sweep = _mono() + _IDLE_SWEEP_SECONDS
+    while True:
+        now = _mono()
+        if now >= next_sweep:
+            _sweep(now)
+            next_sweep = now + _IDLE_SWEEP_SECONDS
+        _promote(now)
+        if not _READY:
+            _WAKE.clear()
+            timeout = (_TIMED[0][0] - now) if _TIMED else _IDLE_SWEEP_SECONDS
+            try:
+                await asyncio.wait_for(_WAKE.wait(), timeout=max(timeout, 0.0))
+            except asyncio.TimeoutError:
+                pass
+            continue
+        wait = _GLOBAL.wait_time(now)
+        if wait > 0:
+            await asyncio.sleep(wait)
+            continue  # за время ожидания мог прийти более важный чат
+
+        _, seq, cid = heapq.heappop(_READY)
+        ch = _CHATS.get(cid)
+        if ch is None or ch.key != seq:
+            continue
+        ch.key = None
+        job = ch.jobs.popleft()
+        ch.counts[job.prio] -= 1
+        if job.fut.done():  # вызывающий уже отменил ожидание
+            _schedule(cid, ch)
+            continue
+        ch.busy = True
+        ch.bucket.take()
+        _GLOBAL.take()
+        task = asyncio.create_task(_execute(cid, ch, job))
+        _BG.add(task)
+        task.add_done_callback(_BG.discard)
+
+
+async def _execute(cid: int, ch: _Chat, job: _Job) -> None:
+    try:
+        res = await job.call()
+    except TelegramRetryAfter as e:
+        # заморозка чата — всегда: следующие задания тоже упёрлись бы в flood-wait
+        ch.hold = max(ch.hold, _mono() + float(e.retry_after))
+        if job.tries < OUTBOUND_MAX_RETRIES and not job.fut.done():
+            job.tries += 1
+            ch.jobs.appendleft(job)
+            ch.counts[job.prio] += 1
+            log.warning("outbound: chat %s flood-wait %ss (try %d)", cid, e.retry_after, job.tries)
+        elif not job.fut.done():
+            job.fut.set_exception(e)
+    except Exception as e:
+        if not job.fut.done():
+            job.fut.set_exception(e)
+    else:
+        if not job.fut.done():
+            job.fut.set_result(res)
+    finally:
+        ch.busy = False
+        _schedule(cid, ch)
+
+
+def _ensure_running() -> None:
+    task = _CTX["task"]
+    if task is None or task.done():
+        _CTX["task"] = asyncio.create_task(_run_dispatcher())
+
+
+# ====== Публичное API ======
+
+async def submit(method: Callable[..., Awaitable[Any]], *, chat_id: int,
+                 prio: int = P_GREETING, retry: bool = True,
+                 **kwargs: Any) -> "asyncio.Future[Any]":
+    """
+    Поставить вызов Bot API в очередь чата и вернуть future, не дожидаясь отправки.
+    Ждёт только свободного места в очереди класса. Порядок внутри чата — порядок
+    вызовов submit(), поэтому вызывающий может отпустить свои замки сразу после него.
+    """
+    slots = _SLOTS[prio]
+    await slots.acquire()
+    fut: "asyncio.Future[Any]" = asyncio.get_running_loop().create_future()
+    fut.add_done_callback(lambda _: slots.release())
+    job = _Job(prio, partial(method, chat_id=chat_id, **kwargs), fut,
+               0 if retry else OUTBOUND_MAX_RETRIES)
+    ch = _CHATS.get(chat_id)
+    if ch is None:
+        ch = _CHATS[chat_id] = _Chat()
+    before = ch.prio()
+    ch.jobs.append(job)
+    ch.counts[prio] += 1
+    if ch.key is None or prio < before:
+        _schedule(chat_id, ch)
+    _ensure_running()
+    return fut
+
+
+async def send(method: Callable[..., Awaitable[Any]], *, chat_id: int,
+               prio: int = P_GREETING, retry: bool = True, **kwargs: Any) -> Any:
+    """
+    Поставить вызов Bot API в очередь чата и дождаться результата:
+        await send(bot.send_message, chat_id=uid, text="…", prio=P_RELAY)
+    Ошибки Telegram пробрасываются вызывающему, как при прямом вызове.
+    retry=False — не повторять после retry_after (для устаревающих правок).
+    """
+    # отмена ожидания отменяет future — диспетчер пропустит задание
+    fut = await submit(method, chat_id=chat_id, prio=prio, retry=retry, **kwargs)
+    return await fut
+
+
+async def send_text(bot: Any, chat_id: int, text: str, *,
+                    prio: int = P_GREETING, **kwargs: Any) -> Any:
+    """Сокращение для send(bot.send_message, …)."""
+    return await send(bot.send_message, chat_id=chat_id, text=text, prio=prio, **kwargs)
+
+
+def _log_failure(what: str, fut: "asyncio.Future[Any]") -> None:
+    if fut.cancelled():
+        return
+    e = fut.exception()
+    if e is not None:
+        log.warning("outbound: %s failed: %r", what, e)
+
+
+def log_failure(fut: "asyncio.Future[Any]", what: str) -> "asyncio.Future[Any]":
+    """Ошибку доставки future из submit() — в лог (когда результата никто не ждёт)."""
+    fut.add_done_callback(partial(_log_failure, what))
+    return fut
+
+
+async def submit_text(bot: Any, chat_id: int, text: str, *,
+                      prio: int = P_GREETING, **kwargs: Any) -> "asyncio.Future[Any]":
+    """Как send_text(), но только ставит в очередь; ошибка доставки уходит в лог."""
+    fut = await submit(bot.send_message, chat_id=chat_id, text=text, prio=prio, **kwargs)
+    return log_failure(fut, f"message to {chat_id}")
+
+
+def pending() -> int:
+    """Сколько сообщений ждёт отправки (для статистики)."""
+    return sum(len(ch.jobs) for ch in _CHATS.values())
+
+
+async def stop_outbound(drain_seconds: float = 5.0) -> None:
+    """Дать очередям доотправиться (не дольше drain_seconds) и остановить диспетчер."""
+    deadline = _mono() + drain_seconds
+    while _mono() < deadline and any(ch.jobs or ch.busy for ch in _CHATS.values()):
+        await asyncio.sleep(0.05)
+    task = _CTX["task"]
+    if task is not None and not task.done():
+        task.cancel()
+    _CTX["task"] = None
+
+
+__all__ = [
+    "P_RELAY", "P_GREETING", "P_FEEDBACK", "P_BROADCAST",
+    "submit", "send", "send_text", "submit_text", "log_failure", "pending", "stop_outbound",
+]
@@ -0,0 +1,254 @@
+# app/services/relay.py
+"""
+Пересылка сообщений собеседнику в анонимном чате.
+
+Один вызов API на сообщение независимо от типа:
+  • текст — санитайз и send_message (без HTML/превью, сущности не переносим);
+  • медиа/стикеры — copy_message с санитайзнутой подписью (parse_mode=None,
+    исходные сущности подписи не копируются) и protect_content;
+  • всё, чего нет в RELAY_POLICY (контакты, геопозиция, опросы…), — отказ;
+  • части альбома (media_group_id) собираются ALBUM_WINDOW_MS и уходят
+    одним send_media_group.
+Отправка идёт через исходящую очередь (класс P_RELAY): обработчик ждёт только
+постановки в очередь чата собеседника, доставку и счётчики учитывает колбэк.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from typing import Any, Deque, Dict, List, Optional, Set
+
+from aiogram import Bot
+from aiogram.enums import ContentType
+from aiogram.types import (
+    InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo, Message,
+)
+
+from app.config import ALBUM_WINDOW_MS, ALBUM_MAX_GROUPS
+from app.runtime import session_of
+from app.services.matching import sanitize_text, clean_cap
+from app.services.outbound import submit, P_RELAY
+
+log = logging.getLogger(__name__)
+
+REJECT_TEXT = "Этот тип вложений отключён в анонимном чате."
+
+# content_type -> способ пересылки. Нет в таблице — не пересылаем.
+RELAY_TEXT = "text"
+RELAY_COPY = "copy"
+RELAY_POLICY: Dict[str, str] = {
+    ContentType.TEXT: RELAY_TEXT,
+    ContentType.PHOTO: RELAY_COPY,
+    ContentType.ANIMATION: RELAY_COPY,
+    ContentType.VIDEO: RELAY_COPY,
+    ContentType.AUDIO: RELAY_COPY,
+    ContentType.VOICE: RELAY_COPY,
+    ContentType.VIDEO_NOTE: RELAY_COPY,
+    ContentType.DOCUMENT: RELAY_COPY,
+    ContentType.STICKER: RELAY_COPY,
+}
+
+_LATENCY: Deque[float] = deque(maxlen=1000)
+_COUNTS: Counter = Counter()
+
+
+def relay_policy(m: Message) -> Optional[str]:
+    return RELAY_POLICY.get(m.content_type)
+
+
+def _track(fut: "asyncio.Future[Any]", what: str, peer: int, kinds: List[str]) -> None:
+    """По завершении доставки — задержка и счётчики по типам; ошибка — в лог."""
+    t0 = time.monotonic()
+
+    def done(f: "asyncio.Future[Any]") -> None:
+        if f.cancelled():
+            return
+        e = f.exception()
+        if e is not None:
+            log.error("relay: %s to %s failed", what, peer, exc_info=e)
+            return
+        _LATENCY.append(time.monotonic() - t0)
+        for k in kinds:
+            _COUNTS[k] += 1
+
+    fut.add_done_callback(done)
+
+
+async def _copy(m: Message, peer: int) -> "asyncio.Future[Any]":
+    extra = {}
+    if m.caption:
+        # без явной подписи copy_message оставил бы исходную (несанитайзнутую)
+        extra = {"caption": clean_cap(m.caption), "parse_mode": None}
+    return await submit(
+        m.bot.copy_message, chat_id=peer,
+        from_chat_id=m.chat.id, message_id=m.message_id,
+        protect_content=True, prio=P_RELAY, **extra,
+    )
+
+
+# ====== Альбомы ======
+# Telegram присылает альбом отдельными апдейтами с общим media_group_id.
+# Части копятся в буфере; окно продлевается с каждой новой частью, по его
+# истечении (или на 10-й части) альбом уходит собеседнику одним вызовом.
+# Любое другое сообщение отправителя (и конец чата) сначала досылает его
+# альбомы — flush_pending_album(): иначе текст обгонит альбом.
+
+_ALBUM_LIMIT = 10  # больше частей Telegram в альбом не кладёт
+
+_INPUT_MEDIA = {
+    ContentType.PHOTO: InputMediaPhoto,
+    ContentType.VIDEO: InputMediaVideo,
+    ContentType.DOCUMENT: InputMediaDocument,
+    ContentType.AUDIO: InputMediaAudio,
+}
+
+
+class _Album:
+    __slots__ = ("bot", "sender", "peer", "parts", "timer")
+
+    def __init__(self, bot: Bot, sender: int, peer: int) -> None:
+        self.bot = bot
+        self.sender = sender
+        self.peer = peer
+        self.parts: List[Message] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+_ALBUMS: Dict[str, _Album] = {}
+_FLUSHES: Dict[int, Set[asyncio.Task]] = {}  # отправитель -> постановки альбомов в очередь
+
+
+def _file_id(m: Message) -> str:
+    if m.photo:
+        return m.photo[-1].file_id
+    media = m.video or m.document or m.audio
+    return media.file_id  # type: ignore[union-attr]
+
+
+def _arm_album(gid: str, album: _Album) -> None:
+    if album.timer is not None:
+        album.timer.cancel()
+    album.timer = asyncio.get_running_loop().call_later(
+        ALBUM_WINDOW_MS / 1000, _flush_album_soon, gid
+    )
+
+
+def _flush_album_soon(gid: str) -> None:
+    """Снять альбом с буфера сразу (новые части начнут следующий) и отправить."""
+    album = _ALBUMS.pop(gid, None)
+    if album is None:
+        return
+    if album.timer is not None:
+        album.timer.cancel()
+    tasks = _FLUSHES.setdefault(album.sender, set())
+    task = asyncio.create_task(_flush_album(gid, album))
+    tasks.add(task)
+
+    def done(t: asyncio.Task) -> None:
+        tasks.discard(t)
+        if not tasks and _FLUSHES.get(album.sender) is tasks:
+            del _FLUSHES[album.sender]
+
+    task.add_done_callback(done)
+
+
+async def flush_pending_album(sender: int) -> None:
+    """
+    Поставить в очередь собеседника все альбомы sender, не дожидаясь окна.
+    Вызывается до релея любого не-альбомного сообщения отправителя и до
+    !stop/!next: ждём только постановки в очередь, не доставки.
+    """
+    for gid in [g for g, a in _ALBUMS.items() if a.sender == sender]:
+        _flush_album_soon(gid)
+    tasks = _FLUSHES.get(sender)
+    if tasks:
+        await asyncio.wait(set(tasks))
+
+
+def album_pending(m: Message) -> bool:
+    """Сообщение — продолжение уже собираемого альбома (таймер молчания не трогаем)."""
+    return m.media_group_id is not None and m.media_group_id in _ALBUMS
+
+
+def _buffer_album(m: Message, peer: int) -> bool:
+    """Положить часть альбома в буфер. False — буфер переполнен, шлём как одиночное."""
+    gid = m.media_group_id
+    album = _ALBUMS.get(gid)  # type: ignore[arg-type]
+    if album is None:
+        if len(_ALBUMS) >= ALBUM_MAX_GROUPS:
+            return False
+        album = _ALBUMS[gid] = _Album(m.bot, m.from_user.id, peer)  # type: ignore[index]
+    album.parts.append(m)
+    if len(album.parts) >= _ALBUM_LIMIT:
+        _flush_album_soon(gid)  # type: ignore[arg-type]
+    else:
+        _arm_album(gid, album)  # type: ignore[arg-type]
+    return True
+
+
+async def _flush_album(gid: str, album: _Album) -> None:
+    s = session_of(album.sender)
+    if s is None or s.peer(album.sender) != album.peer:
+        return  # чат закончился, пока собирали альбом
+    parts = sorted(album.parts, key=lambda x: x.message_id)
+    media: List[Any] = []
+    for p in parts:
+        kw: Dict[str, Any] = {"media": _file_id(p)}
+        if p.caption:
+            kw.update(caption=clean_cap(p.caption), parse_mode=None)
+        media.append(_INPUT_MEDIA[p.content_type](**kw))
+    if len(parts) == 1:  # send_media_group требует от 2 элементов
+        fut = await _copy(parts[0], album.peer)
+    else:
+        fut = await submit(
+            album.bot.send_media_group, chat_id=album.peer,
+            media=media, protect_content=True, prio=P_RELAY,
+        )
+    _track(fut, f"album {gid}", album.peer, [p.content_type for p in parts])
+
+
+async def relay_message(m: Message, peer: int) -> bool:
+    """
+    Переслать сообщение m собеседнику peer: возвращается, как только сообщение
+    встало в очередь чата собеседника (порядок сохраняет FIFO очереди).
+    False — тип запрещён политикой (отправителю уже ответили отказом).
+    """
+    how = relay_policy(m)
+    if how is None:
+        _COUNTS["rejected"] += 1
+        await m.answer(REJECT_TEXT)
+        return False
+
+    if m.media_group_id and m.content_type in _INPUT_MEDIA and _buffer_album(m, peer):
+        return True
+
+    if how == RELAY_TEXT:
+        fut = await submit(
+            m.bot.send_message, chat_id=peer, text=sanitize_text(m.text or ""),
+            parse_mode=None, disable_web_page_preview=True, protect_content=True,
+            prio=P_RELAY,
+        )
+    else:
+        fut = await _copy(m, peer)
+    _track(fut, m.content_type, peer, [m.content_type])
+    return True
+
+
+def relay_stats() -> Dict[str, float]:
+    """Счётчики релея: n, p50/p95 в миллисекундах, число отказов."""
+    xs = sorted(_LATENCY)
+    rejected = _COUNTS["rejected"]
+    if not xs:
+        return {"n": 0, "p50_ms": 0.0, "p95_ms": 0.0, "rejected": rejected}
+    def pct(q: float) -> float:
+        return xs[min(len(xs) - 1, int(q * len(xs)))] * 1000
+    return {"n": sum(_COUNTS.values()) - rejected, "p50_ms": pct(0.5), "p95_ms": pct(0.95),
+            "rejected": rejected}
+
+
+__all__ = [
+    "REJECT_TEXT", "RELAY_POLICY", "RELAY_TEXT", "RELAY_COPY",
+    "relay_policy", "relay_message", "relay_stats", "album_pending", "flush_pending_album",
+]
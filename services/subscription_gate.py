@@ -1,18 +1,69 @@
 # app/services/subscription_gate.py
 from __future__ import annotations
 
-from typing import Optional
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
 
 from aiogram import Bot
+from aiogram.enums import ChatMemberStatus
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.types import Message
 
-from app.config import CHANNEL_USERNAME
-from app.db.core import db
+from app.config import (
+    CHANNEL_USERNAME, SUB_CACHE_TTL, SUB_NEGATIVE_TTL,
+    SUB_RECHECK_INTERVAL, SUB_RECHECK_BATCH, SUB_RECHECK_RPS,
+)
+from app.db.core import db, write
 from app.keyboards.common import subscription_kb
 
+log = logging.getLogger(__name__)
+
+_MEMBER_STATUSES = (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR)
+
 # Кэш для числового ID канала (ускоряет и устойчив к смене @username)
 _RESOLVED_CHANNEL_ID: Optional[int] = None
 
+# Множество tg_id с users.sub_verified=1. Загружается на старте,
+# пополняется в mark_verified() — гвард и ворота не ходят в БД.
+_VERIFIED: set[int] = set()
+
+# Кэш членства: uid -> (результат, monotonic-время истечения).
+# True — подписан, False — не подписан, None — проверить не удалось
+# (бот не админ канала, сеть и т.п.). False/None живут SUB_NEGATIVE_TTL.
+_MEMBERSHIP: Dict[int, Tuple[Optional[bool], float]] = {}
+
+# Очередь обхода для фоновой перепроверки (round-robin по _VERIFIED)
+_RECHECK: Deque[int] = deque()
+_CTX: Dict[str, object] = {"task": None}
+
+
+async def load_verified() -> None:
+    """Загружает множество подтвердивших подписку (вызывать на старте после init_db)."""
+    async with db() as conn:
+        cur = await conn.execute("SELECT tg_id FROM users WHERE sub_verified=1")
+        ids = {int(r[0]) for r in await cur.fetchall()}
+    _VERIFIED.clear()
+    _VERIFIED.update(ids)
+
+
+def is_verified(user_id: int) -> bool:
+    return user_id in _VERIFIED
+
+
+async def mark_verified(user_id: int) -> None:
+    """Ставит users.sub_verified=1 и добавляет пользователя в множество."""
+    await write("UPDATE users SET sub_verified=1 WHERE tg_id=?", (user_id,))
+    _VERIFIED.add(user_id)
+
+
+async def revoke_verified(user_id: int) -> None:
+    """Снимает users.sub_verified (пользователь вышел из канала)."""
+    await write("UPDATE users SET sub_verified=0 WHERE tg_id=?", (user_id,))
+    _VERIFIED.discard(user_id)
+
 
 async def _resolve_channel_id(bot: Bot) -> Optional[int]:
     global _RESOLVED_CHANNEL_ID
@@ -21,46 +72,146 @@ async def _resolve_channel_id(bot: Bot) -> Optional[int]:
     try:
         chat = await bot.get_chat(CHANNEL_USERNAME)
         _RESOLVED_CHANNEL_ID = chat.id
+    except TelegramRetryAfter:
+        raise
     except Exception:
         _RESOLVED_CHANNEL_ID = None
     return _RESOLVED_CHANNEL_ID
 
 
+async def _probe(bot: Bot, user_id: int) -> Optional[bool]:
+    """
+    Один запрос get_chat_member. None — проверить не удалось.
+    TelegramRetryAfter пробрасывается: вызывающий сам решает, ждать ли.
+    """
+    target = await _resolve_channel_id(bot) or CHANNEL_USERNAME
+    try:
+        cm = await bot.get_chat_member(target, user_id)
+    except TelegramRetryAfter:
+        raise
+    except Exception:
+        return None
+    # ChatMemberStatus — (str, Enum): str() даёт «ChatMemberStatus.MEMBER», сравниваем сам член
+    if getattr(cm, "status", None) in _MEMBER_STATUSES:
+        return True
+    # Для старых версий ChatMember / restricted с is_member
+    if hasattr(cm, "is_member") and bool(getattr(cm, "is_member")):
+        return True
+    return False
+
+
+def _prune_membership(now: float) -> int:
+    """Выбросить протухшие записи кэша членства (иначе он растёт с каждым проверенным)."""
+    stale = [uid for uid, (_res, exp) in _MEMBERSHIP.items() if exp <= now]
+    for uid in stale:
+        del _MEMBERSHIP[uid]
+    return len(stale)
+
+
+def cached_membership(user_id: int) -> Optional[bool]:
+    """Результат из кэша членства без запросов к Telegram (None — нет/протух)."""
+    hit = _MEMBERSHIP.get(user_id)
+    if hit is None or hit[1] <= time.monotonic():
+        return None
+    return hit[0]
+
+
+async def check_membership(bot: Bot, user_id: int, *, force: bool = False) -> Optional[bool]:
+    """
+    Членство в канале с TTL-кэшем (в т.ч. отрицательным).
+    force=True — игнорировать кэш (кнопка «Проверить подписку»).
+    """
+    now = time.monotonic()
+    hit = _MEMBERSHIP.get(user_id)
+    if not force and hit is not None and hit[1] > now:
+        return hit[0]
+    res = await _probe(bot, user_id)
+    ttl = SUB_CACHE_TTL if res else SUB_NEGATIVE_TTL
+    _MEMBERSHIP[user_id] = (res, time.monotonic() + ttl)
+    return res
+
+
 async def is_subscribed(bot: Bot, user_id: int) -> bool:
     """
-    Реально проверяет, состоит ли пользователь в канале.
+    Реально проверяет, состоит ли пользователь в канале (через кэш членства).
     Пытается использовать числовой ID (если удалось зарезолвить),
     иначе — проверяет по CHANNEL_USERNAME.
     """
-    target = await _resolve_channel_id(bot) or CHANNEL_USERNAME
     try:
-        cm = await bot.get_chat_member(target, user_id)
-        status = str(getattr(cm, "status", "")).lower()
-        if status in ("member", "administrator", "creator"):
-            return True
-        # Для старых версий ChatMember
-        if hasattr(cm, "is_member") and bool(getattr(cm, "is_member")):
-            return True
-        return False
+        return bool(await check_membership(bot, user_id))
     except Exception:
         # если бот не админ канала или канал недоступен — считаем «не подписан»
         return False
 
 
+# ====== Фоновая перепроверка ======
+
+async def recheck_batch(bot: Bot, limit: int = SUB_RECHECK_BATCH,
+                        rps: float = SUB_RECHECK_RPS) -> int:
+    """
+    Перепроверяет до `limit` подтверждённых пользователей по кругу.
+    Свежие положительные записи кэша пропускаются. Тем, кто точно вышел
+    из канала (False), снимается sub_verified. Заодно из кэша членства
+    вычищаются протухшие записи. Возвращает число отозванных.
+    """
+    _prune_membership(time.monotonic())
+    if not _RECHECK:
+        _RECHECK.extend(_VERIFIED)
+    pause = 1.0 / rps if rps > 0 else 0.0
+    revoked = 0
+    probed = 0
+    while _RECHECK and probed < limit:
+        uid = _RECHECK.popleft()
+        if uid not in _VERIFIED or cached_membership(uid) is True:
+            continue
+        try:
+            res = await check_membership(bot, uid, force=True)
+        except TelegramRetryAfter as e:
+            _RECHECK.appendleft(uid)
+            await asyncio.sleep(e.retry_after)
+            continue
+        probed += 1
+        if res is False:
+            await revoke_verified(uid)
+            revoked += 1
+        if pause:
+            await asyncio.sleep(pause)
+    return revoked
+
+
+async def _recheck_loop(bot: Bot) -> None:
+    while True:
+        await asyncio.sleep(SUB_RECHECK_INTERVAL)
+        try:
+            revoked = await recheck_batch(bot)
+            if revoked:
+                log.info("subscription recheck: revoked %d", revoked)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("subscription recheck failed")
+
+
+def start_recheck_worker(bot: Bot) -> None:
+    """Запускает фоновую перепроверку подписок (один раз при старте)."""
+    task = _CTX["task"]
+    if task is None or task.done():  # type: ignore[union-attr]
+        _CTX["task"] = asyncio.create_task(_recheck_loop(bot))
+
+
+def stop_recheck_worker() -> None:
+    task = _CTX["task"]
+    if task is not None and not task.done():  # type: ignore[union-attr]
+        task.cancel()  # type: ignore[union-attr]
+    _CTX["task"] = None
+
+
 async def gate_subscription(message: Message) -> bool:
     """
     «Одноразовые ворота». Пропускаем пользователя дальше, если в БД
     стоит флаг users.sub_verified=1. Иначе показываем клаву подписки.
     """
-    uid = message.from_user.id
-    async with db() as conn:
-        cur = await conn.execute(
-            "SELECT COALESCE(sub_verified,0) FROM users WHERE tg_id=?",
-            (uid,),
-        )
-        row = await cur.fetchone()
-
-    if bool(row and row[0]):
+    if message.from_user.id in _VERIFIED:
         return True
 
     await message.answer(
@@ -70,4 +221,9 @@ async def gate_subscription(message: Message) -> bool:
     return False
 
 
-__all__ = ["is_subscribed", "gate_subscription"]
+__all__ = [
+    "is_subscribed", "gate_subscription",
+    "load_verified", "is_verified", "mark_verified", "revoke_verified",
+    "check_membership", "cached_membership",
+    "recheck_batch", "start_recheck_worker", "stop_recheck_worker",
+]
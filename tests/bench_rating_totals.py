@@ -0,0 +1,70 @@
+# tests/bench_rating_totals.py
+"""
+Чтение рейтингов для приветствия матча при растущей таблице ratings:
+users.rating_sum/rating_count (одно чтение строк пары) против прежнего
+AVG(stars), COUNT(*) по ratings. Запуск вручную:
+    python -m pytest -q -s tests/bench_rating_totals.py
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+
+from app.db import repo
+from app.db.core import close_db, db, init_db, write_many
+
+USERS = 200
+RATINGS = 1_000_000
+ROUNDS = 200
+
+
+async def _greeting_reads() -> float:
+    """Среднее время (мс) чтения статусов/рейтингов пары, кэш строк холодный."""
+    rnd = random.Random(7)
+    t0 = time.perf_counter()
+    for _ in range(ROUNDS):
+        repo._USERS._rows.clear()
+        a, b = rnd.sample(range(1, USERS + 1), 2)
+        rows = await repo.get_users((a, b))
+        repo.format_rating(rows.get(a)), repo.format_rating(rows.get(b))
+    return (time.perf_counter() - t0) / ROUNDS * 1000
+
+
+async def _legacy_avg_reads() -> float:
+    rnd = random.Random(7)
+    t0 = time.perf_counter()
+    for _ in range(ROUNDS // 20):
+        a, b = rnd.sample(range(1, USERS + 1), 2)
+        for uid in (a, b, a, b):  # как прежний start_match: четыре _get_avg_rating
+            async with db() as conn:
+                cur = await conn.execute(
+                    "SELECT AVG(stars), COUNT(*) FROM ratings WHERE to_user=?", (uid,)
+                )
+                await cur.fetchone()
+    return (time.perf_counter() - t0) / (ROUNDS // 20) * 1000
+
+
+async def _run() -> tuple[float, float, float]:
+    await init_db()
+    try:
+        await write_many("INSERT INTO users(tg_id) VALUES(?)", [(u,) for u in range(1, USERS + 1)])
+        empty = await _greeting_reads()
+        rnd = random.Random(1)
+        await write_many(
+            "INSERT INTO ratings(match_id, from_user, to_user, stars) VALUES(?,?,?,?)",
+            ((i, rnd.randint(1, USERS), rnd.randint(1, USERS), rnd.randint(1, 5))
+             for i in range(RATINGS)),
+        )
+        full = await _greeting_reads()
+        legacy = await _legacy_avg_reads()
+        return empty, full, legacy
+    finally:
+        await close_db()
+
+
+def test_match_start_rating_reads_stay_flat(fresh_db: str) -> None:
+    empty, full, legacy = asyncio.run(_run())
+    print(f"\ngreeting reads per pair: {empty:.3f} ms @0 ratings, {full:.3f} ms @{RATINGS} ratings; "
+          f"legacy 4x AVG: {legacy:.1f} ms")
+    assert full < max(empty * 3, 1.0)
@@ -0,0 +1,45 @@
+# tests/bench_sanitize.py
+"""
+Микробенчмарк sanitize_text против прежней цепочки из пяти re.sub на
+реалистичных строках чата (в основном чистых). Запуск вручную:
+    python -m pytest -q -s tests/bench_sanitize.py
+"""
+from __future__ import annotations
+
+import random
+import time
+from typing import Callable, List
+
+from app.services.matching import sanitize_text
+
+from test_sanitize import legacy_sanitize  # tests/ в sys.path (rootdir-импорт pytest)
+
+CLEAN = [
+    "привет", "как дела?", "норм, а у тебя", "с какого ты факультета", "ахаха",
+    "что слушаешь?", "люблю кино и долгие прогулки", "ну такое", "да!", "а ты?",
+]
+DIRTY = [
+    "пиши @nick_name", "мой номер +7 912 345-67-89", "t.me/somebody", "мне 20 лет",
+    "почта a.b@mail.ru",
+]
+N = 200_000
+
+
+def _us_per_msg(fn: Callable[[str], str], lines: List[str]) -> float:
+    t0 = time.perf_counter()
+    for s in lines:
+        fn(s)
+    return (time.perf_counter() - t0) / len(lines) * 1e6
+
+
+def test_sanitize_speed() -> None:
+    rnd = random.Random(3)
+    mixed = [rnd.choice(DIRTY) if rnd.random() < 0.1 else rnd.choice(CLEAN) for _ in range(N)]
+    clean = [rnd.choice(CLEAN) for _ in range(N)]
+    res = {
+        name: (_us_per_msg(legacy_sanitize, lines), _us_per_msg(sanitize_text, lines))
+        for name, lines in (("mixed", mixed), ("clean", clean))
+    }
+    for name, (old, new) in res.items():
+        print(f"\n{name}: legacy {old:.2f} us/msg, gated {new:.2f} us/msg ({old / new:.1f}x)")
+    assert res["clean"][1] < res["clean"][0]
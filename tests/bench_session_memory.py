@@ -0,0 +1,86 @@
+# tests/bench_session_memory.py
+"""
+Память на активный чат при 10k сессий: прежняя раскладка по параллельным
+словарям runtime (+ задача-наблюдатель на матч) против ChatSession.
+Запуск вручную: python -m pytest -q -s tests/bench_session_memory.py
+"""
+from __future__ import annotations
+
+import asyncio
+import gc
+import heapq
+import time
+import tracemalloc
+from typing import Callable
+
+from app.runtime import BY_USER, SESSIONS, open_chat_session
+from app.services import inactivity
+
+N = 10_000
+
+
+def _measure(fill: Callable[[], object]) -> float:
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    keep = fill()
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del keep
+    return used / N
+
+
+async def _legacy_layout() -> float:
+    async def watch(mid: int) -> None:  # как прежний _watch_inactivity: спит до дедлайна
+        await asyncio.sleep(3600)
+
+    def fill() -> object:
+        active, last_seen, deadline, last_shown = {}, {}, {}, {}
+        warned, countdown_msgs, watchers = {}, {}, {}
+        now, wall = time.monotonic(), time.time()
+        for i in range(N):
+            mid, a = 10**6 + i, 10**9 + 2 * i
+            b = a + 1
+            active[a], active[b] = (b, mid), (a, mid)
+            last_seen[a] = last_seen[b] = wall
+            deadline[mid] = now + 180.0
+            last_shown[mid] = 30
+            warned[mid] = True
+            countdown_msgs[mid] = (100000 + i, 200000 + i)
+            watchers[mid] = asyncio.ensure_future(watch(mid))
+        return active, last_seen, deadline, last_shown, warned, countdown_msgs, watchers
+
+    per_chat = _measure(fill)
+    for t in asyncio.all_tasks():
+        if t is not asyncio.current_task():
+            t.cancel()
+    return per_chat
+
+
+async def _session_layout() -> float:
+    def fill() -> object:
+        now = time.monotonic()
+        for i in range(N):
+            mid, a = 10**6 + i, 10**9 + 2 * i
+            s = open_chat_session(mid, a, a + 1, now + 180.0)
+            s.last_shown, s.warned = 30, True
+            s.countdown_msgs = (100000 + i, 200000 + i)
+            s.due = s.deadline - 60
+            heapq.heappush(inactivity._HEAP, (s.due, mid))
+        return None
+
+    try:
+        return _measure(fill)
+    finally:
+        for s in list(SESSIONS.values()):
+            s.close()
+        inactivity._HEAP.clear()
+        BY_USER.clear()
+
+
+def test_bytes_per_active_chat() -> None:
+    legacy = asyncio.run(_legacy_layout())
+    compact = asyncio.run(_session_layout())
+    print(f"\nbytes per active chat @ {N}: legacy dicts+watcher {legacy:.0f} B, "
+          f"ChatSession {compact:.0f} B ({legacy / compact:.1f}x)")
+    assert compact < legacy
@@ -0,0 +1,62 @@
+# tests/conftest.py
+"""
+Общая обвязка тестов. Запуск из корня репозитория: python -m pytest -q
+
+Код импортирует себя как пакет «app» (так его видит main.py), поэтому корень
+репозитория регистрируется под этим именем. БД живёт во временном HOME.
+"""
+from __future__ import annotations
+
+import importlib.util
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+
+os.environ.setdefault("BOT_TOKEN", "123:abc")
+os.environ["HOME"] = tempfile.mkdtemp(prefix="bot-tests-")
+
+if "app" not in sys.modules:
+    _spec = importlib.util.spec_from_file_location(
+        "app", ROOT / "__init__.py", submodule_search_locations=[str(ROOT)]
+    )
+    _app = importlib.util.module_from_spec(_spec)
+    sys.modules["app"] = _app
+    _spec.loader.exec_module(_app)  # type: ignore[union-attr]
+
+
+@pytest.fixture
+def fresh_db() -> str:
+    """Чистый файл БД на тест (init_db/close_db — внутри самого теста)."""
+    from app.config import DB_PATH
+
+    def _rm() -> None:
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(DB_PATH + suffix)
+            except FileNotFoundError:
+                pass
+
+    _rm()
+    yield DB_PATH
+    _rm()
+
+
+@pytest.fixture
+def fresh_outbound(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Пустая исходящая очередь: asyncio-примитивы модуля привязываются к первому циклу."""
+    import asyncio
+
+    from app.services import outbound
+
+    monkeypatch.setattr(outbound, "_WAKE", asyncio.Event())
+    monkeypatch.setattr(outbound, "_SLOTS", [asyncio.Semaphore(8) for _ in range(outbound._N_PRIO)])
+    monkeypatch.setattr(outbound, "_CHATS", {})
+    monkeypatch.setattr(outbound, "_READY", [])
+    monkeypatch.setattr(outbound, "_TIMED", [])
+    monkeypatch.setattr(outbound, "_CTX", {"task": None})
+    monkeypatch.setattr(outbound, "_GLOBAL", outbound._Bucket(outbound.OUTBOUND_GLOBAL_RPS, 1.0))
@@ -0,0 +1,187 @@
+# tests/test_inactivity.py
+from __future__ import annotations
+
+import asyncio
+from typing import List
+
+import pytest
+
+from app import runtime
+from app.runtime import open_chat_session
+from app.services import inactivity
+
+pytestmark = pytest.mark.usefixtures("fresh_outbound")
+
+STUCK = 11  # чат «под flood-wait»: правка в него висит
+
+
+class EditBot:
+    def __init__(self) -> None:
+        self.edited: List[int] = []
+
+    async def edit_message_text(self, chat_id: int, **_: object) -> None:
+        if chat_id == STUCK:
+            await asyncio.sleep(30)
+        self.edited.append(chat_id)
+
+
+async def _noop(*_: object) -> None:
+    return None
+
+
+def test_stuck_chat_does_not_stall_other_countdowns(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def run() -> None:
+        monkeypatch.setattr(inactivity, "_EDITS_WAKE", asyncio.Event())
+        bot = EditBot()
+        inactivity.init_inactivity(bot, _noop, _noop)  # type: ignore[arg-type]
+        sessions = [open_chat_session(1, STUCK, 12, 1e12), open_chat_session(2, 21, 22, 1e12)]
+        for s in sessions:
+            s.warned, s.last_shown, s.countdown_msgs = True, 30, (100, 101)
+            inactivity._queue_edit(s.mid, 30)
+        editor = asyncio.create_task(inactivity._run_editor())
+        try:
+            for _ in range(100):
+                if {21, 22} <= set(bot.edited):
+                    break
+                await asyncio.sleep(0.01)
+            assert {12, 21, 22} <= set(bot.edited)
+            # свежая правка снимает ещё не ушедшую в тот же чат
+            stale = inactivity._EDIT_FUTS[STUCK]
+            sessions[0].last_shown = 20
+            inactivity._queue_edit(1, 20)
+            await asyncio.sleep(0.2)
+            assert stale.cancelled()
+        finally:
+            editor.cancel()
+            for s in sessions:
+                await inactivity._stop_countdown(s.mid, s.a, s.b, delete_msgs=False)
+                s.close()
+
+    asyncio.run(run())
+
+
+def test_failed_activity_flush_keeps_ids_dirty(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def broken_write(*_: object) -> None:
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(inactivity, "write_many", broken_write)
+    live, gone = open_chat_session(5, 51, 52, 1e12), open_chat_session(6, 61, 62, 1e12)
+    try:
+        inactivity.bump_deadline(5)
+        inactivity.bump_deadline(6)
+        gone.close()  # закрытый чат писать уже незачем
+        with pytest.raises(RuntimeError):
+            asyncio.run(inactivity.flush_activity())
+        assert inactivity._ACTIVITY_DIRTY == {5}
+    finally:
+        live.close()
+        inactivity._ACTIVITY_DIRTY.clear()
+
+
+# ====== Куча сроков: фейковые часы, настоящий _run_scheduler ======
+
+T0 = 10_000.0
+TIMEOUT = 300
+
+
+class Harness:
+    """Часы под контролем теста; побочные эффекты _on_due пишутся в events."""
+    def __init__(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        self.now = T0
+        self.events: List[tuple] = []
+        m = monkeypatch
+        m.setattr(inactivity, "_nowm", lambda: self.now)
+        m.setattr(inactivity, "g_inactivity", lambda: TIMEOUT)
+        m.setattr(inactivity, "_HEAP", [])
+        m.setattr(inactivity, "_WAKE", asyncio.Event())
+        m.setattr(inactivity, "_EDITS_WAKE", asyncio.Event())
+        m.setattr(inactivity, "ACTIVITY_FLUSH_SECONDS", 3600)
+        m.setattr(inactivity, "_CTX", {**inactivity._CTX, "task": None, "editor": None, "activity": None})
+        m.setattr(inactivity, "_queue_edit", lambda mid, rem: self.events.append(("edit", mid, rem)))
+
+        async def warn(s, remaining: int) -> None:
+            self.events.append(("warn", s.mid, remaining))
+
+        async def expire(s) -> None:
+            self.events.append(("expire", s.mid))
+
+        async def stop(mid: int, a: int, b: int, *, delete_msgs: bool = True) -> None:
+            self.events.append(("stop", mid))
+
+        m.setattr(inactivity, "_warn", warn)
+        m.setattr(inactivity, "_expire", expire)
+        m.setattr(inactivity, "_stop_countdown", stop)
+
+    def open(self, mid: int):
+        s = open_chat_session(mid, mid * 10 + 1, mid * 10 + 2, self.now + TIMEOUT)
+        inactivity.schedule_match(s)
+        return s
+
+    async def at(self, offset: float) -> List[tuple]:
+        """Перевести часы на T0+offset, дать планировщику отработать; новые события."""
+        seen = len(self.events)
+        self.now = T0 + offset
+        inactivity._WAKE.set()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        return self.events[seen:]
+
+
+def _run_with(monkeypatch: pytest.MonkeyPatch, scenario) -> None:
+    async def run() -> None:
+        h = Harness(monkeypatch)
+        try:
+            await scenario(h)
+        finally:
+            inactivity.stop_inactivity_scheduler()
+            for s in list(runtime.SESSIONS.values()):
+                s.close()
+
+    asyncio.run(run())
+
+
+def test_warn_then_countdown_steps_then_expiry(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def scenario(h: Harness) -> None:
+        h.open(1)
+        assert await h.at(239) == []
+        assert await h.at(240) == [("warn", 1, 60)]
+        assert await h.at(269) == []
+        assert await h.at(270) == [("edit", 1, 30)]
+        assert await h.at(290) == [("edit", 1, 10)]
+        assert await h.at(295) == [("edit", 1, 5)]
+        assert await h.at(299.5) == []
+        assert await h.at(300) == [("expire", 1)]
+        assert inactivity._HEAP == []  # после закрытия ничего не взведено
+
+    _run_with(monkeypatch, scenario)
+
+
+def test_bump_rearms_lazily_and_clears_countdown(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def scenario(h: Harness) -> None:
+        s = h.open(1)
+        await h.at(100)
+        inactivity.bump_deadline(1)                 # дедлайн -> T0+400
+        assert inactivity._HEAP == [(T0 + 240, 1)]  # куча не тронута: O(1) продление
+        assert await h.at(240) == []                # старая запись лишь перевзводит
+        assert s.due == T0 + 340
+        assert await h.at(340) == [("warn", 1, 60)]
+        await h.at(350)
+        inactivity.bump_deadline(1)                 # отсчёт на экране — снять сразу
+        assert await h.at(350) == [("stop", 1)]
+        assert s.due == T0 + 350 + TIMEOUT - inactivity.WARN_SECONDS
+
+    _run_with(monkeypatch, scenario)
+
+
+def test_closed_matches_never_fire(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def scenario(h: Harness) -> None:
+        h.open(1)
+        h.open(2)
+        h.open(3)
+        inactivity._cleanup_match(1, 11, 12)        # закрыт до предупреждения
+        assert await h.at(240) == [("warn", 2, 60), ("warn", 3, 60)]
+        inactivity._cleanup_match(2, 21, 22)        # закрыт во время отсчёта
+        assert await h.at(270) == [("edit", 3, 30)]
+        assert await h.at(1000) == [("expire", 3)]  # проспали отметки — сразу закрытие
+
+    _run_with(monkeypatch, scenario)
@@ -0,0 +1,242 @@
+# tests/test_matching.py
+from __future__ import annotations
+
+import asyncio
+import random
+
+import pytest
+
+from app import runtime
+from app.db.core import close_db, db, init_db, write, write_many
+from app.services import inactivity, matching
+
+
+@pytest.fixture
+def clean_blocks() -> None:
+    runtime.BLOCKS.clear()
+    runtime.BLOCKS_DIRTY.clear()
+    yield
+    runtime.BLOCKS.clear()
+    runtime.BLOCKS_DIRTY.clear()
+
+
+def test_stop_during_blocks_write_keeps_rows(
+    fresh_db: str, clean_blocks: None, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Остановка, пока фоновый сброс ждёт писателя: финальный сброс всё равно пишет."""
+    real_write_tx = matching.write_tx
+
+    async def run() -> set:
+        await init_db()
+        try:
+            in_write = asyncio.Event()
+
+            async def stuck_once(job):
+                monkeypatch.setattr(matching, "write_tx", real_write_tx)
+                in_write.set()
+                await asyncio.Event().wait()  # писатель занят — ждём, пока не отменят
+
+            monkeypatch.setattr(matching, "write_tx", stuck_once)
+            await matching.record_separation(1, 2)
+            matching._CTX["blocks_flusher"] = asyncio.create_task(matching.flush_blocks())
+            await in_write.wait()
+            await matching.stop_blocks_flusher()
+            async with db() as conn:
+                cur = await conn.execute("SELECT u_id, partner_id FROM recent_partners")
+                return {tuple(r) for r in await cur.fetchall()}
+        finally:
+            await close_db()
+
+    assert asyncio.run(run()) == {(1, 2), (2, 1)}
+    assert not runtime.BLOCKS_DIRTY
+
+
+def test_restore_logs_failed_expiry_notices(
+    fresh_db: str, monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture
+) -> None:
+    """Уведомления о чатах, истёкших за время простоя, — отслеживаемая задача с логом сбоя."""
+    async def broken_notify(pairs) -> None:
+        assert list(pairs) == [(1, 10, 20)]
+        raise RuntimeError("bot is down")
+
+    monkeypatch.setattr(matching, "notify_expired", broken_notify)
+    monkeypatch.setattr(matching, "schedule_many", lambda sessions: None)
+
+    async def run() -> int:
+        await init_db()
+        try:
+            await write_many(
+                "INSERT INTO matches(id, a_id, b_id, active, last_activity) VALUES(?,?,?,1,?)",
+                [(1, 10, 20, 1)],  # простаивал с 1970-го
+            )
+            await write_many(
+                "INSERT INTO active_sessions(user_id, peer_id, match_id) VALUES(?,?,?)",
+                [(10, 20, 1), (20, 10, 1)],
+            )
+            restored = await matching.restore_sessions()
+            assert len(inactivity._BG) == 1  # задача под ссылкой, GC её не заберёт
+            await asyncio.wait(set(inactivity._BG))
+            await asyncio.sleep(0)
+            return restored
+        finally:
+            await close_db()
+
+    with caplog.at_level("ERROR", logger=inactivity.log.name):
+        assert asyncio.run(run()) == 0
+    assert "broken_notify failed" in caplog.text
+    assert not inactivity._BG
+
+
+def test_tick_rolls_back_match_whose_session_failed_to_open(
+    fresh_db: str, clean_blocks: None, monkeypatch: pytest.MonkeyPatch,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    real_decay = matching.decay_blocks
+
+    async def flaky_decay(uid: int) -> None:
+        if uid == 1:  # сбой посреди _open_session: RAM-сессия уже поднята
+            raise RuntimeError("database is locked")
+        await real_decay(uid)
+
+    async def no_greet(*_: object) -> None:
+        return None
+
+    monkeypatch.setattr(matching, "decay_blocks", flaky_decay)
+    monkeypatch.setattr(matching, "_greet", no_greet)
+    monkeypatch.setattr(matching, "schedule_match", lambda s: None)
+    monkeypatch.setattr(matching, "_INDEX", matching.MatchIndex())
+    monkeypatch.setattr(matching, "_ENQUEUED_AT", {})
+    matching.init_matching(object(), no_greet, no_greet)  # type: ignore[arg-type]
+
+    async def run():
+        await init_db()
+        try:
+            users = [(1, "Парень", "Девушки"), (2, "Девушка", "Парни"),
+                     (3, "Парень", "Девушки"), (4, "Девушка", "Парни")]
+            await write_many("INSERT INTO users(tg_id, gender, seeking) VALUES(?,?,?)", users)
+            for u in users:
+                await matching.enqueue(*u)
+            opened = await matching.run_matching_tick()
+            async with db() as conn:
+                cur = await conn.execute("SELECT a_id, b_id FROM matches WHERE active=1")
+                live = [tuple(r) for r in await cur.fetchall()]
+                cur = await conn.execute("SELECT user_id FROM active_sessions ORDER BY user_id")
+                sess = [r[0] for r in await cur.fetchall()]
+                cur = await conn.execute("SELECT tg_id FROM queue ORDER BY tg_id")
+                queued = [r[0] for r in await cur.fetchall()]
+            return opened, live, sess, queued
+        finally:
+            await close_db()
+
+    try:
+        with caplog.at_level("ERROR", logger=matching.log.name):
+            opened, live, sess, queued = asyncio.run(run())
+        assert opened == 1 and live == [(3, 4)] and sess == [3, 4]
+        assert queued == [1, 2]                       # неоткрывшийся матч — обратно в поиск
+        assert 1 in matching._INDEX and 2 in matching._INDEX
+        assert runtime.session_of(1) is None and runtime.session_of(2) is None
+        assert "opening match" in caplog.text
+    finally:
+        runtime.SESSIONS.clear()
+        runtime.BY_USER.clear()
+
+
+# ====== MatchIndex против прежнего find_partner (SQL-join по queue) ======
+
+LEGACY_FIND_PARTNER = """
+    SELECT q.tg_id
+    FROM queue q
+    JOIN users u ON u.tg_id=q.tg_id
+    LEFT JOIN recent_partners rp
+           ON rp.u_id=? AND rp.partner_id=q.tg_id AND rp.block_left>0
+    WHERE q.tg_id<>?
+      AND ((?='Не важно') OR u.gender=CASE ? WHEN 'Парни' THEN 'Парень' WHEN 'Девушки' THEN 'Девушка' END)
+      AND (u.seeking='Не важно' OR u.seeking=CASE ? WHEN 'Парень' THEN 'Парни' WHEN 'Девушка' THEN 'Девушки' END)
+      AND rp.partner_id IS NULL
+    ORDER BY q.ts ASC
+    LIMIT 1
+"""
+
+M, F = "Парень", "Девушка"
+SEEK_M, SEEK_F, ANY = "Парни", "Девушки", "Не важно"
+
+# (название, очередь [(uid, пол, ищет)] в порядке прихода, ищущий, блоки ищущего, ожидаемый)
+CASES = [
+    ("m->f oldest", [(2, F, SEEK_M), (3, F, SEEK_M)], (1, M, SEEK_F), [], 2),
+    ("f->m skips f", [(2, F, SEEK_M), (3, M, SEEK_F)], (1, F, SEEK_M), [], 3),
+    ("any picks oldest compatible", [(2, M, SEEK_M), (3, F, ANY)], (1, M, ANY), [], 2),
+    ("candidate wants other gender", [(2, F, SEEK_F)], (1, M, SEEK_F), [], None),
+    ("candidate seeks any", [(2, F, ANY)], (1, M, SEEK_F), [], 2),
+    ("self is excluded", [(1, M, SEEK_M), (2, M, SEEK_M)], (1, M, SEEK_M), [], 2),
+    ("blocked partner skipped", [(2, F, SEEK_M), (3, F, SEEK_M)], (1, M, SEEK_F), [(2, 2)], 3),
+    ("spent block ignored", [(2, F, SEEK_M)], (1, M, SEEK_F), [(2, 0)], 2),
+    ("only blocked left", [(2, F, SEEK_M)], (1, M, SEEK_F), [(2, 1)], None),
+    ("no prefs searcher", [(2, F, SEEK_M), (3, F, ANY)], (1, None, None), [], None),
+    ("no gender, wants f", [(2, F, SEEK_M), (3, F, ANY)], (1, None, SEEK_F), [], 3),
+    ("candidate without prefs", [(2, None, None), (3, F, ANY)], (1, M, ANY), [], 3),
+    ("empty queue", [], (1, M, ANY), [], None),
+]
+
+
+async def _legacy_and_index(queue, searcher, blocks, extra_users=()):
+    """Засеять БД и MatchIndex одинаково; вернуть (выбор SQL, выбор индекса)."""
+    uid, gender, seeking = searcher
+    users = {u: (g, s) for u, g, s in [*queue, searcher, *extra_users]}
+    await write_many("INSERT INTO users(tg_id, gender, seeking) VALUES(?,?,?)",
+                     [(u, g, s) for u, (g, s) in users.items()])
+    await write_many("INSERT INTO queue(tg_id, gender, seeking, ts) VALUES(?,?,?,?)",
+                     [(u, g, s, 1000 + i) for i, (u, g, s) in enumerate(queue)])
+    await write_many("INSERT INTO recent_partners(u_id, partner_id, block_left) VALUES(?,?,?)",
+                     [(uid, p, left) for p, left in blocks])
+    async with db() as conn:
+        cur = await conn.execute(LEGACY_FIND_PARTNER,
+                                 (uid, uid, seeking or "", seeking or "", gender or ""))
+        row = await cur.fetchone()
+    index = matching.MatchIndex()
+    for u, g, s in queue:
+        index.add(u, g, s)
+    blocked = {p for p, left in blocks if left > 0}
+    return (int(row[0]) if row else None), index.find(uid, gender or "", seeking or "", blocked)
+
+
+@pytest.mark.parametrize("name, queue, searcher, blocks, expected", CASES, ids=[c[0] for c in CASES])
+def test_index_pick_matches_legacy_join(fresh_db: str, name, queue, searcher, blocks, expected) -> None:
+    async def run():
+        await init_db()
+        try:
+            return await _legacy_and_index(queue, searcher, blocks)
+        finally:
+            await close_db()
+
+    legacy, picked = asyncio.run(run())
+    assert legacy == expected
+    assert picked == expected
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_index_pick_matches_legacy_join_random(fresh_db: str, seed: int) -> None:
+    """Случайное население: для каждого ищущего выбор индекса совпадает с SQL."""
+    rnd = random.Random(seed)
+    genders, seeks = (M, F, None), (SEEK_M, SEEK_F, ANY, None)
+    people = [(u, rnd.choice(genders), rnd.choice(seeks)) for u in range(1, 81)]
+    queue = rnd.sample(people, 50)
+
+    async def run():
+        await init_db()
+        mismatches, hits = [], 0
+        try:
+            for searcher in people:
+                blocks = [(p, rnd.randint(0, 3)) for p, _, _ in rnd.sample(queue, 5)]
+                for table in ("users", "queue", "recent_partners"):
+                    await write(f"DELETE FROM {table}")
+                legacy, picked = await _legacy_and_index(queue, searcher, blocks, people)
+                hits += legacy is not None
+                if legacy != picked:
+                    mismatches.append((searcher, legacy, picked))
+        finally:
+            await close_db()
+        return mismatches, hits
+
+    mismatches, hits = asyncio.run(run())
+    assert not mismatches
+    assert hits > 20  # корпус не вырожден: кандидаты действительно находятся
@@ -0,0 +1,116 @@
+# tests/test_matching_claims.py
+"""
+Стресс подбора: тысячи параллельных постановок/поисков и пересекающихся
+claim'ов через писателя. Инвариант — у каждого не больше одного живого матча,
+active_sessions симметрична и совпадает с живыми матчами, сматченных нет в queue.
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+
+import pytest
+
+from app import runtime
+from app.db.core import close_db, db, init_db, write_many
+from app.services import matching
+
+GENDERS = ("Парень", "Девушка")
+SEEKS = ("Парни", "Девушки", "Не важно")
+
+
+@pytest.fixture
+def quiet_matching(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Без приветствий и планировщика молчания: проверяем только claim'ы."""
+    async def no_greet(*_: object) -> None:
+        return None
+
+    monkeypatch.setattr(matching, "_greet", no_greet)
+    monkeypatch.setattr(matching, "schedule_match", lambda s: None)
+    monkeypatch.setattr(matching, "_INDEX", matching.MatchIndex())
+    monkeypatch.setattr(matching, "_ENQUEUED_AT", {})
+    matching.init_matching(object(), no_greet, no_greet)  # type: ignore[arg-type]
+    yield
+    runtime.SESSIONS.clear()
+    runtime.BY_USER.clear()
+    runtime.BLOCKS.clear()
+    runtime.BLOCKS_DIRTY.clear()
+
+
+async def _check_invariants() -> int:
+    async with db() as conn:
+        cur = await conn.execute("SELECT id, a_id, b_id FROM matches WHERE active=1")
+        live = await cur.fetchall()
+        cur = await conn.execute("SELECT user_id, peer_id, match_id FROM active_sessions")
+        sessions = {int(u): (int(p), int(mid)) for u, p, mid in await cur.fetchall()}
+        cur = await conn.execute("SELECT tg_id FROM queue")
+        queued = {int(r[0]) for r in await cur.fetchall()}
+    seen: set[int] = set()
+    for mid, a, b in live:
+        assert a != b
+        assert a not in seen and b not in seen, f"user in two live matches (match {mid})"
+        seen.update((a, b))
+        assert sessions.get(a) == (b, mid) and sessions.get(b) == (a, mid)
+    assert set(sessions) == seen
+    assert not seen & queued
+    return len(live)
+
+
+async def _users(n: int, rnd: random.Random) -> list[tuple[int, str, str]]:
+    rows = [(uid, rnd.choice(GENDERS), rnd.choice(SEEKS)) for uid in range(1, n + 1)]
+    await write_many("INSERT INTO users(tg_id, gender, seeking) VALUES(?,?,?)", rows)
+    return rows
+
+
+def test_overlapping_claims_never_double_book(fresh_db: str, quiet_matching: None) -> None:
+    """Писатель — единственная защита: пары пересекаются как угодно."""
+    async def run() -> int:
+        await init_db()
+        try:
+            rnd = random.Random(12)
+            users = await _users(400, rnd)
+            await write_many(
+                "INSERT INTO queue(tg_id, gender, seeking, ts) VALUES(?,?,?,0)", users
+            )
+            ids = [u for u, _, _ in users]
+            pairs = [tuple(rnd.sample(ids, 2)) for _ in range(3000)]
+            chunks = [pairs[i:i + rnd.randint(1, 8)] for i in range(0, len(pairs), 8)]
+            results = await asyncio.gather(*(matching._create_matches(c) for c in chunks))
+            created = sum(mid is not None for batch in results for mid, _ in batch)
+            assert created == await _check_invariants()
+            return created
+        finally:
+            await close_db()
+
+    assert asyncio.run(run()) > 100
+
+
+def test_concurrent_search_matches_each_user_once(fresh_db: str, quiet_matching: None) -> None:
+    """Тысячи «Найти собеседника» разом вперемешку с тиками пакетного подбора."""
+    async def run() -> None:
+        await init_db()
+        try:
+            rnd = random.Random(34)
+            users = await _users(3000, rnd)
+
+            async def search(uid: int, gender: str, seeking: str) -> None:
+                await asyncio.sleep(rnd.random() / 100)
+                await matching.enqueue(uid, gender, seeking)
+                await matching.try_match_now(uid)
+
+            async def ticks() -> None:
+                for _ in range(20):
+                    await matching.run_matching_tick()
+                    await asyncio.sleep(0.002)
+
+            await asyncio.gather(*(search(*u) for u in users), ticks(), ticks())
+            live = await _check_invariants()
+            assert live > 1000
+            # RAM совпадает с БД: каждый в BY_USER ровно в своей сессии
+            assert len(runtime.SESSIONS) == live
+            for s in runtime.SESSIONS.values():
+                assert runtime.BY_USER[s.a] is s and runtime.BY_USER[s.b] is s
+        finally:
+            await close_db()
+
+    asyncio.run(run())
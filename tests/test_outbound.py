@@ -0,0 +1,155 @@
+# tests/test_outbound.py
+from __future__ import annotations
+
+import asyncio
+from typing import List, Tuple
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from app.services import outbound
+
+
+pytestmark = pytest.mark.usefixtures("fresh_outbound")
+
+
+def _flood(retry_after: int) -> TelegramRetryAfter:
+    return TelegramRetryAfter(
+        method=SendMessage(chat_id=1, text="x"), message="Too Many Requests",
+        retry_after=retry_after,
+    )
+
+
+def test_retry_after_without_retry_still_freezes_chat() -> None:
+    async def run() -> None:
+        async def edit(**_: object) -> None:
+            raise _flood(30)
+
+        with pytest.raises(TelegramRetryAfter):
+            await outbound.send(edit, chat_id=1, retry=False)
+        ch = outbound._CHATS[1]
+        assert ch.hold - outbound._mono() > 25
+        assert not ch.jobs
+        await outbound.stop_outbound(0)
+
+    asyncio.run(run())
+
+
+def test_retry_after_requeues_job_at_head() -> None:
+    calls = []
+
+    async def run() -> None:
+        async def flaky(**kw: object) -> str:
+            calls.append(kw["text"])
+            if len(calls) == 1:
+                raise _flood(0)
+            return str(kw["text"])
+
+        a = asyncio.create_task(outbound.send(flaky, chat_id=1, text="a"))
+        b = asyncio.create_task(outbound.send(flaky, chat_id=1, text="b"))
+        assert await asyncio.wait_for(asyncio.gather(a, b), 10) == ["a", "b"]
+        await outbound.stop_outbound(0)
+
+    asyncio.run(run())
+    assert calls == ["a", "a", "b"]
+
+
+def test_submit_text_returns_before_delivery_and_logs_failure(
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    async def run() -> None:
+        gate = asyncio.Event()
+
+        class Bot:
+            async def send_message(self, chat_id: int, text: str, **_: object) -> None:
+                await gate.wait()
+                raise RuntimeError("bot was blocked by the user")
+
+        fut = await asyncio.wait_for(outbound.submit_text(Bot(), 7, "Собеседник завершил чат."), 1)
+        assert not fut.done()  # вызывающий (и его замок) не ждали доставки
+        gate.set()
+        await asyncio.wait_for(asyncio.wait({fut}), 5)
+        await asyncio.sleep(0)
+        await outbound.stop_outbound(0)
+
+    with caplog.at_level("WARNING", logger=outbound.log.name):
+        asyncio.run(run())
+    assert "message to 7 failed" in caplog.text
+
+
+class Recorder:
+    """Фейковый метод Bot API: пишет (chat_id, метка, время вызова)."""
+    def __init__(self) -> None:
+        self.calls: List[Tuple[int, str, float]] = []
+
+    async def __call__(self, chat_id: int, tag: str = "", **_: object) -> None:
+        self.calls.append((chat_id, tag, asyncio.get_running_loop().time()))
+
+    def times(self, chat_id: int) -> List[float]:
+        return [t for c, _, t in self.calls if c == chat_id]
+
+
+def _rates(monkeypatch: pytest.MonkeyPatch, *, chat_rps: float, burst: int, global_rps: float) -> None:
+    monkeypatch.setattr(outbound, "OUTBOUND_CHAT_RPS", chat_rps)
+    monkeypatch.setattr(outbound, "OUTBOUND_CHAT_BURST", burst)
+    monkeypatch.setattr(outbound, "_GLOBAL", outbound._Bucket(global_rps, 1.0))
+
+
+def test_chat_bucket_allows_burst_then_paces(monkeypatch: pytest.MonkeyPatch) -> None:
+    _rates(monkeypatch, chat_rps=20, burst=3, global_rps=1000)
+    rec = Recorder()
+
+    async def run() -> None:
+        await asyncio.gather(
+            *(outbound.send(rec, chat_id=1) for _ in range(8)),
+            *(outbound.send(rec, chat_id=2) for _ in range(3)),
+        )
+        await outbound.stop_outbound(0)
+
+    asyncio.run(run())
+    one, two = rec.times(1), rec.times(2)
+    t0 = min(one + two)
+    assert one[2] - t0 < 0.04                        # всплеск OUTBOUND_CHAT_BURST — сразу
+    gaps = [b - a for a, b in zip(one[2:], one[3:])]
+    assert min(gaps) > 0.035                         # дальше ~1/OUTBOUND_CHAT_RPS
+    assert max(two) - t0 < 0.04                      # соседний чат своей очереди не ждёт
+
+
+def test_global_bucket_caps_total_rate(monkeypatch: pytest.MonkeyPatch) -> None:
+    _rates(monkeypatch, chat_rps=1000, burst=10, global_rps=20)
+    rec = Recorder()
+
+    async def run() -> None:
+        await asyncio.gather(*(outbound.send(rec, chat_id=c) for c in range(10)))
+        await outbound.stop_outbound(0)
+
+    asyncio.run(run())
+    ts = sorted(t for _, _, t in rec.calls)
+    gaps = [b - a for a, b in zip(ts, ts[1:])]
+    assert min(gaps) > 0.035          # без всплеска: ровно ~1/OUTBOUND_GLOBAL_RPS
+    assert ts[-1] - ts[0] > 0.4
+
+
+def test_relay_and_greeting_overtake_queued_broadcast(monkeypatch: pytest.MonkeyPatch) -> None:
+    _rates(monkeypatch, chat_rps=1000, burst=10, global_rps=20)
+    rec = Recorder()
+
+    async def run() -> None:
+        bulk = [asyncio.create_task(outbound.send(rec, chat_id=c, tag="broadcast",
+                                                  prio=outbound.P_BROADCAST))
+                for c in range(100, 120)]
+        await asyncio.sleep(0.12)  # рассылка уже идёт
+        await asyncio.gather(
+            outbound.send(rec, chat_id=2, tag="greeting", prio=outbound.P_GREETING),
+            outbound.send(rec, chat_id=1, tag="relay", prio=outbound.P_RELAY),
+        )
+        for t in bulk:
+            t.cancel()
+        await outbound.stop_outbound(0)
+
+    asyncio.run(run())
+    order = [tag for _, tag, _ in rec.calls]
+    first = order.index("relay")
+    assert order[first:first + 2] == ["relay", "greeting"]
+    assert 0 < first < 6  # встали перед оставшейся рассылкой, не дождавшись её
@@ -0,0 +1,102 @@
+# tests/test_query_plans.py
+"""EXPLAIN QUERY PLAN горячих запросов: ни одного полного SCAN по users/matches/queue."""
+from __future__ import annotations
+
+import asyncio
+import os
+import re
+
+import pytest
+
+from app.db.core import close_db, db, init_db
+
+# Запросы ровно в том виде, в каком их выполняют matching/chat/admin/repo/main.
+HOT_QUERIES = {
+    "active_peer": ("SELECT peer_id FROM active_sessions WHERE user_id=?", (1,)),
+    "materialize": ("SELECT peer_id, match_id FROM active_sessions WHERE user_id=?", (1,)),
+    "end_current_chat": (
+        "UPDATE matches SET active=0 "
+        "WHERE id IN (SELECT match_id FROM active_sessions WHERE user_id=?)", (1,)),
+    "claim_pair": (
+        "SELECT tg_id FROM queue WHERE tg_id IN (?,?) "
+        "AND tg_id NOT IN (SELECT user_id FROM active_sessions WHERE user_id IN (?,?))",
+        (1, 2, 1, 2)),
+    "dequeue_pair": ("DELETE FROM queue WHERE tg_id IN (?,?)", (1, 2)),
+    "reveal": (
+        "SELECT m.id,m.a_id,m.b_id,m.a_reveal,m.b_reveal "
+        "FROM active_sessions s JOIN matches m ON m.id=s.match_id "
+        "WHERE s.user_id=?", (1,)),
+    "restore_sessions": (
+        "SELECT s.match_id, s.user_id, s.peer_id, "
+        "COALESCE(m.last_activity, m.started_at, s.started_at) "
+        "FROM active_sessions s JOIN matches m ON m.id=s.match_id "
+        "WHERE s.user_id < s.peer_id", ()),
+    "last_match_info": (
+        "SELECT id, a_id, b_id, active FROM matches "
+        "WHERE a_id=? OR b_id=? ORDER BY id DESC LIMIT 1", (1, 1)),
+    "fix_stale_chats": (
+        "UPDATE matches SET active=0 WHERE id IN "
+        "(SELECT match_id FROM active_sessions WHERE started_at < strftime('%s','now') - 86400)",
+        ()),
+    "open_support_threads": (
+        "SELECT from_user, MAX(ts) AS last_ts FROM support_msgs WHERE status='open' "
+        "GROUP BY from_user ORDER BY last_ts DESC LIMIT ?", (10,)),
+    "count_referrals": ("SELECT COUNT(*) FROM referrals WHERE inviter=?", (1,)),
+    "purchases_total": (
+        "SELECT COALESCE(SUM(si.price),0) FROM purchases p "
+        "JOIN shop_items si ON si.id=p.item_id WHERE p.user_id=?", (1,)),
+    "purchases_last": (
+        "SELECT si.name FROM purchases p JOIN shop_items si ON si.id=p.item_id "
+        "WHERE p.user_id=? ORDER BY p.ts DESC LIMIT 5", (1,)),
+    "role_index": ("SELECT tg_id FROM users WHERE role='admin'", ()),
+    "user_by_id": ("SELECT tg_id FROM users WHERE tg_id=?", (1,)),
+}
+
+GUARDED = {"users", "matches", "queue", "support_msgs", "purchases", "referrals"}
+ALIASES = {"m": "matches", "s": "active_sessions", "p": "purchases", "si": "shop_items"}
+_SCAN_RE = re.compile(r"^SCAN (\w+)")
+
+
+async def _plans() -> dict[str, list[str]]:
+    await init_db()
+    try:
+        out: dict[str, list[str]] = {}
+        async with db() as conn:
+            for name, (sql, params) in HOT_QUERIES.items():
+                cur = await conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+                out[name] = [str(r[3]) for r in await cur.fetchall()]
+        return out
+    finally:
+        await close_db()
+
+
+@pytest.fixture(scope="module")
+def plans() -> dict[str, list[str]]:
+    from app.config import DB_PATH
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(DB_PATH + suffix):
+            os.remove(DB_PATH + suffix)
+    return asyncio.run(_plans())
+
+
+@pytest.mark.parametrize("name", sorted(HOT_QUERIES))
+def test_no_full_scan(plans: dict[str, list[str]], name: str) -> None:
+    for detail in plans[name]:
+        m = _SCAN_RE.match(detail)
+        if m:
+            table = ALIASES.get(m.group(1), m.group(1))
+            assert table not in GUARDED, f"{name}: {detail}"
+
+
+def test_detects_scan_without_index(fresh_db: str) -> None:
+    """Самопроверка: без idx_queue_ts сортировка очереди — полный SCAN queue."""
+    async def plan() -> list[str]:
+        await init_db()
+        try:
+            async with db() as conn:
+                await conn.execute("DROP INDEX idx_queue_ts")
+                cur = await conn.execute("EXPLAIN QUERY PLAN SELECT tg_id FROM queue ORDER BY ts")
+                return [str(r[3]) for r in await cur.fetchall()]
+        finally:
+            await close_db()
+    assert any(_SCAN_RE.match(d) and "queue" in d for d in asyncio.run(plan()))
@@ -0,0 +1,112 @@
+# tests/test_relay.py
+from __future__ import annotations
+
+import asyncio
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+
+import pytest
+from aiogram.enums import ContentType
+
+from app.middlewares.ordering import KeyedLocks
+from app.runtime import open_chat_session
+from app.services.relay import flush_pending_album, relay_message
+
+pytestmark = pytest.mark.usefixtures("fresh_outbound")
+
+A, B = 101, 202
+
+
+class FakeBot:
+    """Чат B «медленный» (как под flood-wait), чат A отвечает сразу."""
+    def __init__(self) -> None:
+        self.delivered: Dict[int, float] = {}
+
+    async def send_message(self, chat_id: int, text: str, **_: object) -> None:
+        if chat_id == B:
+            await asyncio.sleep(1.0)
+        self.delivered[chat_id] = asyncio.get_running_loop().time()
+
+
+def _text(bot: FakeBot, sender: int, text: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        bot=bot, chat=SimpleNamespace(id=sender), from_user=SimpleNamespace(id=sender),
+        message_id=1, content_type=ContentType.TEXT, text=text, caption=None,
+        media_group_id=None,
+    )
+
+
+def test_match_lock_is_released_once_relay_is_enqueued() -> None:
+    async def run() -> None:
+        bot, locks = FakeBot(), KeyedLocks()
+        loop = asyncio.get_running_loop()
+
+        async def handle(sender: int, peer: int, text: str) -> None:
+            async with locks.hold(("match", 1)):  # как OrderedUpdates для живого чата
+                await relay_message(_text(bot, sender, text), peer)
+
+        t0 = loop.time()
+        await handle(A, B, "привет")    # доставка в B займёт секунду
+        await handle(B, A, "и тебе")    # не должна её ждать
+        while len(bot.delivered) < 2:
+            await asyncio.sleep(0.01)
+        assert bot.delivered[A] - t0 < 0.5
+        assert bot.delivered[B] - t0 >= 1.0
+
+    asyncio.run(run())
+
+
+class RecordingBot:
+    def __init__(self) -> None:
+        self.calls: List[Tuple[str, int]] = []
+
+    async def send_message(self, chat_id: int, **_: object) -> None:
+        self.calls.append(("text", chat_id))
+
+    async def send_media_group(self, chat_id: int, media: list, **_: object) -> None:
+        self.calls.append((f"album/{len(media)}", chat_id))
+
+
+def _photo(bot: RecordingBot, sender: int, n: int) -> SimpleNamespace:
+    return SimpleNamespace(
+        bot=bot, chat=SimpleNamespace(id=sender), from_user=SimpleNamespace(id=sender),
+        message_id=n, content_type=ContentType.PHOTO, photo=[SimpleNamespace(file_id=f"f{n}")],
+        video=None, document=None, audio=None, caption=None, media_group_id="g1",
+    )
+
+
+async def _drain(bot: RecordingBot, n: int) -> None:
+    while len(bot.calls) < n:
+        await asyncio.sleep(0.01)
+
+
+def test_text_after_album_does_not_overtake_it() -> None:
+    async def run() -> None:
+        bot = RecordingBot()
+        s = open_chat_session(1, A, B, deadline=1e12)
+        try:
+            for n in (1, 2, 3):
+                await relay_message(_photo(bot, A, n), B)
+            # как relay_chat перед не-альбомным сообщением (окно альбома не истекло)
+            await flush_pending_album(A)
+            await relay_message(_text(bot, A, "смотри"), B)
+            await asyncio.wait_for(_drain(bot, 2), 5)
+        finally:
+            s.close()
+        assert bot.calls == [("album/3", B), ("text", B)]
+
+    asyncio.run(run())
+
+
+def test_album_survives_stop_after_flush() -> None:
+    async def run() -> None:
+        bot = RecordingBot()
+        s = open_chat_session(2, A, B, deadline=1e12)
+        for n in (1, 2):
+            await relay_message(_photo(bot, B, n), A)
+        await flush_pending_album(B)  # !stop от A: альбом собеседника досылается
+        s.close()                     # ...и только потом чат кончается
+        await asyncio.wait_for(_drain(bot, 1), 5)
+        assert bot.calls == [("album/2", A)]
+
+    asyncio.run(run())
@@ -0,0 +1,68 @@
+# tests/test_sanitize.py
+"""
+sanitize_text с подсказками должна совпадать с прежней цепочкой из пяти re.sub
+символ в символ: золотой корпус (с ожидаемыми строками) + случайный фазз.
+"""
+from __future__ import annotations
+
+import random
+
+import pytest
+
+from app.services.matching import (
+    MAIL_RE, PHON_RE, TGID_RE, TME_RE, USER_RE, sanitize_text,
+)
+
+
+def legacy_sanitize(s: str) -> str:
+    """Цепочка до введения подсказок (эталон)."""
+    s = TGID_RE.sub('[hidden]', s)
+    s = TME_RE.sub('[link hidden]', s)
+    s = USER_RE.sub('@hidden', s)
+    s = MAIL_RE.sub('[email hidden]', s)
+    s = PHON_RE.sub('[phone hidden]', s)
+    return s
+
+
+GOLDEN = [
+    ("", ""),
+    ("привет, как дела?", "привет, как дела?"),
+    ("мне 19 лет", "мне 19 лет"),
+    ("12345678", "12345678"),
+    ("a@b", "a@b"),
+    ("пиши @durov_bot", "пиши @hidden"),
+    ("mail me: a.b-c@mail.ru ok", "mail me: [email hidden] ok"),
+    ("@user@mail.ru", "@[email hidden]"),
+    ("tg://user?id=12345", "[hidden]"),
+    ("TG://USER?ID=9", "[hidden]"),
+    ("https://t.me/joinchat/AAA", "[link hidden]"),
+    ("T.ME/Someone", "[link hidden]"),
+    ("a@b.t.me/zz", "a@b.[link hidden]"),  # порядок проходов: ссылка раньше почты
+    ("+7 (912) 345-67-89", "[phone hidden]"),
+    ("8-912-345-67-89", "[phone hidden]"),
+    ("позвони 89123456789 или @nick", "позвони [phone hidden] или @hidden"),
+    ("tg://user?id=1 и t.me/x и 123456789012", "[hidden] и [link hidden] и [phone hidden]"),
+    ("tg://user?id=123456789012", "[hidden]"),
+    ("t.me/+79123456789", "[link hidden]"),
+    ("ник @ab и @abc", "ник @ab и @hidden"),
+]
+
+_FRAGMENTS = [
+    "привет", " ", "  ", "\n", ".", ",", "-", "(", ")", "+", "@", "/", "?", "=",
+    "tg://user?id=", "TG://", "t.me/", "T.Me/", "https://", "http://", "t.m",
+    "mail", ".ru", "gmail.com", "_", "user", "ник", "Ω", "🙂",
+    "7", "8", "9", "12", "345", "67-89", "(912)", "0000000",
+]
+
+
+@pytest.mark.parametrize("raw, expected", GOLDEN)
+def test_golden(raw: str, expected: str) -> None:
+    assert legacy_sanitize(raw) == expected
+    assert sanitize_text(raw) == expected
+
+
+def test_fuzz_matches_legacy_chain() -> None:
+    rnd = random.Random(22)
+    for _ in range(50_000):
+        s = "".join(rnd.choice(_FRAGMENTS) for _ in range(rnd.randint(0, 14)))
+        assert sanitize_text(s) == legacy_sanitize(s), s
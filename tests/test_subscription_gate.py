@@ -0,0 +1,107 @@
+# tests/test_subscription_gate.py
+"""Перепроверка подписок против фейковой сессии Bot (без сети)."""
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import GetChat, GetChatMember
+from aiogram.types import ChatFullInfo, ChatMemberLeft, ChatMemberMember, ChatMemberOwner, User
+
+from app.db.core import close_db, db, init_db, write_many
+from app.services import subscription_gate as gate
+
+CHANNEL_ID = -100500
+
+
+class FakeSession(BaseSession):
+    """get_chat_member по таблице статусов: "member"/"owner"/"left"/"error"."""
+
+    def __init__(self, statuses: Dict[int, str]) -> None:
+        super().__init__()
+        self.statuses = statuses
+        self.calls = 0
+
+    async def make_request(self, bot: Bot, method: Any, timeout: Optional[int] = None) -> Any:
+        if isinstance(method, GetChat):
+            return ChatFullInfo(id=CHANNEL_ID, type="channel", accent_color_id=0, max_reaction_count=0)
+        assert isinstance(method, GetChatMember)
+        self.calls += 1
+        uid = int(method.user_id)
+        user = User(id=uid, is_bot=False, first_name="u")
+        kind = self.statuses[uid]
+        if kind == "member":
+            return ChatMemberMember(user=user)
+        if kind == "owner":
+            return ChatMemberOwner(user=user, is_anonymous=False)
+        if kind == "left":
+            return ChatMemberLeft(user=user)
+        raise TelegramBadRequest(method=method, message="Bad Request: member list is inaccessible")
+
+    async def close(self) -> None:
+        pass
+
+    async def stream_content(self, *args: Any, **kwargs: Any):  # pragma: no cover
+        raise NotImplementedError
+        yield b""
+
+
+def _reset_gate() -> None:
+    gate._VERIFIED.clear()
+    gate._MEMBERSHIP.clear()
+    gate._RECHECK.clear()
+    gate._RESOLVED_CHANNEL_ID = None
+
+
+def test_probe_classifies_enum_statuses(fresh_db: str) -> None:
+    _reset_gate()
+    session = FakeSession({1: "member", 2: "owner", 3: "left", 4: "error"})
+    bot = Bot("123:abc", session=session)
+
+    async def run() -> list:
+        return [await gate.check_membership(bot, uid, force=True) for uid in (1, 2, 3, 4)]
+
+    assert asyncio.run(run()) == [True, True, False, None]
+
+
+def test_recheck_keeps_members_revokes_leavers_trusts_errors(fresh_db: str) -> None:
+    _reset_gate()
+    statuses = {1: "member", 2: "member", 3: "owner", 4: "member", 5: "member",
+                6: "left", 7: "error"}
+    session = FakeSession(statuses)
+    bot = Bot("123:abc", session=session)
+
+    async def run() -> tuple[int, set[int], set[int]]:
+        await init_db()
+        try:
+            await write_many(
+                "INSERT INTO users(tg_id, sub_verified) VALUES(?,1)", [(u,) for u in statuses]
+            )
+            await gate.load_verified()
+            revoked = await gate.recheck_batch(bot, limit=100, rps=0)
+            async with db() as conn:
+                cur = await conn.execute("SELECT tg_id FROM users WHERE sub_verified=1")
+                in_db = {int(r[0]) for r in await cur.fetchall()}
+            return revoked, set(gate._VERIFIED), in_db
+        finally:
+            await close_db()
+
+    revoked, verified, in_db = asyncio.run(run())
+    assert revoked == 1
+    assert verified == in_db == {1, 2, 3, 4, 5, 7}  # 6 вышел, 7 — ошибка проверки: не трогаем
+    assert session.calls == len(statuses)
+
+
+def test_recheck_prunes_expired_membership_entries() -> None:
+    _reset_gate()
+    now = time.monotonic()
+    gate._MEMBERSHIP.update({uid: (False, now - 1) for uid in range(1000)})
+    gate._MEMBERSHIP[5000] = (True, now + 3600)
+    bot = Bot("123:abc", session=FakeSession({}))
+
+    assert asyncio.run(gate.recheck_batch(bot, limit=10, rps=0)) == 0
+    assert set(gate._MEMBERSHIP) == {5000}